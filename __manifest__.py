@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 {
     'name': 'CDEK API v2 Integration (cdek_odooAPI2)',
-    'version': '18.0.1.0.0',
+    'version': '18.0.1.3.0',
     'summary': 'Интеграция с CDEK API v2: модели, контроллеры, сервис и frontend‑виджет выбора ПВЗ',
     'description': """
 Модуль интеграции Odoo с CDEK API v2.
@@ -30,6 +30,9 @@
         'website',            
         'website_sale',
     ],
+    'external_dependencies': {
+        'python': ['unidecode'],
+    },
 
     'data': [
         'security/ir.model.access.csv',
@@ -40,6 +43,8 @@
         'views/delivery_carrier_views.xml',
         'views/stock_picking_views.xml',
         'views/sale_order_views.xml',
+        'views/product_views.xml',
+        'views/stock_package_type_views.xml',
         'views/cdek_pvz_views.xml',
         'views/cdek_pvz_views.xml', 
         'views/cdek_tariff_views.xml',
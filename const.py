@@ -10,9 +10,14 @@ CDEK_URLS = {
     "delivery_points":    "deliverypoints",
     "location_cities":    "location/cities",
     "calculator_tariff":  "calculator/tariff",
+    "calculator_tarifflist": "calculator/tarifflist",
     "orders":             "orders",
     "order_by_uuid":      "orders/{uuid}",
-    "print_barcodes":     "print/orders/{uuid}/labels/{format}",
+    "print_barcodes":     "print/barcodes",
+    "print_barcodes_job": "print/barcodes/{uuid}",
+    "print_barcodes_pdf": "print/barcodes/{uuid}.pdf",
+    "webhooks":           "webhooks",
+    "webhook_by_uuid":    "webhooks/{uuid}",
 }
 
 # Label Formats supported by CDEK and this module
@@ -33,4 +38,139 @@ DEFAULT_WEIGHT_KG = 1.0
 CDEK_ORDER_TYPE_IM = 1
 
 # Timeouts for requests
-REQUEST_TIMEOUT_SECONDS = 30
\ No newline at end of file
+REQUEST_TIMEOUT_SECONDS = 30
+
+# Per-endpoint deadline (seconds) covering every attempt of one call, retries
+# included; endpoints not listed get REQUEST_TIMEOUT_SECONDS. Checkout-facing
+# calls are tight so a slow CDEK cannot hold a website worker.
+CDEK_CONNECT_TIMEOUT_SECONDS = 3
+CDEK_ENDPOINT_DEADLINES = {
+    "token": 10,
+    "calculator_tariff": 6,
+    "calculator_tarifflist": 8,
+    "location_cities": 4,
+    "delivery_points": 10,
+    "order_by_uuid": 15,
+    "orders": 60,
+}
+# Manual retries inside the deadline: transient answers are retried for reads
+# and calculator calls only; other POSTs are retried only when the connection
+# was never established
+CDEK_RETRY_MAX_ATTEMPTS = 3
+CDEK_RETRY_BACKOFF_SECONDS = 0.5
+CDEK_RETRY_STATUSES = (429, 500, 502, 503, 504)
+CDEK_IDEMPOTENT_POSTS = ("calculator_tariff", "calculator_tarifflist")
+
+# Rate limiter shared by all processes of the server (token bucket per CDEK
+# account). Each priority class leaves this fraction of the bucket to the
+# classes above it; every request earns CDEK_RETRY_BUDGET_RATIO retry credit,
+# capped at CDEK_RETRY_BUDGET_MAX, and each retry spends one.
+CDEK_RATE_LIMIT_PER_SECOND = 10
+CDEK_RATE_LIMIT_BURST = 20
+CDEK_RATE_LIMIT_RESERVES = {
+    "interactive": 0.0,
+    "warehouse": 0.25,
+    "background": 0.5,
+}
+CDEK_RATE_LIMIT_DEFAULT_PRIORITY = "warehouse"
+CDEK_RATE_LIMIT_MAX_SLEEP_SECONDS = 1
+CDEK_RETRY_BUDGET_MAX = 10
+CDEK_RETRY_BUDGET_RATIO = 0.1
+
+# Circuit breakers shared by the CDEK clients of a worker, one per endpoint class:
+# failing background calls must not make the checkout calls below fail fast
+CDEK_CIRCUIT_FAILURE_THRESHOLD = 5
+CDEK_CIRCUIT_RESET_SECONDS = 30
+CDEK_CIRCUIT_INTERACTIVE_ENDPOINTS = frozenset({"calculator_tariff", "calculator_tarifflist", "location_cities"})
+
+# Connection pool of the long-lived per-worker CDEK client
+CDEK_POOL_CONNECTIONS = 4
+CDEK_POOL_MAXSIZE = 16
+
+# OAuth token cache: refresh this many seconds before expiry (hard margin) and
+# start refreshing opportunistically inside the refresh-ahead window.
+CDEK_TOKEN_EXPIRY_MARGIN_SECONDS = 60
+CDEK_TOKEN_REFRESH_AHEAD_SECONDS = 300
+CDEK_TOKEN_DEFAULT_TTL_SECONDS = 3600
+# Waiting for another process' refresh is bounded by the caller's deadline (or this, without one)
+CDEK_TOKEN_LOCK_TIMEOUT_SECONDS = 30
+CDEK_TOKEN_LOCK_POLL_SECONDS = 0.05
+
+# Rate quote cache: weight is rounded up to CDEK's billing step before keying
+CDEK_BILLING_WEIGHT_STEP_G = 100
+CDEK_RATE_CACHE_SIZE = 2048
+CDEK_RATE_CACHE_TTL_SECONDS = 600
+# Parcel priced from each sender location to itself to list the tariffs available there
+CDEK_TARIFF_PROBE_PACKAGE = {"weight": 1000, "length": 10, "width": 10, "height": 10}
+# Last good quote per route and weight bracket, served as an estimate while CDEK is unavailable
+CDEK_STALE_QUOTE_WEIGHT_BRACKET_G = 500
+CDEK_STALE_QUOTE_TTL_SECONDS = 24 * 3600
+
+# Streaming downloads and PVZ replica sync
+STREAM_CHUNK_SIZE = 64 * 1024
+CDEK_PVZ_SYNC_PAGE_SIZE = 1000
+CDEK_PVZ_SYNC_BATCH_SIZE = 500
+
+# Server-side PVZ clustering: grid cells per tile side, tile budget per request
+CDEK_PVZ_CLUSTER_GRID = 4
+CDEK_PVZ_CLUSTER_MAX_TILES = 64
+CDEK_PVZ_CLUSTER_CACHE_SIZE = 4096
+CDEK_PVZ_CLUSTER_CACHE_TTL_SECONDS = 6 * 3600
+
+# Bulk tracking update: status fetches in flight on the async client (bounded
+# by the connection pool), applied and committed per batch
+CDEK_TRACKING_WORKERS = 16
+CDEK_TRACKING_BATCH_SIZE = 200
+
+# Webhooks: event types subscribed to, inbox batch size, and how often the
+# tracking cron still polls CDEK once webhooks deliver the statuses
+CDEK_WEBHOOK_TYPES = ("ORDER_STATUS", "PRINT_FORM")
+CDEK_WEBHOOK_BATCH_SIZE = 500
+CDEK_WEBHOOK_RECONCILE_HOURS = 6
+CDEK_WEBHOOK_RETENTION_DAYS = 30
+
+# Adaptive tracking schedule: next check = base interval (cdek.tracking_update_interval_minutes)
+# times the factor of the current CDEK status; unknown codes count as in transit.
+# Errors back off exponentially from the base interval.
+CDEK_TRACKING_DEFAULT_FACTOR = 2
+CDEK_TRACKING_STATUS_FACTORS = {
+    "CREATED": 3,
+    "ACCEPTED": 3,
+    "ACCEPTED_IN_RECIPIENT_CITY": 1,
+    "TAKEN_BY_COURIER": 1,
+    "ACCEPTED_AT_PICK_UP_POINT": 12,
+    "POSTOMAT_POSTED": 12,
+    "NOT_DELIVERED": 24,
+    "DELIVERED": 24 * 7,
+    "POSTOMAT_RECEIVED": 24 * 7,
+    "INVALID": 24 * 7,
+    "REMOVED": 24 * 7,
+}
+CDEK_TRACKING_MAX_BACKOFF_EXPONENT = 5
+
+# Shipment registration queue: jobs per cron batch, concurrent POST /orders
+# calls, retry budget and exponential backoff base. The picking name is sent
+# as the CDEK order number and serves as idempotency key.
+CDEK_SHIPMENT_BATCH_SIZE = 100
+CDEK_SHIPMENT_WORKERS = 4
+CDEK_SHIPMENT_MAX_ATTEMPTS = 6
+CDEK_SHIPMENT_RETRY_BASE_SECONDS = 60
+# Jobs left in progress longer than this (worker crashed mid-call) are
+# reconciled: looked up by order number at CDEK before any new POST
+CDEK_SHIPMENT_STALE_MINUTES = 15
+
+# Label print jobs (print/barcodes): CDEK accepts at most 100 orders per job
+# and renders asynchronously, so the job is polled until READY
+CDEK_PRINT_MAX_ORDERS = 100
+CDEK_PRINT_PAPER_FORMAT = "A6"
+CDEK_PRINT_POLL_INTERVAL_SECONDS = 1
+CDEK_PRINT_POLL_TIMEOUT_SECONDS = 120
+# Bumped whenever the requested print form changes (paper format, copies,
+# CDEK layout); cached labels of older versions are fetched again
+CDEK_PRINT_FORM_VERSION = f"barcodes/{CDEK_PRINT_PAPER_FORMAT}/1"
+
+# Multi-parcel packing: CDEK weight limit per parcel (overridable with
+# cdek.max_package_weight_kg) and the per-worker cache of packing results
+CDEK_MAX_PACKAGE_WEIGHT_KG = 30.0
+CDEK_PACKING_CACHE_SIZE = 1024
+CDEK_PACKING_CACHE_TTL_SECONDS = 600
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 import logging
-from odoo import http, _
-from odoo.http import request
+import tempfile
+
+from werkzeug.wsgi import wrap_file
+
+from odoo import fields, http, _
+from odoo.http import Response, content_disposition, request
 from odoo.exceptions import UserError, AccessError
 
+from ..services import cdek_rate_limiter
+
 _logger = logging.getLogger(__name__)
 
 
@@ -29,13 +35,30 @@ class CdekFrontendApi(http.Controller):
 
 
     @http.route("/cdek/city/search", type="json", auth="public", methods=["POST"], csrf=False)
-    def city_search(self, query=None, limit=10, **_):
-        """Return a list of cities for the autocomplete widget."""
+    def city_search(self, query=None, limit=10, country_code=None, **_):
+        """Return a list of cities for the autocomplete widget.
+
+        Answered from the local ``cdek.city`` directory once it has been synced.
+        CDEK is queried live when nothing matches locally, unless the requested
+        country is synced (then there is nothing more to find).
+        """
         if not query:
             return []
         try:
+            country_code = country_code.upper() if country_code else None
+            cities_model = request.env["cdek.city"].sudo()
+            if cities_model._has_replica():
+                cities = cities_model._search_autocomplete(
+                    query, limit=max(1, min(int(limit), 50)), country_code=country_code)
+                if cities or (country_code and cities_model._has_replica(country_code)):
+                    return cities
+
             client = self._get_client()
-            cities = client.get_cities({"q": query, "size": int(limit)})
+            params = {"q": query, "size": int(limit)}
+            if country_code:
+                params["country_codes"] = country_code
+            with cdek_rate_limiter.priority("interactive"):
+                cities = client.get_cities(**params)
             return [
                 {
                     "code": str(c.get("code")),
@@ -64,41 +87,68 @@ class CdekFrontendApi(http.Controller):
 
     @http.route("/cdek/pvz/search", type="json", auth="public", methods=["POST"], csrf=False)
     def pvz_search(self, city_code=None, delivery_type="PVZ", limit=300, **_):
-        """Return pickup points for the given *city_code*."""
+        """Return pickup points for the given *city_code*.
+
+        Served from the local ``cdek.pvz`` replica; CDEK is only queried live
+        for cities that have never been synced or when live search is forced.
+        """
         if not city_code:
             return []
         try:
-            client = self._get_client()
-            params = {
-                "city_code": int(city_code),
-                "type": delivery_type.upper() if delivery_type else None,
-                "size": int(limit),
-            }
-            points = client.get_delivery_points(params=params)
-            res = []
-            for p in (points or []):
-                loc = p.get("location", {})
-                res.append(
-                    {
-                        "code": p.get("code"),
-                        "name": p.get("name"),
-                        "address": loc.get("address"),
-                        "address_full": loc.get("address_full"),
-                        "city": loc.get("city"),
-                        "work_time": p.get("work_time"),
-                        "lat": loc.get("latitude"),
-                        "lon": loc.get("longitude"),
-                        "type": p.get("type"),
-                        "owner_code": p.get("owner_code"),
-                        "is_cash_allowed": p.get("have_cash") or p.get("is_cash_on_delivery"),
-                        "is_card_allowed": p.get("have_card") or p.get("is_card_payment"),
-                    }
-                )
-            return res
+            return request.env["cdek.pvz"].sudo()._get_widget_points(
+                int(city_code), delivery_type.upper() if delivery_type else None, int(limit))
         except Exception as e:
             _logger.exception("CDEK PVZ search failed: %s", e)
             return self._json_error(str(e), "PVZ_SEARCH_ERROR")
 
+    @http.route("/cdek/pvz/nearby", type="json", auth="public", methods=["POST"], csrf=False)
+    def pvz_nearby(self, lat=None, lon=None, delivery_type=None, limit=20, **_):
+        """Return the *limit* pickup points nearest to (*lat*, *lon*)."""
+        if lat is None or lon is None:
+            return self._json_error(_("Missing coordinates."), "PVZ_NEARBY_PARAM_ERROR")
+        try:
+            return request.env["cdek.pvz"].sudo()._search_nearest_widget_points(
+                float(lat), float(lon),
+                limit=max(1, min(int(limit), 200)),
+                pvz_type=delivery_type.upper() if delivery_type else None,
+            )
+        except Exception as e:
+            _logger.exception("CDEK PVZ nearby search failed: %s", e)
+            return self._json_error(str(e), "PVZ_NEARBY_ERROR")
+
+    @http.route("/cdek/pvz/viewport", type="json", auth="public", methods=["POST"], csrf=False)
+    def pvz_viewport(self, bbox=None, delivery_type=None, limit=500, **_):
+        """Return pickup points inside *bbox* = [south, west, north, east]."""
+        if not bbox or len(bbox) != 4:
+            return self._json_error(_("Missing map bounds."), "PVZ_VIEWPORT_PARAM_ERROR")
+        try:
+            south, west, north, east = (float(v) for v in bbox)
+            return request.env["cdek.pvz"].sudo()._search_viewport_widget_points(
+                south, west, north, east,
+                limit=max(1, min(int(limit), 2000)),
+                pvz_type=delivery_type.upper() if delivery_type else None,
+            )
+        except Exception as e:
+            _logger.exception("CDEK PVZ viewport search failed: %s", e)
+            return self._json_error(str(e), "PVZ_VIEWPORT_ERROR")
+
+    @http.route("/cdek/pvz/clusters", type="json", auth="public", methods=["POST"], csrf=False)
+    def pvz_clusters(self, bbox=None, zoom=None, delivery_type=None, **_):
+        """Return pickup point clusters for *bbox* = [south, west, north, east] at map *zoom*."""
+        if not bbox or len(bbox) != 4 or zoom is None:
+            return self._json_error(_("Missing map bounds or zoom."), "PVZ_CLUSTERS_PARAM_ERROR")
+        try:
+            south, west, north, east = (float(v) for v in bbox)
+            return request.env["cdek.pvz"].sudo()._get_viewport_clusters(
+                south, west, north, east, int(zoom),
+                pvz_type=delivery_type.upper() if delivery_type else None,
+            )
+        except UserError as e:
+            return self._json_error(str(e), "PVZ_CLUSTERS_PARAM_ERROR")
+        except Exception as e:
+            _logger.exception("CDEK PVZ clustering failed: %s", e)
+            return self._json_error(str(e), "PVZ_CLUSTERS_ERROR")
+
     @http.route("/cdek/calc", type="json", auth="public", methods=["POST"], csrf=False)
     def calc(self, order_id=None, carrier_id=None, cdek_city_code_to=None, cdek_pvz_code=None, **_):
         """Calculate delivery price and transit time."""
@@ -185,3 +235,40 @@ class CdekFrontendApi(http.Controller):
         except Exception as e:
             _logger.exception("Unexpected error updating delivery: %s", e)
             return self._json_error(_("Server error."), "SERVER_ERROR")
+
+
+class CdekLabelController(http.Controller):
+    """Backend download of CDEK shipping labels."""
+
+    @http.route("/cdek/labels", type="http", auth="user", methods=["GET"])
+    def labels(self, picking_ids="", **_):
+        """Stream the merged labels of several pickings.
+
+        The merge is spooled to a temporary file and streamed from there; it is
+        never stored as an attachment, the per-picking labels stay the cache.
+        """
+        ids = [int(picking_id) for picking_id in picking_ids.split(",") if picking_id.strip().isdigit()]
+        pickings = request.env["stock.picking"].browse(ids).exists()
+        if not pickings:
+            return request.not_found()
+        pickings.check_access("read")
+        attachments = pickings._cdek_ensure_labels()
+
+        merged = tempfile.TemporaryFile()
+        try:
+            pickings._cdek_merge_label_pdf(attachments, merged)
+            size = merged.tell()
+            merged.seek(0)
+        except Exception:
+            merged.close()
+            raise
+        name = f"cdek_labels_{fields.Datetime.now():%Y%m%d_%H%M%S}.pdf"
+        return Response(
+            wrap_file(request.httprequest.environ, merged),
+            headers=[
+                ("Content-Type", "application/pdf"),
+                ("Content-Length", str(size)),
+                ("Content-Disposition", content_disposition(name)),
+            ],
+            direct_passthrough=True,
+        )
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import hmac
+import json
+import logging
+
+from odoo import http
+from odoo.http import request
+
+_logger = logging.getLogger(__name__)
+
+
+class CdekWebhook(http.Controller):
+    """Receiver for CDEK webhook callbacks (ORDER_STATUS, PRINT_FORM)."""
+
+    @http.route("/cdek/webhook", type="http", auth="public", methods=["POST"], csrf=False, save_session=False)
+    def webhook(self, token=None, **_):
+        """
+        Store the callback in the ``cdek.webhook.event`` inbox and return at once.
+        CDEK does not sign callbacks, so the URL registered with CDEK carries a
+        shared secret (``cdek.webhook_secret``) that is checked here.
+        """
+        secret = request.env["ir.config_parameter"].sudo().get_param("cdek.webhook_secret")
+        if not secret or not token or not hmac.compare_digest(token, secret):
+            _logger.warning("CDEK webhook rejected: invalid token from %s", request.httprequest.remote_addr)
+            return request.make_response("Forbidden", status=403)
+
+        try:
+            payload = json.loads(request.httprequest.get_data() or b"null")
+        except ValueError:
+            return request.make_response("Bad Request", status=400)
+
+        events = request.env["cdek.webhook.event"].sudo()
+        payloads = payload if isinstance(payload, list) else [payload]
+        vals_list = [vals for vals in map(events._prepare_event_vals, payloads) if vals]
+        if not vals_list:
+            return request.make_response("Bad Request", status=400)
+
+        events.create(vals_list)
+        cron = request.env.ref("cdek_odooAPI2.ir_cron_process_cdek_webhooks", raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return request.make_response("OK")
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""The tracking cron calls ``cron_update_cdek_tracking`` instead of inline code.
+
+Scheduled actions are loaded with noupdate, so existing databases keep the old
+code until it is rewritten here.
+"""
+from odoo import SUPERUSER_ID, api
+
+
+def migrate(cr, version):
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    cron = env.ref('cdek_odooAPI2.ir_cron_update_cdek_tracking', raise_if_not_found=False)
+    if cron:
+        cron.write({'code': 'model.cron_update_cdek_tracking()'})
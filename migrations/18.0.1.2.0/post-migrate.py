@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Tracking history moved from the stored ``stock_picking.cdek_tracking_history_log``
+text to ``cdek.tracking.event`` rows; import the old logs as events.
+
+Each log line was written as ``<date_time> - [<code>] <name> (<city>)``. The
+old column is left in place, so lines that cannot be parsed are not lost.
+"""
+import logging
+import re
+
+from odoo import SUPERUSER_ID, api
+from odoo.tools.sql import column_exists
+
+_logger = logging.getLogger(__name__)
+
+LINE_RE = re.compile(r'^(?P<date_time>\S+) - \[(?P<code>[^\]]+)\] ?(?P<name>.*?)(?: \((?P<city>[^()]*)\))?$')
+
+
+def migrate(cr, version):
+    if not column_exists(cr, 'stock_picking', 'cdek_tracking_history_log'):
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    Picking = env['stock.picking']
+    cr.execute("""
+        SELECT id, COALESCE(cdek_order_uuid, carrier_tracking_ref), cdek_tracking_history_log
+          FROM stock_picking
+         WHERE cdek_tracking_history_log IS NOT NULL
+           AND COALESCE(cdek_order_uuid, carrier_tracking_ref) IS NOT NULL
+    """)
+    vals_list = []
+    skipped = 0
+    for picking_id, order_uuid, log in cr.fetchall():
+        for line in log.splitlines():
+            match = LINE_RE.match(line.strip())
+            date_time = match and Picking._cdek_parse_datetime(match['date_time'])
+            if not date_time:
+                skipped += bool(line.strip())
+                continue
+            vals_list.append({
+                'picking_id': picking_id,
+                'order_uuid': order_uuid,
+                'code': match['code'],
+                'name': match['name'] or None,
+                'date_time': date_time,
+                'city': match['city'] or None,
+                'source': 'poll',
+            })
+    imported = env['cdek.tracking.event']._insert_events(vals_list) if vals_list else []
+    _logger.info("CDEK: imported %s tracking events from the old history logs (%s unreadable lines kept in "
+                 "stock_picking.cdek_tracking_history_log)", len(imported), skipped)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""Tracking is polled every 15 minutes, next to the webhook and shipment queue crons.
+
+Scheduled actions are loaded with noupdate, so an existing tracking cron keeps
+its hourly interval until it is changed here. The queue crons are new records
+and get created by the data file; make sure they are running.
+"""
+from odoo import SUPERUSER_ID, api
+
+
+def migrate(cr, version):
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    cron = env.ref('cdek_odooAPI2.ir_cron_update_cdek_tracking', raise_if_not_found=False)
+    if cron:
+        cron.write({'interval_number': 15, 'interval_type': 'minutes'})
+    for xmlid in ('cdek_odooAPI2.ir_cron_process_cdek_webhooks', 'cdek_odooAPI2.ir_cron_process_cdek_shipments'):
+        cron = env.ref(xmlid, raise_if_not_found=False)
+        if cron and not cron.active:
+            cron.active = True
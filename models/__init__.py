@@ -1,6 +1,15 @@
+from . import cdek_directory_mixin
 from . import cdek_tariff
 from . import cdek_pvz
+from . import cdek_city
+from . import cdek_tracking_event
+from . import cdek_webhook_event
+from . import cdek_shipment_job
+from . import cdek_label
+from . import product
+from . import stock_package_type
 from . import delivery_carrier
 from . import stock_picking
 from . import sale_order
 from . import res_config_settings
+from . import ir_config_parameter
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models
+from odoo.tools.sql import create_index
+
+from ..services.cdek_text import like_prefix, normalize_search_text, transliterate_search_text
+
+
+class CdekCity(models.Model):
+    _name = 'cdek.city'
+    _inherit = ['cdek.directory.mixin']
+    _description = 'CDEK City'
+    _order = 'name'
+    _cdek_sync_label = 'city'
+
+    code = fields.Integer(string='City Code (CDEK)', required=True, index=True)
+    name = fields.Char(string='City', required=True)
+    region = fields.Char(string='Region')
+    sub_region = fields.Char(string='Sub-region')
+    country_code = fields.Char(string='Country Code', index=True)
+    country = fields.Char(string='Country')
+    latitude = fields.Float(string='Latitude', digits=(10, 7))
+    longitude = fields.Float(string='Longitude', digits=(10, 7))
+    search_key = fields.Char(readonly=True, help="Case and ё/е folded city name used for prefix search.")
+    search_key_translit = fields.Char(readonly=True, help="Transliterated search key, for queries typed in Latin.")
+
+    _sql_constraints = [
+        ('code_uniq', 'unique (code)', 'CDEK city code must be unique!')
+    ]
+
+    def init(self):
+        create_index(self._cr, 'cdek_city_search_key_idx', self._table, ['search_key text_pattern_ops'], where='active')
+        create_index(self._cr, 'cdek_city_search_key_translit_idx', self._table,
+                     ['search_key_translit text_pattern_ops'], where='active')
+
+    @api.model
+    def _cdek_iter_page(self, client, country_code, page, size):
+        return client.iter_cities(country_codes=country_code, page=page, size=size)
+
+    @api.model
+    def _cdek_prepare_vals(self, data):
+        name = data.get('city') or str(data.get('code'))
+        return {
+            'code': data.get('code'),
+            'name': name,
+            'region': data.get('region'),
+            'sub_region': data.get('sub_region'),
+            'country_code': data.get('country_code'),
+            'country': data.get('country'),
+            'latitude': data.get('latitude'),
+            'longitude': data.get('longitude'),
+            'search_key': normalize_search_text(name),
+            'search_key_translit': transliterate_search_text(name),
+        }
+
+    @api.model
+    def _has_replica(self, country_code=None):
+        """Whether cities were synced at all, or for ``country_code`` when given."""
+        if country_code:
+            self.env.cr.execute("SELECT 1 FROM cdek_city WHERE active AND country_code = %s LIMIT 1",
+                                (country_code.upper(),))
+        else:
+            self.env.cr.execute("SELECT 1 FROM cdek_city WHERE active LIMIT 1")
+        return bool(self.env.cr.fetchone())
+
+    @api.model
+    def _search_autocomplete(self, query, limit=10, country_code=None):
+        """Prefix search on the folded and transliterated city names, exact matches and short names first."""
+        key = normalize_search_text(query)
+        if not key:
+            return []
+        self.env.cr.execute("""
+            SELECT code, name, region, country_code, country, latitude, longitude
+              FROM cdek_city
+             WHERE active AND (search_key LIKE %s OR search_key_translit LIKE %s)
+               AND (%s IS NULL OR country_code = %s)
+             ORDER BY search_key = %s DESC, length(search_key), name
+             LIMIT %s
+        """, (like_prefix(key), like_prefix(transliterate_search_text(key)),
+              country_code, country_code, key, limit))
+        return [
+            {
+                "code": str(code),
+                "city": name,
+                "region": region,
+                "country_code": country_code,
+                "country": country,
+                "lat": lat,
+                "lon": lon,
+            }
+            for code, name, region, country_code, country, lat, lon in self.env.cr.fetchall()
+        ]
+
+    @api.model
+    def cron_update_cdek_city_list(self, auto_commit=True):
+        """
+        Scheduled action: replicate the CDEK city directory for the PVZ sync countries.
+        The start of the last successful run is stored in 'cdek.city_sync_watermark'.
+        """
+        self._cdek_run_sync('cdek.city_sync_watermark', auto_commit=auto_commit)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+from odoo.tools import SQL
+
+from ..const import CDEK_PVZ_SYNC_BATCH_SIZE, CDEK_PVZ_SYNC_PAGE_SIZE
+from ..services import cdek_rate_limiter
+
+_logger = logging.getLogger(__name__)
+
+
+class CdekDirectoryMixin(models.AbstractModel):
+    """Local replica of a CDEK directory (pickup points, cities) synced page by page per country.
+
+    Inheriting models provide ``_cdek_sync_key`` (unique column used for the
+    upsert), ``_cdek_iter_page()`` and ``_cdek_prepare_vals()``.
+    """
+    _name = 'cdek.directory.mixin'
+    _description = 'CDEK Replicated Directory'
+    _cdek_sync_key = 'code'
+    _cdek_sync_label = 'directory'
+
+    active = fields.Boolean(default=True, index=True)
+    last_synced = fields.Datetime(string='Last Synced', readonly=True)
+
+    @api.model
+    def _cdek_iter_page(self, client, country_code, page, size):
+        """
+        Hook: yield the raw CDEK records of one page of the directory of ``country_code``.
+        A page shorter than ``size`` ends the sync of that country.
+        """
+        raise UserError(_("%s does not define how to page through its CDEK directory.") % self._name)
+
+    @api.model
+    def _cdek_prepare_vals(self, data):
+        """Hook: map one raw CDEK record onto column values; they must include ``_cdek_sync_key``."""
+        raise UserError(_("%s does not define how to store CDEK directory records.") % self._name)
+
+    @api.model
+    def _upsert_batch(self, vals_list, synced_at=None):
+        """
+        Insert or update rows on the sync key with a single INSERT ... ON CONFLICT.
+        Bypasses the ORM on purpose (a full country is tens of thousands of rows) but goes through the
+        Odoo cursor: pending writes are flushed before and the model cache invalidated after.
+        :return: number of rows written
+        """
+        key = self._cdek_sync_key
+        vals_list = [vals for vals in vals_list if vals.get(key)]
+        if not vals_list:
+            return 0
+        synced_at = synced_at or fields.Datetime.now()
+        columns = list(vals_list[0])
+        uid = self.env.uid
+        # Last occurrence wins when CDEK repeats a key inside one batch
+        rows = {
+            vals[key]: tuple([vals.get(col) for col in columns] + [synced_at, True, uid, synced_at, uid, synced_at])
+            for vals in vals_list
+        }
+        all_columns = columns + ['last_synced', 'active', 'create_uid', 'create_date', 'write_uid', 'write_date']
+        query = SQL(
+            """
+            INSERT INTO %(table)s (%(columns)s)
+            VALUES %(rows)s
+            ON CONFLICT (%(key)s) DO UPDATE SET
+                %(updates)s, last_synced = EXCLUDED.last_synced, active = TRUE,
+                write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date
+            """,
+            table=SQL.identifier(self._table),
+            columns=SQL(', ').join(SQL.identifier(col) for col in all_columns),
+            rows=SQL(', ').join(SQL('%s', row) for row in rows.values()),
+            key=SQL.identifier(key),
+            updates=SQL(', ').join(
+                SQL('%s = EXCLUDED.%s', SQL.identifier(col), SQL.identifier(col)) for col in columns if col != key
+            ),
+        )
+        self.env.flush_all()
+        self.env.cr.execute(query)
+        self.invalidate_model()
+        return len(rows)
+
+    @api.model
+    def _sync_country(self, client, country_code, synced_at, auto_commit=False):
+        """Page through the CDEK directory of one country and upsert it in batches."""
+        total = 0
+        page = 0
+        batch = []
+        while True:
+            page_count = 0
+            for data in self._cdek_iter_page(client, country_code, page, CDEK_PVZ_SYNC_PAGE_SIZE):
+                page_count += 1
+                batch.append(self._cdek_prepare_vals(data))
+                if len(batch) >= CDEK_PVZ_SYNC_BATCH_SIZE:
+                    total += self._upsert_batch(batch, synced_at)
+                    batch = []
+                    if auto_commit:
+                        self.env.cr.commit()
+            if page_count < CDEK_PVZ_SYNC_PAGE_SIZE:
+                break
+            page += 1
+        total += self._upsert_batch(batch, synced_at)
+        return total
+
+    @api.model
+    def _deactivate_vanished(self, country_code, synced_at):
+        """Archive rows of a fully synced country that CDEK no longer returned."""
+        self.env.flush_all()
+        self.env.cr.execute(SQL(
+            """
+            UPDATE %(table)s SET active = FALSE, write_uid = %(uid)s, write_date = %(now)s
+             WHERE country_code = %(country)s AND active
+               AND (last_synced IS NULL OR last_synced < %(now)s)
+            """,
+            table=SQL.identifier(self._table), uid=self.env.uid, now=synced_at, country=country_code,
+        ))
+        self.invalidate_model()
+        return self.env.cr.rowcount
+
+    @api.model
+    def _cdek_run_sync(self, watermark_param, auto_commit=True):
+        """
+        Replicate the directory for the countries of 'cdek.pvz_sync_countries' (default RU).
+        Points of an interrupted country stay active: they were just not seen yet.
+        The start of a run where every country succeeded is stored in ``watermark_param``.
+        :return: True if every country was synced
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        countries = [c.strip().upper() for c in (params.get_param('cdek.pvz_sync_countries') or 'RU').split(',') if c.strip()]
+        try:
+            client = self.env['res.config.settings']._get_cdek_client()
+        except UserError as e:
+            _logger.error("CRON: CDEK %s sync skipped: %s", self._cdek_sync_label, e)
+            return False
+
+        synced_at = fields.Datetime.now()
+        failed = []
+        for country_code in countries:
+            started = time.monotonic()
+            try:
+                with cdek_rate_limiter.priority('background'):
+                    count = self._sync_country(client, country_code, synced_at, auto_commit=auto_commit)
+            except Exception as e:
+                _logger.error("CRON: CDEK %s sync failed for %s: %s", self._cdek_sync_label, country_code, e, exc_info=True)
+                if not auto_commit:
+                    raise
+                self.env.cr.rollback()
+                failed.append(country_code)
+                continue
+            archived = self._deactivate_vanished(country_code, synced_at)
+            _logger.info("CRON: CDEK %s sync %s: %s upserted, %s archived in %.1fs",
+                         self._cdek_sync_label, country_code, count, archived, time.monotonic() - started)
+            if auto_commit:
+                self.env.cr.commit()
+
+        if not failed:
+            params.set_param(watermark_param, fields.Datetime.to_string(synced_at))
+        return not failed
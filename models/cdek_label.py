@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import tempfile
+
+from odoo import api, fields, models
+
+from ..const import CDEK_LABEL_FORMATS, CDEK_PRINT_FORM_VERSION, STREAM_CHUNK_SIZE
+
+
+class CdekLabel(models.Model):
+    """
+    Label cache: one stored file per (CDEK order, format, print form version).
+    The content lives in an ``ir.attachment``, so the filestore keeps it once under its checksum.
+    """
+    _name = 'cdek.label'
+    _description = 'CDEK Label'
+    _order = 'id desc'
+    _rec_name = 'order_uuid'
+
+    order_uuid = fields.Char(string='CDEK Order UUID', required=True, readonly=True)
+    label_format = fields.Selection(CDEK_LABEL_FORMATS, string='Format', required=True, readonly=True, default='pdf')
+    version = fields.Char(string='Print Form Version', required=True, readonly=True, default=CDEK_PRINT_FORM_VERSION)
+    picking_id = fields.Many2one('stock.picking', string='Transfer', index=True, ondelete='cascade', readonly=True)
+    attachment_id = fields.Many2one('ir.attachment', string='File', required=True, ondelete='cascade', readonly=True)
+    checksum = fields.Char(related='attachment_id.checksum', store=True, index=True)
+
+    _sql_constraints = [
+        ('label_uniq', 'unique (order_uuid, label_format, version)', 'A CDEK label is stored only once!')
+    ]
+
+    @api.model
+    def _get_cached(self, order_uuids, label_format='pdf', version=CDEK_PRINT_FORM_VERSION):
+        """:return: dict order uuid -> cached label, for the orders whose label is already stored"""
+        labels = self.search([
+            ('order_uuid', 'in', list(order_uuids)),
+            ('label_format', '=', label_format),
+            ('version', '=', version),
+        ])
+        return {label.order_uuid: label for label in labels}
+
+    @api.model
+    def _attachment_from_file(self, fileobj, vals):
+        """
+        Create an attachment from an open binary file.
+        With the file storage the content is copied to the filestore in chunks of STREAM_CHUNK_SIZE,
+        never held in memory as a whole: deduplicated under its checksum and registered for the
+        filestore garbage collector like ``ir.attachment`` does. The database storage needs ``raw``.
+        """
+        Attachment = self.env['ir.attachment']
+        fileobj.seek(0)
+        if Attachment._storage() != 'file':
+            return Attachment.create(dict(vals, raw=fileobj.read()))
+
+        sha = hashlib.sha1()
+        size = 0
+        os.makedirs(Attachment._filestore(), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=Attachment._filestore(), delete=False) as spool:
+            try:
+                for chunk in iter(lambda: fileobj.read(STREAM_CHUNK_SIZE), b''):
+                    sha.update(chunk)
+                    size += len(chunk)
+                    spool.write(chunk)
+            except BaseException:
+                spool.close()
+                os.unlink(spool.name)
+                raise
+        checksum = sha.hexdigest()
+        # same layout as ir.attachment._get_path, existing files are kept: same checksum, same content
+        fname = next((name for name in (checksum[:3] + '/' + checksum, checksum[:2] + '/' + checksum)
+                      if os.path.isfile(Attachment._full_path(name))), None)
+        if fname:
+            os.unlink(spool.name)
+        else:
+            fname = checksum[:2] + '/' + checksum
+            full_path = Attachment._full_path(fname)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(spool.name, full_path)
+            # the file is collected again if the transaction rolls back
+            Attachment._mark_for_gc(fname)
+        return Attachment.create(dict(vals, store_fname=fname, checksum=checksum, file_size=size))
+
+    @api.model
+    def _open_attachment(self, attachment):
+        """Open the content of a stored attachment as a binary file."""
+        if attachment.store_fname:
+            return open(attachment._full_path(attachment.store_fname), 'rb')
+        return io.BytesIO(attachment.raw)
+
+    @api.model
+    def _store(self, picking, order_uuid, fileobj, label_format='pdf', version=CDEK_PRINT_FORM_VERSION):
+        """Store a freshly downloaded label file, replacing any label of an older print form version."""
+        self.search([
+            ('order_uuid', '=', order_uuid), ('label_format', '=', label_format), ('version', '!=', version),
+        ]).attachment_id.unlink()
+        attachment = self._attachment_from_file(fileobj, {
+            'name': f"cdek_label_{picking.name.replace('/', '_')}.{label_format}",
+            'mimetype': 'application/pdf' if label_format == 'pdf' else 'text/plain',
+            'res_model': 'stock.picking',
+            'res_id': picking.id,
+        })
+        return self.create({
+            'order_uuid': order_uuid,
+            'label_format': label_format,
+            'version': version,
+            'picking_id': picking.id,
+            'attachment_id': attachment.id,
+        })
+
+    @api.model
+    def _invalidate(self, order_uuids):
+        """Drop the cached labels of orders that changed at CDEK; they are fetched again on next print."""
+        self.search([('order_uuid', 'in', list(order_uuids))]).attachment_id.unlink()
@@ -1,10 +1,24 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields, api
+import json
+import logging
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from odoo.tools.sql import create_index
+
+from ..const import CDEK_PVZ_CLUSTER_GRID, CDEK_PVZ_CLUSTER_MAX_TILES
+from ..services import cdek_cache, cdek_geo, cdek_rate_limiter
+
+_logger = logging.getLogger(__name__)
+
+PVZ_TYPES = ('PVZ', 'POSTAMAT')
 
 class CdekPvz(models.Model):
     _name = 'cdek.pvz'
+    _inherit = ['cdek.directory.mixin']
     _description = 'Пункт выдачи заказов СДЭК'
     _order = 'name'
+    _cdek_sync_label = 'PVZ'
 
     name = fields.Char(string='Наименование ПВЗ', required=True, index=True)
     code = fields.Char(string='Код ПВЗ', required=True, index=True) # Уникальный код ПВЗ от СДЭК
@@ -31,14 +45,22 @@ class CdekPvz(models.Model):
     # Координаты для карты
     longitude = fields.Float(string='Долгота', digits=(10, 7))
     latitude = fields.Float(string='Широта', digits=(10, 7))
+    geohash = fields.Char(string='Geohash', readonly=True,
+                          help="Spatial index key computed from the coordinates at sync time.")
 
     # Технические поля
     last_synced = fields.Datetime(string='Последняя синхронизация') #
+    widget_json = fields.Text(string='Данные для виджета', readonly=True,
+                              help="Compact JSON served as-is by /cdek/pvz/search, precomputed at sync time.")
 
     _sql_constraints = [
         ('code_uniq', 'unique (code)', 'Код ПВЗ должен быть уникальным!')
     ]
 
+    def init(self):
+        create_index(self._cr, 'cdek_pvz_city_code_type_active_idx', self._table, ['city_code', 'type'], where='active')
+        create_index(self._cr, 'cdek_pvz_geohash_active_idx', self._table, ['geohash text_pattern_ops'], where='active')
+
     def name_get(self):
         result = []
         for record in self:
@@ -46,36 +68,224 @@ class CdekPvz(models.Model):
             result.append((record.id, name))
         return result
 
+    @api.model
+    def _prepare_widget_data(self, pvz_data):
+        """Projection of a CDEK /deliverypoints entry used by the checkout widget."""
+        loc = pvz_data.get('location') or {}
+        return {
+            "code": pvz_data.get("code"),
+            "name": pvz_data.get("name"),
+            "address": loc.get("address"),
+            "address_full": loc.get("address_full"),
+            "city": loc.get("city"),
+            "work_time": pvz_data.get("work_time"),
+            "lat": loc.get("latitude"),
+            "lon": loc.get("longitude"),
+            "type": pvz_data.get("type"),
+            "owner_code": pvz_data.get("owner_code"),
+            "is_cash_allowed": pvz_data.get("have_cash") or pvz_data.get("is_cash_on_delivery"),
+            "is_card_allowed": pvz_data.get("have_card") or pvz_data.get("is_card_payment"),
+        }
+
+    @api.model
+    def _search_widget_points(self, city_code, pvz_type=None, limit=300):
+        """
+        Answer the widget from the local replica.
+        :return: list of widget dicts, or None if this city has never been synced
+        """
+        query = """
+            SELECT widget_json FROM cdek_pvz
+             WHERE city_code = %s AND active AND widget_json IS NOT NULL
+        """
+        args = [city_code]
+        if pvz_type:
+            query += " AND type = %s"
+            args.append(pvz_type)
+        query += " ORDER BY name LIMIT %s"
+        args.append(limit)
+        self.env.cr.execute(query, args)
+        rows = self.env.cr.fetchall()
+        if not rows:
+            self.env.cr.execute("SELECT 1 FROM cdek_pvz WHERE city_code = %s AND widget_json IS NOT NULL LIMIT 1",
+                                [city_code])
+            return [] if self.env.cr.fetchone() else None
+        return [json.loads(row[0]) for row in rows]
+
+    @api.model
+    def _get_widget_points(self, city_code, pvz_type=None, limit=300):
+        """
+        Points of a city for the checkout widget, from the local replica.
+        CDEK is only queried live for cities that have never been synced, or always when
+        'cdek.pvz_live_search' is set.
+        """
+        if not self.env['ir.config_parameter'].sudo().get_param('cdek.pvz_live_search'):
+            points = self._search_widget_points(city_code, pvz_type, limit)
+            if points is not None:
+                return points
+        client = self.env['res.config.settings']._get_cdek_client()
+        with cdek_rate_limiter.priority('interactive'):
+            points = client.get_delivery_points(city_code=city_code, type=pvz_type, size=limit)
+        return [self._prepare_widget_data(p) for p in points or []]
+
+    @api.model
+    def _fetch_widget_points_in_cells(self, cells, pvz_type=None, bbox=None, limit=None):
+        """Rows (lat, lon, widget_json) whose geohash starts with one of ``cells``."""
+        if not cells:
+            return []
+        query = "SELECT latitude, longitude, widget_json FROM cdek_pvz WHERE active AND widget_json IS NOT NULL AND ("
+        query += " OR ".join(["geohash LIKE %s"] * len(cells)) + ")"
+        args = [cell + '%' for cell in cells]
+        if pvz_type:
+            query += " AND type = %s"
+            args.append(pvz_type)
+        if bbox:
+            boxes = cdek_geo.split_bbox(*bbox)
+            query += " AND (" + " OR ".join(
+                ["(latitude BETWEEN %s AND %s AND longitude BETWEEN %s AND %s)"] * len(boxes)) + ")"
+            for south, west, north, east in boxes:
+                args += [south, north, west, east]
+            center_lat, center_lon = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+            query += " ORDER BY (latitude - %s) ^ 2 + (longitude - %s) ^ 2"
+            args += [center_lat, center_lon]
+        if limit:
+            query += " LIMIT %s"
+            args.append(limit)
+        self.env.cr.execute(query, args)
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _search_nearest_widget_points(self, lat, lon, limit=20, pvz_type=None):
+        """
+        Nearest ``limit`` points to (lat, lon), each with a 'distance_km' key.
+        Scans the geohash neighbourhood of the point, widening it until the
+        N-th hit is closer than the radius the neighbourhood is known to cover.
+        """
+        rows = []
+        for precision in range(6, 1, -1):
+            rows = self._fetch_widget_points_in_cells(cdek_geo.neighborhood(lat, lon, precision), pvz_type)
+            if len(rows) >= limit:
+                distances = sorted(cdek_geo.haversine_km(lat, lon, r[0], r[1]) for r in rows)
+                if distances[limit - 1] <= cdek_geo.covered_radius_km(lat, precision):
+                    break
+        points = []
+        for r_lat, r_lon, widget_json in rows:
+            point = json.loads(widget_json)
+            point['distance_km'] = round(cdek_geo.haversine_km(lat, lon, r_lat, r_lon), 3)
+            points.append(point)
+        points.sort(key=lambda p: p['distance_km'])
+        return points[:limit]
+
+    @api.model
+    def _search_viewport_widget_points(self, south, west, north, east, limit=500, pvz_type=None):
+        """Points inside the map viewport, closest to its centre first."""
+        cells = cdek_geo.bbox_cover(south, west, north, east)
+        rows = self._fetch_widget_points_in_cells(cells, pvz_type, bbox=(south, west, north, east), limit=limit)
+        return [json.loads(widget_json) for _lat, _lon, widget_json in rows]
+
+    @api.model
+    def _compute_tile_clusters(self, x, y, zoom, pvz_type=None):
+        """Aggregate the points of one map tile on a CDEK_PVZ_CLUSTER_GRID x CDEK_PVZ_CLUSTER_GRID grid."""
+        south, west, north, east = cdek_geo.tile_bbox(x, y, zoom)
+        cell_h = (north - south) / CDEK_PVZ_CLUSTER_GRID
+        cell_w = (east - west) / CDEK_PVZ_CLUSTER_GRID
+        cells = cdek_geo.bbox_cover(south, west, north, east, max_cells=8)
+        query = """
+            SELECT count(*), avg(latitude), avg(longitude),
+                   min(latitude), min(longitude), max(latitude), max(longitude),
+                   CASE WHEN count(*) = 1 THEN min(code) END
+              FROM cdek_pvz
+             WHERE active AND (%s)
+               AND latitude >= %%s AND latitude < %%s AND longitude >= %%s AND longitude < %%s
+        """ % " OR ".join(["geohash LIKE %s"] * len(cells))
+        args = [cell + '%' for cell in cells] + [south, north, west, east]
+        if pvz_type:
+            query += " AND type = %s"
+            args.append(pvz_type)
+        query += " GROUP BY floor((latitude - %s) / %s), floor((longitude - %s) / %s)"
+        args += [south, cell_h, west, cell_w]
+        self.env.cr.execute(query, args)
+        return [{
+            'count': count,
+            'lat': lat,
+            'lon': lon,
+            'bbox': [min_lat, min_lon, max_lat, max_lon],
+            'code': code,
+        } for count, lat, lon, min_lat, min_lon, max_lat, max_lon, code in self.env.cr.fetchall()]
+
+    @api.model
+    def _get_viewport_clusters(self, south, west, north, east, zoom, pvz_type=None):
+        """
+        Pre-aggregated clusters (count, centroid, bbox) for the map viewport.
+        Tiles are cached per worker; the PVZ sync watermark is part of the key.
+        """
+        zoom = max(0, min(int(zoom), 21))
+        tiles = cdek_geo.tiles_for_bbox(south, west, north, east, zoom)
+        if len(tiles) > CDEK_PVZ_CLUSTER_MAX_TILES:
+            raise UserError(_("Map viewport is too large for zoom level %s.") % zoom)
+        watermark = self.env['ir.config_parameter'].sudo().get_param('cdek.pvz_sync_watermark', '')
+        clusters = []
+        for x, y in tiles:
+            key = (watermark, pvz_type, zoom, x, y)
+            tile_clusters = cdek_cache.cluster_cache.get(key)
+            if tile_clusters is None:
+                tile_clusters = self._compute_tile_clusters(x, y, zoom, pvz_type)
+                cdek_cache.cluster_cache.set(key, tile_clusters)
+            clusters += tile_clusters
+        return clusters
+
+    @api.model
+    def _prepare_pvz_vals(self, pvz_data):
+        """Map one CDEK /deliverypoints entry to cdek.pvz column values."""
+        location = pvz_data.get('location') or {}
+        pvz_type = (pvz_data.get('type') or 'PVZ').upper()
+        return {
+            'code': pvz_data.get('code'),
+            'name': pvz_data.get('name') or pvz_data.get('code'),
+            'city_code': location.get('city_code'),
+            'city_name': location.get('city'),
+            'country_code': location.get('country_code'),
+            'address_full': location.get('address_full') or location.get('address'),
+            'address_comment': pvz_data.get('address_comment'),
+            'work_time': pvz_data.get('work_time'),
+            'phone': ', '.join([p.get('number') for p in pvz_data.get('phones') or [] if p.get('number')]),
+            'email': pvz_data.get('email'),
+            'note': pvz_data.get('note'),
+            'type': pvz_type if pvz_type in PVZ_TYPES else 'PVZ',
+            'owner_code': pvz_data.get('owner_code'),
+            'take_only': bool(pvz_data.get('take_only')),
+            'is_dressing_room': bool(pvz_data.get('is_dressing_room')),
+            'have_cashless': bool(pvz_data.get('have_cashless')),
+            'allowed_cod': bool(pvz_data.get('allowed_cod')),
+            'longitude': location.get('longitude'),
+            'latitude': location.get('latitude'),
+            'geohash': cdek_geo.geohash_encode(location['latitude'], location['longitude'])
+                       if location.get('latitude') is not None and location.get('longitude') is not None else None,
+            'widget_json': json.dumps(self._prepare_widget_data(pvz_data), ensure_ascii=False, separators=(',', ':')),
+        }
+
+    @api.model
+    def _cdek_iter_page(self, client, country_code, page, size):
+        return client.iter_delivery_points(country_code=country_code, page=page, size=size)
+
+    @api.model
+    def _cdek_prepare_vals(self, data):
+        return self._prepare_pvz_vals(data)
+
     @api.model
     def find_or_create_pvz(self, pvz_data):
         """
-        Ищет ПВЗ по коду или создает новый.
+        Ищет ПВЗ по коду или создает новый; существующий ПВЗ обновляется.
         pvz_data - словарь с данными от API СДЭК.
         """
-        pvz = self.search([('code', '=', pvz_data.get('code'))], limit=1)
-        if not pvz:
-            # Адаптируйте ключи pvz_data под поля вашей модели
-            vals = {
-                'code': pvz_data.get('code'),
-                'name': pvz_data.get('name'),
-                'city_code': pvz_data.get('location', {}).get('city_code'),
-                'city_name': pvz_data.get('location', {}).get('city'),
-                'country_code': pvz_data.get('location', {}).get('country_code'),
-                'address_full': pvz_data.get('location', {}).get('address_full') or pvz_data.get('location', {}).get('address'),
-                'work_time': pvz_data.get('work_time'),
-                'phone': ', '.join([p.get('number') for p in pvz_data.get('phones', []) if p.get('number')]),
-                'email': pvz_data.get('email'),
-                'note': pvz_data.get('note'),
-                'type': pvz_data.get('type', 'PVZ').upper(), # У СДЭК может быть 'PVZ' или 'POSTAMAT'
-                'longitude': pvz_data.get('location', {}).get('longitude'),
-                'latitude': pvz_data.get('location', {}).get('latitude'),
-                'is_dressing_room': any(s.get('type') == 'FITTING_ROOM' for s in pvz_data.get('services', [])), # Пример
-                'have_cashless': any(s.get('type') == 'CARD' for s in pvz_data.get('services', [])), # Пример
-                'allowed_cod': pvz_data.get('cash_on_delivery'), # Проверьте точное поле в API
-                # Добавьте другие поля по необходимости
-            }
-            pvz = self.create(vals)
-        else:
-
-            pass
-        return pvz.id
\ No newline at end of file
+        vals = self._prepare_pvz_vals(pvz_data)
+        self._upsert_batch([vals])
+        return self.with_context(active_test=False).search([('code', '=', vals['code'])], limit=1).id
+
+    @api.model
+    def cron_update_cdek_pvz_list(self, auto_commit=True):
+        """
+        Scheduled action: replicate CDEK pickup points for the configured countries.
+        The start of the last successful run is stored in 'cdek.pvz_sync_watermark'.
+        """
+        self._cdek_run_sync('cdek.pvz_sync_watermark', auto_commit=auto_commit)
+        cdek_cache.cluster_cache.clear()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import timedelta
+
+from odoo import _, api, fields, models
+
+from ..const import (
+    CDEK_SHIPMENT_BATCH_SIZE, CDEK_SHIPMENT_WORKERS, CDEK_SHIPMENT_MAX_ATTEMPTS, CDEK_SHIPMENT_RETRY_BASE_SECONDS,
+    CDEK_SHIPMENT_STALE_MINUTES,
+)
+from ..services import cdek_async_request
+
+_logger = logging.getLogger(__name__)
+
+
+class CdekShipmentJob(models.Model):
+    """Outbound queue of CDEK order registrations, one job per picking, processed by a cron."""
+    _name = 'cdek.shipment.job'
+    _description = 'CDEK Shipment Registration Job'
+    _order = 'id desc'
+
+    name = fields.Char(string='Order Number', required=True, readonly=True,
+                       help="Picking reference sent to CDEK as the order number; one job per reference.")
+    picking_id = fields.Many2one('stock.picking', string='Transfer', required=True, index=True,
+                                 ondelete='cascade', readonly=True)
+    carrier_id = fields.Many2one('delivery.carrier', string='Carrier', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('in_progress', 'Sending'),
+        ('done', 'Registered'),
+        ('failed', 'Failed'),
+    ], default='pending', required=True, readonly=True, index=True)
+    attempts = fields.Integer(readonly=True)
+    next_attempt_at = fields.Datetime(string='Next Attempt', readonly=True, default=fields.Datetime.now)
+    last_error = fields.Text(readonly=True)
+    order_uuid = fields.Char(string='CDEK Order UUID', readonly=True)
+
+    _sql_constraints = [
+        ('name_uniq', 'unique (name)', 'A picking can only be queued once for CDEK registration!')
+    ]
+
+    @api.model
+    def _enqueue(self, pickings):
+        """Queue the pickings for registration; pickings already queued are left alone, failed ones are retried."""
+        jobs = self.search([('name', 'in', pickings.mapped('name'))])
+        jobs.filtered(lambda j: j.state == 'failed').write({
+            'state': 'pending', 'attempts': 0, 'next_attempt_at': fields.Datetime.now(), 'last_error': False,
+        })
+        queued = set(jobs.mapped('name'))
+        jobs |= self.create([
+            {'name': picking.name, 'picking_id': picking.id, 'carrier_id': picking.carrier_id.id}
+            for picking in pickings if picking.name not in queued
+        ])
+        cron = self.env.ref('cdek_odooAPI2.ir_cron_process_cdek_shipments', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return jobs
+
+    def _submit(self, client, payloads):
+        """
+        POST the prepared payloads concurrently from a bounded pool of threads; the ORM is not touched meanwhile.
+        Jobs that were attempted before are looked up at CDEK by order number first.
+        :param payloads: dict job -> order payload
+        :return: dict job -> (response, exception)
+        """
+        async def submit(cdek, payload, lookup_first):
+            try:
+                return await cdek.create_order_idempotent(payload, lookup_first=lookup_first), None
+            except Exception as e:
+                return None, e
+
+        async def submit_all(cdek):
+            return await cdek_async_request.gather_bounded(
+                [submit(cdek, payload, job.attempts > 0) for job, payload in payloads.items()],
+                CDEK_SHIPMENT_WORKERS)
+
+        if not payloads:
+            return {}
+        client._get_token()
+        return dict(zip(payloads, cdek_async_request.run_sync(client, submit_all)))
+
+    def _mark_done(self, order_uuid, package_count=0):
+        self.ensure_one()
+        picking = self.picking_id
+        self.write({'state': 'done', 'order_uuid': order_uuid, 'last_error': False})
+        picking.write({
+            'carrier_tracking_ref': order_uuid, 'cdek_order_uuid': order_uuid, 'cdek_package_count': package_count,
+        })
+        if picking.sale_id:
+            picking.sale_id.cdek_order_uuid = order_uuid
+        picking.message_post(body=_("Successfully registered with CDEK. Order UUID: %s") % order_uuid)
+
+    def _mark_failed(self, error, retry=True):
+        """Schedule another attempt with exponential backoff, or give up and report on the picking."""
+        self.ensure_one()
+        attempts = self.attempts + 1
+        if retry and attempts < CDEK_SHIPMENT_MAX_ATTEMPTS:
+            self.write({
+                'state': 'pending',
+                'attempts': attempts,
+                'last_error': error,
+                'next_attempt_at': fields.Datetime.now() + timedelta(
+                    seconds=CDEK_SHIPMENT_RETRY_BASE_SECONDS * 2 ** (attempts - 1)),
+            })
+            return
+        self.write({'state': 'failed', 'attempts': attempts, 'last_error': error})
+        self.picking_id.message_post(body=error)
+
+    def _process(self, auto_commit=False):
+        """
+        Build, submit and record one batch of jobs.
+        The jobs are marked in progress (and committed) before the call, so a worker dying mid-call leaves
+        a trace that :meth:`_reconcile_stale` resolves by order number instead of registering twice.
+        """
+        payloads = {}
+        for job in self:
+            picking = job.picking_id
+            if picking.cdek_order_uuid:
+                job.write({'state': 'done', 'order_uuid': picking.cdek_order_uuid})
+                continue
+            try:
+                payloads[job] = job.carrier_id._build_order_payload(picking)
+            except Exception as e:
+                # Payload errors are data errors (missing phone, address...): retrying will not help
+                job._mark_failed(_("CDEK: cannot prepare order for picking %s: %s") % (picking.name, e), retry=False)
+
+        if not payloads:
+            return
+        self.browse([job.id for job in payloads]).write({'state': 'in_progress'})
+        if auto_commit:
+            self.env.cr.commit()
+        client = self.env['res.config.settings']._get_cdek_client()
+        for job, (response, error) in self._submit(client, payloads).items():
+            if error:
+                _logger.warning("CDEK: registration of %s failed (attempt %s): %s", job.name, job.attempts + 1, error)
+                job._mark_failed(_("CDEK API Error for Picking %s: %s") % (job.name, error))
+                continue
+            order_uuid = job.carrier_id._cdek_extract_order_uuid(response)
+            if order_uuid:
+                job._mark_done(order_uuid, len(payloads[job].get('packages') or []))
+            else:
+                job._mark_failed(_("CDEK: Failed to register order %s. Details: %s") % (
+                    job.name, job.carrier_id._cdek_order_errors(response)), retry=False)
+
+    @api.model
+    def _reconcile_stale(self):
+        """
+        Hand jobs stuck in progress (crashed worker) back to the queue as retries:
+        their next attempt looks the order up at CDEK by number before sending anything.
+        """
+        stale = self.search([
+            ('state', '=', 'in_progress'),
+            ('write_date', '<', fields.Datetime.now() - timedelta(minutes=CDEK_SHIPMENT_STALE_MINUTES)),
+        ])
+        for job in stale:
+            _logger.warning("CDEK: registration of %s was interrupted, reconciling by order number", job.name)
+            job.write({
+                'state': 'pending',
+                'attempts': job.attempts + 1,
+                'next_attempt_at': fields.Datetime.now(),
+                'last_error': _("Interrupted while sending to CDEK; checked by order number before retrying."),
+            })
+        return stale
+
+    @api.model
+    def cron_process_cdek_shipment_jobs(self, auto_commit=True):
+        """Scheduled action: register due jobs batch by batch with bounded concurrency."""
+        self._reconcile_stale()
+        processed = 0
+        while True:
+            jobs = self.search([
+                ('state', '=', 'pending'),
+                ('next_attempt_at', '<=', fields.Datetime.now()),
+            ], order='next_attempt_at, id', limit=CDEK_SHIPMENT_BATCH_SIZE)
+            if not jobs:
+                break
+            jobs._process(auto_commit=auto_commit)
+            processed += len(jobs)
+            if auto_commit:
+                self.env.cr.commit()
+            if len(jobs) < CDEK_SHIPMENT_BATCH_SIZE:
+                break
+        if processed:
+            _logger.info("CDEK shipment queue: %s jobs processed", processed)
+        return processed
+
+    def action_retry(self):
+        failed = self.filtered(lambda j: j.state == 'failed')
+        failed._enqueue(failed.picking_id)
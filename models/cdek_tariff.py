@@ -1,5 +1,16 @@
 # -*- coding: utf-8 -*-
+import json
+import logging
+
+import psycopg2
+
 from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+
+from ..const import CDEK_TARIFF_PROBE_PACKAGE
+from ..services import cdek_rate_limiter
+
+_logger = logging.getLogger(__name__)
 
 class CdekTariff(models.Model):
     _name = 'cdek.tariff'
@@ -48,7 +59,7 @@ class CdekTariff(models.Model):
 
         vals = {
             'code': cdek_tariff_data.get('tariff_code'), # Ensure key matches API
-            'name': cdek_tariff_data.get('tariff_name'),
+            'name': cdek_tariff_data.get('tariff_name') or str(cdek_tariff_data.get('tariff_code')),
             'description': cdek_tariff_data.get('tariff_description'),
             'delivery_mode_code': cdek_tariff_data.get('delivery_mode'), # delivery_mode is on order, not tariff list
             'active': True,
@@ -56,36 +67,68 @@ class CdekTariff(models.Model):
         }
         return vals
 
+    @api.model
+    def _process_api_tariffs(self, cdek_tariffs):
+        """
+        Create missing tariffs and refresh changed ones from a calculator/tarifflist answer.
+        :param cdek_tariffs: list of 'tariff_codes' entries returned by CDEK
+        :return: cdek.tariff recordset of the tariffs seen
+        """
+        by_code = {t['tariff_code']: t for t in cdek_tariffs or [] if t.get('tariff_code')}
+        if not by_code:
+            return self.browse()
+        existing = self.with_context(active_test=False).search([
+            ('code', 'in', list(by_code)), ('company_id', '=', self.env.company.id),
+        ])
+        for tariff in existing:
+            data = by_code[tariff.code]
+            if tariff.name != data.get('tariff_name') or tariff.delivery_mode_code != data.get('delivery_mode') \
+                    or not tariff.active:
+                tariff.write(self._format_tariff_data_from_cdek(data))
+
+        missing = [by_code[code] for code in set(by_code) - set(existing.mapped('code'))]
+        created = self.browse()
+        if missing:
+            try:
+                # Concurrent checkouts may discover the same tariff; losing the race is harmless.
+                with self.env.cr.savepoint():
+                    created = self.create([self._format_tariff_data_from_cdek(data) for data in missing])
+            except psycopg2.IntegrityError:
+                _logger.info("CDEK: tariffs %s were created concurrently", [d['tariff_code'] for d in missing])
+        return existing | created
+
     @api.model
     def cron_update_cdek_tariffs(self):
         """
         Scheduled action to update the list of CDEK Tariffs.
-        NOTE: CDEK API v2 does not have a simple public endpoint to list all available tariffs like /deliverypoints.
-        Tariff codes are generally documented or known. This method is a placeholder
-        or could be adapted if a partner-specific tariff listing API is available.
+        CDEK API v2 has no endpoint listing the tariffs; calculator/tarifflist from each CDEK carrier's
+        sender location to itself answers with the tariffs available there. Checkout ratings only read
+        CDEK, so this is the one place tariffs are written.
         """
-        _logger.info("CRON: Starting CDEK Tariff list update (Placeholder - No direct CDEK API for this).")
-        # client = self.env['res.config.settings']._get_cdek_client()
-        # if not client:
-        #     _logger.error("CRON: CDEK Tariff update failed. Client could not be initialized.")
-        #     return
-        #
-        # try:
-        #     # Hypothetical call: cdek_tariffs_data = client.get_available_tariffs()
-        #     # For now, this would likely involve updating from a predefined list or manual entries.
-        #     # Example:
-        #     # predefined_tariffs = [
-        #     #    {'tariff_code': 136, 'tariff_name': 'Посылка склад-дверь', ...},
-        #     #    {'tariff_code': 233, 'tariff_name': 'Экономичная посылка склад-склад', ...}
-        #     # ]
-        #     # for tariff_data in predefined_tariffs:
-        #     #     vals = self._format_tariff_data_from_cdek(tariff_data)
-        #     #     # ... create or update logic ...
-        #
-        #     _logger.info("CRON: CDEK Tariff list update finished (Manual/Placeholder).")
-        #
-        # except UserError as e:
-        #     _logger.error("CRON: UserError during CDEK Tariff update: %s", e)
-        # except Exception as e:
-        #     _logger.error("CRON: Exception during CDEK Tariff update: %s", e, exc_info=True)
-        pass
\ No newline at end of file
+        client = self.env['res.config.settings']._get_cdek_client()
+        probed = set()
+        for carrier in self.env['delivery.carrier'].sudo().search([('delivery_type', '=', 'cdek')]):
+            company = carrier.company_id or self.env.company
+            try:
+                origin = carrier.with_company(company)._cdek_prepare_origin_location(company.partner_id)
+            except UserError as e:
+                _logger.warning("CRON: cannot list CDEK tariffs for carrier %s: %s", carrier.name, e)
+                continue
+            payload = {
+                'type': int(carrier.cdek_order_type),
+                'from_location': origin,
+                'to_location': origin,
+                'packages': [dict(CDEK_TARIFF_PROBE_PACKAGE)],
+            }
+            key = (company.id, json.dumps(payload, sort_keys=True))
+            if key in probed:
+                continue
+            probed.add(key)
+            try:
+                with cdek_rate_limiter.priority('background'):
+                    response = client.calculate_tariff_list(payload)
+            except UserError as e:
+                _logger.warning("CRON: CDEK tariff list failed for carrier %s: %s", carrier.name, e)
+                continue
+            tariffs = self.with_company(company)._process_api_tariffs((response or {}).get('tariff_codes'))
+            _logger.info("CRON: %s CDEK tariffs available for %s", len(tariffs), company.name)
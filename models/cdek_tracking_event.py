@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models
+from odoo.tools import SQL
+
+
+class CdekTrackingEvent(models.Model):
+    """One CDEK order status, stored once. Rows are only ever inserted."""
+    _name = 'cdek.tracking.event'
+    _description = 'CDEK Tracking Event'
+    _order = 'date_time desc, id desc'
+    _rec_name = 'code'
+
+    picking_id = fields.Many2one('stock.picking', string='Transfer', index=True, ondelete='cascade', readonly=True)
+    order_uuid = fields.Char(string='CDEK Order UUID', required=True, readonly=True)
+    code = fields.Char(string='Status Code', required=True, readonly=True)
+    name = fields.Char(string='Status', readonly=True)
+    date_time = fields.Datetime(string='Status Date', required=True, readonly=True)
+    city = fields.Char(string='City', readonly=True)
+    source = fields.Selection([
+        ('poll', 'Polling'),
+        ('webhook', 'Webhook'),
+    ], readonly=True)
+
+    _sql_constraints = [
+        ('event_uniq', 'unique (order_uuid, code, date_time)', 'A CDEK status is recorded only once per order!')
+    ]
+
+    @api.model
+    def _insert_events(self, vals_list):
+        """
+        Insert events with INSERT ... ON CONFLICT DO NOTHING; already known statuses are dropped by the database.
+        :param vals_list: dicts with picking_id, order_uuid, code, name, date_time, city, source
+        :return: recordset of the events that were actually new
+        """
+        columns = ['picking_id', 'order_uuid', 'code', 'name', 'date_time', 'city', 'source']
+        vals_list = [vals for vals in vals_list if vals.get('order_uuid') and vals.get('code') and vals.get('date_time')]
+        if not vals_list:
+            return self.browse()
+        now = fields.Datetime.now()
+        uid = self.env.uid
+        query = SQL(
+            """
+            INSERT INTO cdek_tracking_event (%(columns)s, create_uid, create_date, write_uid, write_date)
+            VALUES %(rows)s
+            ON CONFLICT (order_uuid, code, date_time) DO NOTHING
+            RETURNING id
+            """,
+            columns=SQL(', ').join(SQL.identifier(col) for col in columns),
+            rows=SQL(', ').join(
+                SQL('%s', tuple([vals.get(col) for col in columns] + [uid, now, uid, now])) for vals in vals_list
+            ),
+        )
+        self.env.flush_all()
+        self.env.cr.execute(query)
+        new_events = self.browse([row[0] for row in self.env.cr.fetchall()])
+        self.invalidate_model()
+        new_events.picking_id.invalidate_recordset(['cdek_tracking_event_ids'])
+        return new_events
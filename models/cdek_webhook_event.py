@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from ..const import CDEK_WEBHOOK_BATCH_SIZE, CDEK_WEBHOOK_RETENTION_DAYS
+
+_logger = logging.getLogger(__name__)
+
+
+class CdekWebhookEvent(models.Model):
+    """Inbox of CDEK webhook callbacks: stored as received, applied in batches by a cron."""
+    _name = 'cdek.webhook.event'
+    _description = 'CDEK Webhook Event'
+    _order = 'id desc'
+    _rec_name = 'uuid'
+
+    event_type = fields.Selection([
+        ('ORDER_STATUS', 'Order Status'),
+        ('PRINT_FORM', 'Print Form'),
+    ], string='Type', required=True, readonly=True)
+    uuid = fields.Char(string='Entity UUID', readonly=True, index=True,
+                       help="CDEK order UUID for status events, print task UUID for print forms.")
+    status_code = fields.Char(string='Status Code', readonly=True)
+    status_datetime = fields.Datetime(string='Status Date', readonly=True)
+    city_name = fields.Char(string='City', readonly=True)
+    url = fields.Char(string='Print Form URL', readonly=True)
+    payload = fields.Text(string='Payload', readonly=True)
+    state = fields.Selection([
+        ('new', 'New'),
+        ('done', 'Processed'),
+        ('ignored', 'Ignored'),
+    ], default='new', required=True, readonly=True, index=True)
+
+    @api.model
+    def _prepare_event_vals(self, payload):
+        """Map a CDEK callback body onto inbox values; None when the body is not a CDEK event."""
+        if not isinstance(payload, dict) or payload.get('type') not in dict(self._fields['event_type'].selection):
+            return None
+        attributes = payload.get('attributes') or {}
+        picking_model = self.env['stock.picking']
+        return {
+            'event_type': payload['type'],
+            'uuid': payload.get('uuid'),
+            'status_code': attributes.get('code'),
+            'status_datetime': picking_model._cdek_parse_datetime(
+                attributes.get('status_date_time') or payload.get('date_time')),
+            'city_name': attributes.get('city_name'),
+            'url': attributes.get('url'),
+            'payload': json.dumps(payload, ensure_ascii=False),
+        }
+
+    def _apply_order_status_events(self):
+        """Record the statuses as tracking events of the matching pickings; duplicates of polled statuses are dropped."""
+        uuids = list({event.uuid for event in self if event.uuid and event.status_code})
+        if not uuids:
+            return
+        pickings = self.env['stock.picking'].search([
+            '|', ('cdek_order_uuid', 'in', uuids), ('carrier_tracking_ref', 'in', uuids),
+        ])
+        picking_by_uuid = {}
+        for picking in pickings:
+            picking_by_uuid.setdefault(picking.cdek_order_uuid or picking.carrier_tracking_ref, picking)
+            picking_by_uuid.setdefault(picking.carrier_tracking_ref or picking.cdek_order_uuid, picking)
+        updated = pickings._cdek_record_tracking_events([
+            {
+                'picking_id': picking_by_uuid[event.uuid].id,
+                'order_uuid': event.uuid,
+                'code': event.status_code,
+                'date_time': event.status_datetime,
+                'city': event.city_name,
+                'source': 'webhook',
+            }
+            for event in self if event.uuid in picking_by_uuid and event.status_code
+        ])
+        updated._cdek_schedule_next_check(pickings._cdek_tracking_base_interval() or 60)
+        pickings.flush_recordset()
+
+    @api.model
+    def _process_pending(self, limit=CDEK_WEBHOOK_BATCH_SIZE):
+        """Apply one batch of received events. :return: number of events processed"""
+        events = self.search([('state', '=', 'new')], order='id', limit=limit)
+        status_events = events.filtered(lambda e: e.event_type == 'ORDER_STATUS')
+        status_events._apply_order_status_events()
+        status_events.write({'state': 'done'})
+        # Print forms are downloaded on demand from the picking; the callback is kept for reference only
+        (events - status_events).write({'state': 'ignored'})
+        return len(events)
+
+    @api.model
+    def cron_process_cdek_webhook_events(self, auto_commit=True):
+        """Scheduled action: drain the webhook inbox batch by batch."""
+        processed = 0
+        while True:
+            count = self._process_pending()
+            processed += count
+            if auto_commit:
+                self.env.cr.commit()
+            if count < CDEK_WEBHOOK_BATCH_SIZE:
+                break
+        if processed:
+            _logger.info("CDEK webhooks: %s events processed", processed)
+        return processed
+
+    @api.autovacuum
+    def _gc_processed_events(self):
+        limit_date = fields.Datetime.now() - timedelta(days=CDEK_WEBHOOK_RETENTION_DAYS)
+        self.search([('state', '!=', 'new'), ('create_date', '<', limit_date)]).unlink()
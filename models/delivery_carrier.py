@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import base64
+import math
 import re
 import logging
 from unidecode import unidecode
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, ValidationError
 from datetime import datetime, date # Добавлен date
-from ..const import CDEK_ORDER_TYPE_IM, CDEK_LABEL_FORMATS, DEFAULT_LENGTH_CM, DEFAULT_WIDTH_CM, DEFAULT_HEIGHT_CM, DEFAULT_WEIGHT_KG
+from ..const import CDEK_ORDER_TYPE_IM, CDEK_LABEL_FORMATS, DEFAULT_LENGTH_CM, DEFAULT_WIDTH_CM, DEFAULT_HEIGHT_CM, DEFAULT_WEIGHT_KG, \
+    CDEK_RATE_CACHE_TTL_SECONDS, CDEK_MAX_PACKAGE_WEIGHT_KG
+from ..services import cdek_cache, cdek_packing, cdek_rate_limiter
+from ..services.cdek_resilience import CdekUnavailable
 
 _logger = logging.getLogger(__name__)
 
@@ -160,77 +164,227 @@ class DeliveryCarrier(models.Model):
         
         return location_data
 
-    def _cdek_prepare_packages_payload(self, picking_or_order, order_for_cod_ref=None):
-        self.ensure_one()
+    @api.model
+    def _cdek_package_defaults(self):
+        """Default package size and unit weight from the settings, read once per payload."""
         params = self.env['ir.config_parameter'].sudo()
-        packages_payload = []
-        
-        is_order = picking_or_order._name == 'sale.order'
-        record = picking_or_order
-        
-        # Используем переданный order_for_cod_ref или получаем его
-        actual_order_for_cod = order_for_cod_ref if order_for_cod_ref else (record if is_order else record.sale_id)
-
-        default_length = int(round(float(params.get_param('cdek.default_length_cm', DEFAULT_LENGTH_CM))))
-        default_width  = int(round(float(params.get_param('cdek.default_width_cm', DEFAULT_WIDTH_CM))))
-        default_height = int(round(float(params.get_param('cdek.default_height_cm', DEFAULT_HEIGHT_CM))))
-        default_weight_one_item_kg = float(params.get_param('cdek.default_weight_kg', DEFAULT_WEIGHT_KG))
+        return {
+            'length': int(round(float(params.get_param('cdek.default_length_cm', DEFAULT_LENGTH_CM)))),
+            'width': int(round(float(params.get_param('cdek.default_width_cm', DEFAULT_WIDTH_CM)))),
+            'height': int(round(float(params.get_param('cdek.default_height_cm', DEFAULT_HEIGHT_CM)))),
+            'weight_g': max(10, int(round(float(params.get_param('cdek.default_weight_kg', DEFAULT_WEIGHT_KG)) * 1000))),
+        }
 
-        items_for_package = []
-        total_package_weight_grams = 0
+    @api.model
+    def _cdek_shippable_lines(self, record, price_order=None):
+        """
+        Flatten a sale order or picking into (product, quantity, unit price) tuples in one pass.
+        Picking prices come from ``price_order`` through a product -> sale line index,
+        falling back to the product's precomputed declared value.
+        """
+        if record._name == 'sale.order':
+            return [
+                (line.product_id, int(line.product_uom_qty), line.price_unit * (1 - (line.discount or 0.0) / 100.0))
+                for line in record.order_line
+                if not line.display_type and line.product_id.type in ('product', 'consu') and line.product_uom_qty > 0
+            ]
+        sale_line_by_product = {}
+        for sale_line in (price_order.order_line if price_order else []):
+            sale_line_by_product.setdefault(sale_line.product_id.id, sale_line)
+        lines = []
+        for move in record.move_ids:
+            product = move.product_id
+            qty = int(move.quantity or move.product_uom_qty)
+            if product.type not in ('product', 'consu') or qty <= 0:
+                continue
+            sale_line = sale_line_by_product.get(product.id)
+            price = sale_line.price_unit * (1 - (sale_line.discount or 0.0) / 100.0) if sale_line \
+                else product.cdek_declared_value
+            lines.append((product, qty, price))
+        return lines
+
+    @api.model
+    def _cdek_packing_boxes(self):
+        """Box catalogue of the packing engine: package types flagged for CDEK, sizes in cm and grams."""
+        package_types = self.env['stock.package.type'].sudo().search([('cdek_packing_box', '=', True)])
+        return [self._cdek_package_type_box(package_type) for package_type in package_types]
+
+    @api.model
+    def _cdek_package_type_box(self, package_type):
+        """A stock.package.type as a packing Box, its dimensions converted from the product length unit."""
+        product_tmpl = self.env['product.template']
+        length_uom = product_tmpl._get_length_uom_id_from_ir_config_parameter()
+        weight_uom = product_tmpl._get_weight_uom_id_from_ir_config_parameter()
+        cm = self.env.ref('uom.product_uom_cm')
+        gram = self.env.ref('uom.product_uom_gram')
+
+        def to_cm(value):
+            return int(math.ceil(length_uom._compute_quantity(value or 0.0, cm, round=False)))
+
+        return cdek_packing.Box(
+            package_type.name,
+            to_cm(package_type.packaging_length), to_cm(package_type.width), to_cm(package_type.height),
+            int(weight_uom._compute_quantity(package_type.max_weight or 0.0, gram, round=False)),
+        )
+
+    @api.model
+    def _cdek_pack(self, pack_lines, defaults):
+        """Run the packing engine, cached per line signature, box catalogue and weight limit."""
+        boxes = self._cdek_packing_boxes()
+        max_weight_g = int(float(self.env['ir.config_parameter'].sudo().get_param(
+            'cdek.max_package_weight_kg', CDEK_MAX_PACKAGE_WEIGHT_KG)) * 1000)
+        default_box = cdek_packing.Box(None, defaults['length'], defaults['width'], defaults['height'], 0)
+        key = cdek_cache.payload_key(pack_lines, boxes, max_weight_g, default_box)
+        parcels = cdek_cache.packing_cache.get(key)
+        if parcels is None:
+            parcels = cdek_packing.pack_lines(pack_lines, boxes, max_weight_g, default_box)
+            cdek_cache.packing_cache.set(key, parcels)
+        return parcels
+
+    def _cdek_prepacked_parcels(self, picking):
+        """
+        Parcels already packed in the warehouse: one per destination package of the picking.
+        :return: (list of {'box', 'weight_g', 'items': {product id: qty}}, {product id: packed qty})
+        """
+        weight_uom = self.env['product.template']._get_weight_uom_id_from_ir_config_parameter()
+        gram = self.env.ref('uom.product_uom_gram')
+        defaults = self._cdek_package_defaults()
+        parcels = []
+        packed_qty = {}
+        move_lines = picking.move_line_ids.filtered('result_package_id')
+        for package in move_lines.result_package_id:
+            items = {}
+            weight_g = 0
+            for move_line in move_lines.filtered(lambda ml: ml.result_package_id == package):
+                product = move_line.product_id
+                qty = int(move_line.quantity)
+                if qty <= 0:
+                    continue
+                items[product.id] = items.get(product.id, 0) + qty
+                packed_qty[product.id] = packed_qty.get(product.id, 0) + qty
+                weight_g += (product.cdek_weight_g or defaults['weight_g']) * qty
+            if not items:
+                continue
+            if package.shipping_weight:
+                weight_g = int(weight_uom._compute_quantity(package.shipping_weight, gram, round=False))
+            if package.package_type_id and package.package_type_id.packaging_length:
+                box = self._cdek_package_type_box(package.package_type_id)
+            else:
+                box = cdek_packing.Box(None, defaults['length'], defaults['width'], defaults['height'], 0)
+            parcels.append({'box': box, 'weight_g': weight_g, 'items': items})
+        return parcels, packed_qty
 
-        lines_to_process = record.order_line.filtered(lambda l: not l.display_type and l.product_id.type in ['product', 'consu']) if is_order \
-            else record.move_line_ids.filtered(lambda ml: ml.product_id.type in ['product', 'consu'] and (ml.qty_done > 0 or ml.product_uom_qty > 0))
+    def _cdek_prepare_packages_payload(self, picking_or_order, order_for_cod_ref=None):
+        """
+        Split the goods into CDEK packages: packages already packed on the picking are kept as they are,
+        the rest goes through the packing engine against the box catalogue and the parcel weight limit.
+        """
+        self.ensure_one()
+        record = picking_or_order
+        is_order = record._name == 'sale.order'
+        actual_order_for_cod = order_for_cod_ref or (record if is_order else record.sale_id)
+        defaults = self._cdek_package_defaults()
 
-        if not lines_to_process:
+        lines = self._cdek_shippable_lines(record, price_order=actual_order_for_cod)
+        if not lines:
             _logger.warning("CDEK: No product lines in %s %s. Using default item.", record._name, record.name)
-            item_weight_g = max(10, int(round(default_weight_one_item_kg * 1000)))
-            items_for_package.append({
-                "name": _("Default Goods"), "ware_key": "DEFAULT_ITEM_SKU", "cost": 0.01, # Минимальная стоимость
-                "weight": item_weight_g, "amount": 1,
-            })
-            total_package_weight_grams = item_weight_g
-        else:
-            for line in lines_to_process:
-                product = line.product_id
-                qty = int(line.product_uom_qty if is_order else (line.qty_done or line.product_uom_qty))
-                if qty <= 0: continue
-
-                item_weight_grams = max(10, int(round((product.weight or default_weight_one_item_kg) * 1000)))
-                total_package_weight_grams += item_weight_grams * qty
-                
-                cost_per_unit = 0.01 
-                if is_order:
-                    cost_per_unit = line.price_unit * (1 - (line.discount or 0.0) / 100.0)
-                elif actual_order_for_cod: # picking
-                    so_line = actual_order_for_cod.order_line.filtered(lambda sol: sol.product_id == product)[:1]
-                    if so_line: cost_per_unit = so_line.price_unit * (1-(so_line.discount or 0.0)/100.0)
-                    else: cost_per_unit = product.list_price
-                cost_per_unit = max(0.01, round(cost_per_unit, 2))
-
-
+            return [{
+                "number": "1", "weight": defaults['weight_g'],
+                "length": defaults['length'], "width": defaults['width'], "height": defaults['height'],
+                "items": [{
+                    "name": _("Default Goods"), "ware_key": "DEFAULT_ITEM_SKU", "cost": 0.01,  # Минимальная стоимость
+                    "weight": defaults['weight_g'], "amount": 1,
+                }],
+            }]
+
+        parcels, packed_qty = [], {}
+        if not is_order:
+            parcels, packed_qty = self._cdek_prepacked_parcels(record)
+
+        # Pre-packed parcels reference products; map them back onto the first matching line
+        line_index_by_product = {}
+        pack_lines = []
+        for index, (product, qty, price) in enumerate(lines):
+            line_index_by_product.setdefault(product.id, index)
+            packed = min(qty, packed_qty.get(product.id, 0))
+            if packed:
+                packed_qty[product.id] -= packed
+            if qty - packed > 0:
+                pack_lines.append(cdek_packing.PackLine(
+                    index, qty - packed, product.cdek_weight_g or defaults['weight_g'],
+                    product.cdek_length_cm, product.cdek_width_cm, product.cdek_height_cm,
+                ))
+        for parcel in parcels:
+            parcel['items'] = {
+                line_index_by_product[product_id]: qty
+                for product_id, qty in parcel['items'].items() if product_id in line_index_by_product
+            }
+        if pack_lines:
+            parcels = parcels + self._cdek_pack(pack_lines, defaults)
+
+        with_cod = bool(self.cdek_allow_cod and actual_order_for_cod)
+        packages = []
+        for parcel in parcels:
+            if not parcel['items']:
+                continue
+            box = parcel['box']
+            items_for_package = []
+            for index, qty in parcel['items'].items():
+                product, _qty, price = lines[index]
+                cost_per_unit = max(0.01, round(price, 2))
                 item_payload = {
                     "name": product.name[:255],
-                    "ware_key": product.default_code or f"SKU_{product.id}",
+                    "ware_key": product.cdek_ware_key,
                     "cost": cost_per_unit,
-                    "weight": item_weight_grams,
+                    "weight": product.cdek_weight_g or defaults['weight_g'],
                     "amount": qty,
-                    # "vat_rate": product.supplier_taxes_id[:1].amount_type == 'percent' and int(product.supplier_taxes_id[:1].amount) or 0 # Пример НДС
                 }
-                if self.cdek_allow_cod and actual_order_for_cod:
-                    payment_value_for_item = cost_per_unit
-                    item_payload["payment"] = {"value": payment_value_for_item}
+                if with_cod:
+                    item_payload["payment"] = {"value": cost_per_unit}
                 items_for_package.append(item_payload)
+            packages.append({
+                "number": str(len(packages) + 1), "weight": max(10, parcel['weight_g']),
+                "length": box.length or defaults['length'],
+                "width": box.width or defaults['width'],
+                "height": box.height or defaults['height'],
+                "items": items_for_package,
+            })
+        return packages
 
-        if not items_for_package: raise UserError(_("CDEK: No items for package in %s %s.") % (record._name, record.name))
-        if total_package_weight_grams <= 0: total_package_weight_grams = 10 # Минимальный вес
+    def _cdek_prepare_pvz_location(self, pvz):
+        """Calculator location of a pickup point: its CDEK city code, or its address."""
+        if pvz.city_code:
+            return {'code': pvz.city_code}
+        return {'country_code': pvz.country_code or 'RU', 'city': pvz.city_name, 'address': pvz.address_full}
 
-        packages_payload.append({
-            "number": "1", "weight": total_package_weight_grams,
-            "length": default_length, "width": default_width, "height": default_height,
-            "items": items_for_package,
-        })
-        return packages_payload
+    def _cdek_prepare_origin_location(self, sender_partner):
+        """Calculator ``from_location`` of this carrier: its shipment point, or the sender's address."""
+        self.ensure_one()
+        if self.cdek_shipment_point_code:
+            pvz_sender = self.env['cdek.pvz'].sudo().search([('code', '=', self.cdek_shipment_point_code)], limit=1)
+            if not pvz_sender:
+                raise UserError(_("Sender PVZ with code %s not found.") % self.cdek_shipment_point_code)
+            return self._cdek_prepare_pvz_location(pvz_sender) # Используем адрес ПВЗ как адрес
+        return self._cdek_prepare_location_info(sender_partner)
+
+    def _cdek_prepare_rate_payload(self, order):
+        """Build the calculator payload of this carrier for ``order`` (raises UserError)."""
+        self.ensure_one()
+        from_location_payload = self._cdek_prepare_origin_location(
+            order.warehouse_id.partner_id or self.env.company.partner_id)
+
+        if order.cdek_pvz_id:
+            to_location_payload = self._cdek_prepare_pvz_location(order.cdek_pvz_id) # Используем адрес ПВЗ как адрес
+        else:
+            to_location_payload = self._cdek_prepare_location_info(order.partner_shipping_id)
+
+        return {
+            'type': int(self.cdek_order_type),
+            'tariff_code': self.cdek_tariff_code,
+            'from_location': from_location_payload,
+            'to_location': to_location_payload,
+            'packages': self._cdek_prepare_packages_payload(order),
+        }
 
     # --- Методы API Odoo для способов доставки ---
     def cdek_rate_shipment(self, order):
@@ -240,57 +394,20 @@ class DeliveryCarrier(models.Model):
         if self.cdek_free_shipping_threshold > 0 and order.amount_untaxed >= self.cdek_free_shipping_threshold:
             return {'success': True, 'price': 0.0, 'error_message': False, 'warning_message': _("Free shipping by CDEK threshold")}
 
-
-        sender_partner = order.warehouse_id.partner_id or self.env.company.partner_id
-        from_location_payload = {}
-        if self.cdek_shipment_point_code : 
-             from_location_payload = {'code': int(self.cdek_shipment_point_code)} 
-        else: 
-            try: from_location_payload = self._cdek_prepare_location_info(sender_partner)
-            except UserError as e: return self._rate_error(str(e))
-
-
-        recipient_partner = order.partner_shipping_id
-        to_location_payload = {}
-        if order.cdek_pvz_id and order.cdek_pvz_id.code: 
-            to_location_payload = self._cdek_prepare_location_info(None, is_pvz_delivery_point=True, pvz_code=order.cdek_pvz_id.code)
-        else:
-            try: to_location_payload = self._cdek_prepare_location_info(recipient_partner)
-            except UserError as e: return self._rate_error(str(e))
-
-        try: packages_payload = self._cdek_prepare_packages_payload(order)
+        try: calc_payload = self._cdek_prepare_rate_payload(order)
         except UserError as e: return self._rate_error(str(e))
 
-        currency_code = order.currency_id.name if order.currency_id else 'RUB'
-
-
-        calc_payload = {
-            'type': int(self.cdek_order_type),
-            'tariff_code': self.cdek_tariff_code,
-            'from_location': from_location_payload, # Будет использоваться, если cdek_shipment_point_code не задан
-            'to_location': to_location_payload,     # Будет использоваться, если cdek_pvz_id не задан
-            'packages': packages_payload,
-        }
-
-        if self.cdek_shipment_point_code:
-             pvz_sender = self.env['cdek.pvz'].sudo().search([('code', '=', self.cdek_shipment_point_code)], limit=1)
-             if pvz_sender: calc_payload['from_location'] = self._cdek_prepare_location_info(pvz_sender, is_sender=True) # Используем адрес ПВЗ как адрес
-             else: return self._rate_error(_("Sender PVZ with code %s not found.") % self.cdek_shipment_point_code)
-        
-        if order.cdek_pvz_id:
-             calc_payload['to_location'] = self._cdek_prepare_location_info(order.cdek_pvz_id) # Используем адрес ПВЗ как адрес
-
-
+        estimate = False
         try:
-            # calc_payload_for_list не должен содержать tariff_code
-            # tarifflist_payload = calc_payload.copy()
-            # tarifflist_payload.pop('tariff_code', None)
-            # available_tariffs = client.calculate_tariff_list(tarifflist_payload)
-            # self.env['cdek.tariff']._process_api_tariffs(available_tariffs) 
-            
-            _logger.info("CDEK Rating Request: %s", calc_payload)
-            result = client.calculate_tariff(calc_payload)
-            _logger.info("CDEK Rating Response: %s", result)
+            try:
+                with cdek_rate_limiter.priority('interactive'):
+                    result = self._cdek_calculate_tariff_cached(client, calc_payload, order=order)
+            except CdekUnavailable as e:
+                result = cdek_cache.stale_quote_cache.get(cdek_cache.stale_quote_key(calc_payload, client))
+                if result is None:
+                    raise
+                _logger.warning("CDEK unavailable, serving last known quote for %s: %s", order.name, e)
+                estimate = True
             if not result or 'total_sum' not in result:
                 error_msg_parts = []
                 if result and result.get('errors'):
@@ -313,13 +430,108 @@ class DeliveryCarrier(models.Model):
                  delivery_time_str = (delivery_time_str + add_days_str) if delivery_time_str else add_days_str.strip()[1:-1]
 
 
+            warning_message = result.get('warnings') or False
+            if estimate:
+                warning_message = _("Estimated price: CDEK is temporarily unavailable, the final cost may differ.")
             return {'success': True, 'price': price, 'error_message': False, 
-                    'warning_message': result.get('warnings') or False, 'delivery_time': delivery_time_str or False}
+                    'warning_message': warning_message, 'delivery_time': delivery_time_str or False}
         except UserError as e: return self._rate_error(str(e))
         except Exception as e:
             _logger.exception("CDEK Rating General Exception:")
             return self._rate_error(_("Unexpected error during CDEK rating: %s") % str(e))
 
+    @api.model
+    def _cdek_rate_cache_ttl(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'cdek.rate_cache_ttl_seconds', CDEK_RATE_CACHE_TTL_SECONDS))
+
+    def _cdek_calculate_tariff_cached(self, client, calc_payload, order=None):
+        """calculator/tariff behind the per-worker quote cache; only valid quotes are cached.
+
+        On a miss with an ``order`` at hand, every CDEK carrier available for
+        that order is rated at once through calculator/tarifflist first.
+        """
+        ttl = self._cdek_rate_cache_ttl()
+        cache_key = cdek_cache.rate_cache_key(calc_payload, client) if ttl > 0 else None
+        if cache_key:
+            result = cdek_cache.rate_cache.get(cache_key, ttl=ttl)
+            if result is not None:
+                _logger.debug("CDEK Rating cache hit for tariff %s", calc_payload.get('tariff_code'))
+                return result
+            if order is not None:
+                self._cdek_rate_order_batch(client, order, ttl)
+                result = cdek_cache.rate_cache.get(cache_key, ttl=ttl)
+                if result is not None:
+                    return result
+
+        _logger.info("CDEK Rating Request: %s", calc_payload)
+        result = client.calculate_tariff(calc_payload)
+        _logger.info("CDEK Rating Response: %s", result)
+        if result and 'total_sum' in result:
+            if cache_key:
+                cdek_cache.rate_cache.set(cache_key, result)
+            cdek_cache.stale_quote_cache.set(cdek_cache.stale_quote_key(calc_payload, client), result)
+        return result
+
+    @api.model
+    def _cdek_carriers_for_order(self, order):
+        """CDEK carriers offered for ``order``: those of its company (or website) available for its address."""
+        if order.website_id and hasattr(order, '_get_delivery_methods'):
+            carriers = order._get_delivery_methods()
+        else:
+            Carrier = self.sudo()
+            carriers = Carrier.search(Carrier._check_company_domain(order.company_id)).available_carriers(
+                order.partner_shipping_id, order)
+        return carriers.filtered(lambda c: c.delivery_type == 'cdek')
+
+    @api.model
+    def _cdek_rate_order_batch(self, client, order, ttl):
+        """Rate every CDEK carrier available for ``order`` with one tarifflist call per route.
+
+        Carriers sharing the same sender, recipient and packages only differ by
+        tariff code, so a single calculator/tarifflist answer is fanned out
+        into the quote cache under each carrier's own calculator payload key.
+        Nothing is written to the database: the tariff catalogue is refreshed by its cron.
+        """
+        carriers = self._cdek_carriers_for_order(order)
+        routes = {}
+        for carrier in carriers:
+            try:
+                payload = carrier._cdek_prepare_rate_payload(order)
+            except UserError:
+                continue
+            cache_key = cdek_cache.rate_cache_key(payload, client)
+            if cdek_cache.rate_cache.get(cache_key, ttl=ttl) is not None:
+                continue
+            list_payload = {k: v for k, v in payload.items() if k != 'tariff_code'}
+            route_key = cdek_cache.rate_cache_key(list_payload, client)
+            route = routes.setdefault(route_key, {'payload': list_payload, 'keys': {}})
+            route['keys'].setdefault(payload['tariff_code'], []).append((cache_key, payload))
+
+        for route in routes.values():
+            try:
+                _logger.info("CDEK Tariff List Request for %s tariff(s): %s", len(route['keys']), route['payload'])
+                response = client.calculate_tariff_list(route['payload'])
+            except CdekUnavailable:
+                # Do not spend the single rating call of the checkout on another attempt
+                raise
+            except UserError as e:
+                _logger.warning("CDEK Tariff List failed for %s, falling back to single rating: %s", order.name, e)
+                continue
+            for tariff in (response or {}).get('tariff_codes') or []:
+                if tariff.get('delivery_sum') is None:
+                    continue
+                # tarifflist prices the delivery only, as calculator/tariff does without extra services
+                quote = dict(tariff, total_sum=tariff['delivery_sum'])
+                for cache_key, payload in route['keys'].get(tariff.get('tariff_code'), []):
+                    cdek_cache.rate_cache.set(cache_key, quote)
+                    cdek_cache.stale_quote_cache.set(cdek_cache.stale_quote_key(payload, client), quote)
+
+    @api.model
+    def cdek_rate_cache_stats(self):
+        """Hit/miss counters of this worker's CDEK quote cache."""
+        return cdek_cache.rate_cache.stats()
+
     def _build_order_payload(self, picking): 
         self.ensure_one()
         sale_order = picking.sale_id
@@ -329,8 +541,8 @@ class DeliveryCarrier(models.Model):
         sender_partner = picking.picking_type_id.warehouse_id.partner_id or self.env.company.partner_id
         recipient_partner = picking.partner_id
 
-        sender_contact_payload = self._cdek_prepare_contact_info(sender_partner, is_sender=True, for_order_api=True)
-        recipient_contact_payload = self._cdek_prepare_contact_info(recipient_partner, for_order_api=True)
+        sender_contact_payload = self._cdek_prepare_contact_info(sender_partner, is_sender=True)
+        recipient_contact_payload = self._cdek_prepare_contact_info(recipient_partner)
 
         from_location_payload, shipment_point_code_str = (None, None)
         if self.cdek_shipment_point_code:
@@ -344,7 +556,7 @@ class DeliveryCarrier(models.Model):
         else:
             to_location_payload = self._cdek_prepare_location_info(recipient_partner)
 
-        packages_payload, _ = self._cdek_prepare_packages_payload(picking, order_for_cod_ref=sale_order)
+        packages_payload = self._cdek_prepare_packages_payload(picking, order_for_cod_ref=sale_order)
 
         payload = {
             'type': int(self.cdek_order_type),
@@ -381,67 +593,48 @@ class DeliveryCarrier(models.Model):
 
         return payload
 
+    @api.model
+    def _cdek_extract_order_uuid(self, response_data):
+        """CDEK order UUID from a POST /orders answer, or None when the order was not accepted."""
+        if not isinstance(response_data, dict):
+            return None
+        if (response_data.get('entity') or {}).get('uuid'):
+            return response_data['entity']['uuid']
+        for api_request in response_data.get('requests') or []:
+            for rentity in api_request.get('related_entities') or []:
+                if rentity.get('type') == 'ORDER' and rentity.get('uuid'):
+                    return rentity['uuid']
+        return None
+
+    @api.model
+    def _cdek_order_errors(self, response_data):
+        api_requests_info = response_data.get('requests') if isinstance(response_data, dict) else None
+        if api_requests_info and isinstance(api_requests_info, list) and api_requests_info[0].get('errors'):
+            return "; ".join(f"Code: {err.get('code')}, Message: {err.get('message')}"
+                             for err in api_requests_info[0]['errors'])
+        return str(response_data)
+
     def cdek_send_shipping(self, pickings):
+        """
+        Queue the pickings for registration with CDEK and return at once.
+        The ``cdek.shipment.job`` cron submits them and writes the CDEK UUID back to each picking.
+        """
         self.ensure_one()
-        client = self._get_cdek_client()
         results = []
-
+        to_queue = self.env['stock.picking']
         for picking in pickings:
             if picking.carrier_tracking_ref and picking.cdek_order_uuid:
                 _logger.info("CDEK: Picking %s already sent (UUID: %s)", picking.name, picking.cdek_order_uuid)
                 results.append({'exact_price': picking.carrier_price or 0.0, 'tracking_number': picking.cdek_order_uuid})
                 continue
-            try:
-                payload = self._build_order_payload(picking)
-                _logger.info("CDEK Send Shipping Payload for %s: %s", picking.name, payload)
-                response_data = client.create_order(payload)
-                _logger.info("CDEK Send Shipping Response for %s: %s", picking.name, response_data)
-
-                cdek_uuid = None
-                if response_data and response_data.get('entity') and response_data['entity'].get('uuid'):
-                    cdek_uuid = response_data['entity']['uuid']
-                elif response_data and response_data.get('requests') and response_data['requests'][0].get('related_entities'):
-                    for rentity in response_data['requests'][0]['related_entities']:
-                        if rentity.get('type') == 'ORDER' and rentity.get('uuid'):
-                            cdek_uuid = rentity['uuid']
-                            break
-                
-                if not cdek_uuid:
-                    error_msg_parts = []
-                    api_requests_info = response_data.get('requests') if isinstance(response_data, dict) else None
-                    if api_requests_info and isinstance(api_requests_info, list) and api_requests_info[0].get('errors'):
-                        for err in api_requests_info[0]['errors']:
-                            error_msg_parts.append(f"Code: {err.get('code')}, Message: {err.get('message')}")
-                    final_error_msg = _("CDEK: Failed to register order %s. Details: %s") % (
-                        picking.name, "; ".join(error_msg_parts) if error_msg_parts else str(response_data)
-                    )
-                    results.append({'error_message': final_error_msg, 'exact_price': 0.0})
-                    picking.message_post(body=final_error_msg)
-                    continue
+            to_queue |= picking
+            results.append({'exact_price': picking.carrier_price or 0.0, 'tracking_number': False})
 
-                picking.write({
-                    'carrier_tracking_ref': cdek_uuid,
-                    'cdek_order_uuid': cdek_uuid,
-                })
-                if picking.sale_id: picking.sale_id.cdek_order_uuid = cdek_uuid
-
-                results.append({'exact_price': picking.carrier_price or 0.0, 'tracking_number': cdek_uuid})
-                picking.message_post(body=_("Successfully registered with CDEK. Order UUID: %s") % cdek_uuid)
-
-            except UserError as e: # Ошибки UserError от _build_order_payload или CdekRequest
-                error_msg = _("CDEK API Error for Picking %s: %s") % (picking.name, str(e))
-                _logger.error(error_msg)
-                results.append({'error_message': error_msg, 'exact_price': 0.0})
-                picking.message_post(body=error_msg)
-            except Exception as e:
-                _logger.exception("CDEK Send Shipping General Exception for %s:", picking.name)
-                error_msg = _("Unexpected error sending Picking %s to CDEK: %s") % (picking.name, str(e))
-                results.append({'error_message': error_msg, 'exact_price': 0.0})
-                picking.message_post(body=error_msg)
+        self.env['cdek.shipment.job'].sudo()._enqueue(to_queue)
+        for picking in to_queue:
+            picking.message_post(body=_("Queued for registration with CDEK."))
         return results
 
-
-
     @staticmethod
     def _rate_error(msg: str) -> dict:
         """Return structure compatible with delivery._get_rate() expectations."""
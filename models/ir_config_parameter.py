@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from odoo import api, models
+
+from ..services import cdek_client_pool
+
+CDEK_CLIENT_PARAMS = ('cdek.client_id', 'cdek.client_secret', 'cdek.test_mode')
+
+
+class IrConfigParameter(models.Model):
+    _inherit = 'ir.config_parameter'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        if any(vals.get('key') in CDEK_CLIENT_PARAMS for vals in vals_list):
+            cdek_client_pool.invalidate()
+        return records
+
+    def write(self, vals):
+        touches_cdek = any(key in CDEK_CLIENT_PARAMS for key in self.mapped('key') + [vals.get('key')])
+        res = super().write(vals)
+        if touches_cdek:
+            cdek_client_pool.invalidate()
+        return res
+
+    def unlink(self):
+        touches_cdek = any(key in CDEK_CLIENT_PARAMS for key in self.mapped('key'))
+        res = super().unlink()
+        if touches_cdek:
+            cdek_client_pool.invalidate()
+        return res
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models
+
+
+class ProductTemplate(models.Model):
+    _inherit = 'product.template'
+
+    cdek_length_cm = fields.Float(string='Length (cm)', digits='Stock Weight',
+                                  help="Packed length of one unit for CDEK; 0 uses the default package size.")
+    cdek_width_cm = fields.Float(string='Width (cm)', digits='Stock Weight')
+    cdek_height_cm = fields.Float(string='Height (cm)', digits='Stock Weight')
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    # Shipping profile precomputed for CDEK payloads; 0 / empty means "use the module default"
+    cdek_weight_g = fields.Integer(string='CDEK Weight (g)', compute='_compute_cdek_profile', store=True)
+    cdek_length_cm = fields.Integer(string='CDEK Length (cm)', compute='_compute_cdek_profile', store=True)
+    cdek_width_cm = fields.Integer(string='CDEK Width (cm)', compute='_compute_cdek_profile', store=True)
+    cdek_height_cm = fields.Integer(string='CDEK Height (cm)', compute='_compute_cdek_profile', store=True)
+    cdek_declared_value = fields.Float(string='CDEK Declared Value', compute='_compute_cdek_profile', store=True,
+                                       help="Unit value declared to CDEK when no sale order line prices the item.")
+    cdek_ware_key = fields.Char(string='CDEK Ware Key', compute='_compute_cdek_profile', store=True)
+
+    # Sale price without context: lst_price depends on the pricelist/uom context and cannot drive a stored field
+    @api.depends('weight', 'list_price', 'product_template_attribute_value_ids.price_extra', 'default_code',
+                 'product_tmpl_id.cdek_length_cm', 'product_tmpl_id.cdek_width_cm', 'product_tmpl_id.cdek_height_cm')
+    def _compute_cdek_profile(self):
+        for product in self:
+            template = product.product_tmpl_id
+            product.cdek_weight_g = max(10, round(product.weight * 1000)) if product.weight else 0
+            product.cdek_length_cm = max(1, round(template.cdek_length_cm)) if template.cdek_length_cm else 0
+            product.cdek_width_cm = max(1, round(template.cdek_width_cm)) if template.cdek_width_cm else 0
+            product.cdek_height_cm = max(1, round(template.cdek_height_cm)) if template.cdek_height_cm else 0
+            product.cdek_declared_value = max(0.01, round(product.list_price + product.price_extra, 2))
+            product.cdek_ware_key = (product.default_code or f"SKU_{product.id}")[:50]
@@ -1,8 +1,13 @@
+import logging
+import secrets
+
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
-from odoo.addons.cdek_odooAPI2.services.cdek_request import CdekRequest
+from odoo.addons.cdek_odooAPI2.services import cdek_client_pool
+
+from ..const import CDEK_WEBHOOK_TYPES, CDEK_MAX_PACKAGE_WEIGHT_KG, CDEK_LABEL_FORMATS, DEFAULT_LENGTH_CM, DEFAULT_WIDTH_CM, DEFAULT_HEIGHT_CM, DEFAULT_WEIGHT_KG
 
-from ..const import CDEK_LABEL_FORMATS, DEFAULT_LENGTH_CM, DEFAULT_WIDTH_CM, DEFAULT_HEIGHT_CM, DEFAULT_WEIGHT_KG
+_logger = logging.getLogger(__name__)
 
 class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
@@ -75,17 +80,87 @@ class ResConfigSettings(models.TransientModel):
         digits='Stock Weight'
     )
 
+    cdek_max_package_weight_kg = fields.Float(
+        string='Max Parcel Weight (kg)',
+        config_parameter='cdek.max_package_weight_kg',
+        default=CDEK_MAX_PACKAGE_WEIGHT_KG,
+        digits='Stock Weight',
+        help="Orders heavier than this are split into several CDEK parcels."
+    )
+
     cdek_tracking_update_interval_minutes = fields.Integer(
         string='Tracking Update Interval (minutes)',
         config_parameter='cdek.tracking_update_interval_minutes',
         default=60,
-        help="How often to automatically check CDEK shipment statuses. 0 to disable."
+        help="Base interval for polling CDEK shipment statuses, scaled per status (in transit, waiting at a pickup point, delivered). 0 to disable."
+    )
+
+    cdek_pvz_sync_countries = fields.Char(
+        string='PVZ Sync Countries',
+        config_parameter='cdek.pvz_sync_countries',
+        default='RU',
+        help="Comma separated ISO country codes whose pickup points are replicated by the daily sync."
+    )
+    cdek_pvz_live_search = fields.Boolean(
+        string='Live Pickup Point Search',
+        config_parameter='cdek.pvz_live_search',
+        help="Always query CDEK for the checkout widget instead of the local pickup point replica."
     )
 
+    cdek_webhook_url = fields.Char(
+        string='CDEK Webhook URL',
+        compute='_compute_cdek_webhook_url',
+        help="Callback URL registered with CDEK for status and print form events."
+    )
+
+    @api.depends('company_id')
+    def _compute_cdek_webhook_url(self):
+        secret = self.env['ir.config_parameter'].sudo().get_param('cdek.webhook_secret')
+        for settings in self:
+            settings.cdek_webhook_url = settings._get_cdek_webhook_url(secret) if secret else False
+
+    @api.model
+    def _get_cdek_webhook_url(self, secret):
+        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        return f"{base_url.rstrip('/')}/cdek/webhook?token={secret}"
+
+    def action_cdek_register_webhooks(self):
+        """
+        Subscribe this database to CDEK ORDER_STATUS and PRINT_FORM callbacks.
+        Generates the shared secret on first use; existing subscriptions to an outdated URL are replaced.
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        secret = params.get_param('cdek.webhook_secret') or secrets.token_urlsafe(32)
+        url = self._get_cdek_webhook_url(secret)
+        client = self._get_cdek_client()
+
+        registered = set()
+        for hook in client.list_webhooks() or []:
+            if hook.get('type') not in CDEK_WEBHOOK_TYPES or '/cdek/webhook' not in (hook.get('url') or ''):
+                continue
+            if hook.get('url') == url:
+                registered.add(hook['type'])
+            else:
+                client.delete_webhook(hook['uuid'])
+        for event_type in CDEK_WEBHOOK_TYPES:
+            if event_type not in registered:
+                client.register_webhook(url, event_type)
+        params.set_param('cdek.webhook_secret', secret)
+        _logger.info("CDEK webhooks registered for %s", ', '.join(CDEK_WEBHOOK_TYPES))
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'type': 'success',
+                'message': _("CDEK webhooks registered. Tracking polling now runs as a periodic reconciliation."),
+                'next': {'type': 'ir.actions.act_window_close'},
+            },
+        }
+
     @api.model
     def _get_cdek_client(self, carrier=None):
         """
-        Helper to get an instance of CdekRequest with current global settings.
+        Helper to get the pooled CdekRequest of this worker for the current global settings.
         :param carrier: Optional delivery.carrier record. If provided, its log_xml method can be used for debugging.
         :return: CdekRequest instance
         """
@@ -94,17 +169,13 @@ class ResConfigSettings(models.TransientModel):
         client_secret = params.get_param('cdek.client_secret')
         test_mode = params.get_param('cdek.test_mode', 'False').lower() in ('true', '1')
 
-        from ..const import CDEK_API_PROD_URL, CDEK_API_TEST_URL
-        base_url = CDEK_API_TEST_URL if test_mode else CDEK_API_PROD_URL
-
         if not client_id or not client_secret:
             if self.env.context.get('saving_config'):
                  _logger.warning("CDEK client cannot be initialized: API credentials not yet saved or missing.")
                  return None 
             raise UserError(_("CDEK API Client ID or Secret is not configured in settings."))
 
-        debug_logger = None
+        client = cdek_client_pool.get_client(client_id, client_secret, test_mode=test_mode)
         if carrier and hasattr(carrier, 'log_xml') and carrier.debug_logging:
-            debug_logger = lambda message, name: carrier.log_xml(message, name)
-
-        return CdekRequest(client_id, client_secret, base_url, debug_logger=debug_logger)
\ No newline at end of file
+            client = client.with_debug_logger(lambda message, name: carrier.log_xml(message, name))
+        return client
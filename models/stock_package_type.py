@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from odoo import fields, models
+
+
+class StockPackageType(models.Model):
+    _inherit = 'stock.package.type'
+
+    cdek_packing_box = fields.Boolean(
+        string='CDEK Packing Box',
+        help="Offer this box to the CDEK packing engine when splitting orders into parcels."
+    )
@@ -1,7 +1,24 @@
 # -*- coding: utf-8 -*-
-import base64
+import logging
+import tempfile
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
+from odoo.tools import split_every
+from odoo.tools.pdf import PdfFileReader, PdfFileWriter
+from odoo.tools.sql import create_index
+
+from ..const import (
+    CDEK_TRACKING_WORKERS, CDEK_TRACKING_BATCH_SIZE, CDEK_WEBHOOK_RECONCILE_HOURS,
+    CDEK_TRACKING_DEFAULT_FACTOR, CDEK_TRACKING_STATUS_FACTORS, CDEK_TRACKING_MAX_BACKOFF_EXPONENT,
+    CDEK_PRINT_MAX_ORDERS,
+)
+from ..services import cdek_async_request, cdek_rate_limiter
+from ..services.cdek_resilience import CdekUnavailable
+
+_logger = logging.getLogger(__name__)
 
 class StockPicking(models.Model):
     _inherit = "stock.picking"
@@ -30,13 +47,56 @@ class StockPicking(models.Model):
         readonly=True,
         help="Timestamp of the latest CDEK status."
     )
+    cdek_package_count = fields.Integer(
+        string='CDEK Packages',
+        copy=False,
+        readonly=True,
+        help="Number of packages registered with CDEK; bulk label files are split per order by this count."
+    )
     cdek_tracking_history_log = fields.Text(
         string='CDEK Tracking History',
+        compute='_compute_cdek_tracking_history_log',
+        help="Full log of CDEK tracking status updates."
+    )
+    cdek_tracking_fingerprint = fields.Char(
+        string='CDEK Tracking Fingerprint',
         copy=False,
         readonly=True,
-        help="Full log of CDEK tracking status updates."
+        help="Latest status code, date and status count of the last CDEK answer; unchanged answers are skipped."
+    )
+    cdek_tracking_next_check = fields.Datetime(
+        string='CDEK Next Status Check',
+        copy=False,
+        readonly=True,
+        help="When the tracking cron polls CDEK again; derived from the current status and recent errors."
+    )
+    cdek_tracking_error_count = fields.Integer(
+        string='CDEK Tracking Errors',
+        copy=False,
+        readonly=True,
+        help="Consecutive failed status checks; the polling interval backs off exponentially."
+    )
+    cdek_tracking_event_ids = fields.One2many(
+        'cdek.tracking.event', 'picking_id',
+        string='CDEK Tracking Events',
+        readonly=True,
     )
 
+    def init(self):
+        super().init()
+        create_index(self._cr, 'stock_picking_cdek_tracking_next_check_idx', self._table,
+                     ['cdek_tracking_next_check', 'id'],
+                     where="cdek_order_uuid IS NOT NULL AND state NOT IN ('done', 'cancel')")
+
+    @api.depends('cdek_tracking_event_ids')
+    def _compute_cdek_tracking_history_log(self):
+        for picking in self:
+            picking.cdek_tracking_history_log = "\n".join(
+                f"{event.date_time} - [{event.code}] {event.name or ''}"
+                f"{(' (' + event.city + ')') if event.city else ''}"
+                for event in picking.cdek_tracking_event_ids.sorted(lambda e: (e.date_time, e.id))
+            )
+
     def _get_cdek_client_for_picking(self):
         """Helper to get CDEK client, ensuring carrier is CDEK."""
         self.ensure_one()
@@ -47,103 +107,349 @@ class StockPicking(models.Model):
         return self.carrier_id._get_cdek_client()
 
 
-    def cdek_update_tracking_state(self):
-        """Updates CDEK tracking status for selected pickings."""
-        updated_pickings = self.env['stock.picking']
-        for picking in self.filtered(lambda p: p.carrier_id.delivery_type == 'cdek' and (p.carrier_tracking_ref or p.cdek_order_uuid) and p.state not in ('done', 'cancel')):
-            client = picking._get_cdek_client_for_picking()
-            if not client:
-                picking.message_post(body=_("CDEK tracking update failed: Client could not be initialized. Check CDEK configuration."))
-                continue
+    def _cdek_is_trackable(self):
+        self.ensure_one()
+        return self.carrier_id.delivery_type == 'cdek' and bool(self.carrier_tracking_ref or self.cdek_order_uuid) \
+            and self.state not in ('done', 'cancel')
 
-            tracking_uuid = picking.carrier_tracking_ref or picking.cdek_order_uuid
+    @api.model
+    def _cdek_fetch_order_infos(self, client, uuids):
+        """
+        Fetch CDEK order info for many UUIDs concurrently in threads (see ``cdek_async_request``).
+        Runs outside the ORM: only HTTP goes through the shared pooled client.
+        :return: dict uuid -> (order_info, exception)
+        """
+        async def fetch(cdek, uuid):
             try:
-                _logger.info("CDEK Tracking Update: Fetching status for picking %s (UUID: %s)", picking.name, tracking_uuid)
-                order_info = client.get_order_info(tracking_uuid)
-                _logger.info("CDEK Tracking Update for %s: Response %s", picking.name, order_info)
-
-                if not order_info or 'statuses' not in order_info or not order_info['statuses']:
-                    picking.message_post(body=_("CDEK Tracking: No status information found for UUID %s.") % tracking_uuid)
-                    continue
-
-                statuses = sorted(order_info['statuses'], key=lambda s: s['date_time'], reverse=True)
-                latest_status = statuses[0] 
-
-                history_lines = []
-                for status in sorted(order_info['statuses'], key=lambda s: s['date_time']): # Chronological for log
-                    history_lines.append(
-                        f"{status.get('date_time')} - [{status.get('code')}] {status.get('name')}"
-                        f"{(' (' + status.get('city') + ')') if status.get('city') else ''}"
-                    )
-
-                picking.write({
-                    'cdek_tracking_state_code': latest_status.get('code'),
-                    'cdek_tracking_state_name': latest_status.get('name'),
-                    'cdek_tracking_state_datetime': fields.Datetime.from_string(latest_status.get('date_time')),
-                    'cdek_tracking_history_log': "\n".join(history_lines),
-                })
-                picking.message_post(body=_("CDEK tracking status updated: [%s] %s at %s") % (
-                    latest_status.get('code'), latest_status.get('name'), latest_status.get('date_time')
-                ))
-                updated_pickings |= picking
-
-            except UserError as e:
-                _logger.error("CDEK Tracking Update UserError for %s: %s", picking.name, e)
-                picking.message_post(body=_("CDEK Tracking Error: %s") % str(e))
+                return await cdek.get_order_info(uuid), None
             except Exception as e:
-                _logger.error("CDEK Tracking Update Exception for %s: %s", picking.name, e, exc_info=True)
-                picking.message_post(body=_("Unexpected error during CDEK tracking update for %s: %s") % (picking.name, str(e)))
-        return updated_pickings
+                return None, e
 
+        async def fetch_all(cdek):
+            return await cdek_async_request.gather_bounded([fetch(cdek, uuid) for uuid in uuids], CDEK_TRACKING_WORKERS)
 
-    def cdek_action_get_label(self):
-        """Action to download and attach CDEK shipping label."""
-        self.ensure_one()
-        if not self.carrier_id or self.carrier_id.delivery_type != 'cdek':
-            raise UserError(_("This picking is not configured for CDEK delivery."))
+        uuids = list(dict.fromkeys(uuids))
+        if not uuids:
+            return {}
+        # Warm the shared token once so the workers don't race for it
+        client._get_token()
+        return dict(zip(uuids, cdek_async_request.run_sync(client, fetch_all)))
+
+    @api.model
+    def _cdek_prepare_tracking_events(self, order_info):
+        """Return the statuses of a CDEK order info payload as ``cdek.tracking.event`` values."""
+        entity = (order_info or {}).get('entity') or order_info or {}
+        return [
+            {
+                'order_uuid': entity.get('uuid'),
+                'code': status.get('code'),
+                'name': status.get('name'),
+                'date_time': self._cdek_parse_datetime(status.get('date_time')),
+                'city': status.get('city'),
+                'source': 'poll',
+            }
+            for status in entity.get('statuses') or []
+        ]
+
+    @api.model
+    def _cdek_tracking_fingerprint(self, events):
+        """Cheap digest of a CDEK status list: latest code and date plus the number of statuses."""
+        latest = max(events, key=lambda e: e['date_time'] or datetime.min)
+        return f"{latest['code']}|{latest['date_time']}|{len(events)}"
+
+    @api.model
+    def _cdek_tracking_base_interval(self):
+        """Base polling interval in minutes (``cdek.tracking_update_interval_minutes``); 0 disables polling."""
+        value = self.env['ir.config_parameter'].sudo().get_param('cdek.tracking_update_interval_minutes', 60)
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return 60
 
-        tracking_uuid = self.carrier_tracking_ref or self.cdek_order_uuid
-        if not tracking_uuid:
-            raise UserError(_("CDEK Order UUID or Tracking Reference is missing for this picking."))
+    def _cdek_schedule_next_check(self, base_minutes, failed=False):
+        """Set the next poll from the current status code, or back off exponentially after a failure."""
+        now = fields.Datetime.now()
+        webhooks = bool(self.env['ir.config_parameter'].sudo().get_param('cdek.webhook_secret'))
+        for picking in self:
+            if failed:
+                errors = picking.cdek_tracking_error_count + 1
+                delay = timedelta(minutes=base_minutes * 2 ** min(errors, CDEK_TRACKING_MAX_BACKOFF_EXPONENT))
+            else:
+                errors = 0
+                factor = CDEK_TRACKING_STATUS_FACTORS.get(picking.cdek_tracking_state_code, CDEK_TRACKING_DEFAULT_FACTOR)
+                delay = timedelta(minutes=base_minutes * factor)
+                if webhooks:
+                    # Statuses are pushed; polling only reconciles missed callbacks
+                    delay = max(delay, timedelta(hours=CDEK_WEBHOOK_RECONCILE_HOURS))
+            picking.cdek_tracking_error_count = errors
+            picking.cdek_tracking_next_check = now + delay
 
-        client = self._get_cdek_client_for_picking()
-        if not client:
-            raise UserError(_("CDEK label download failed: Client could not be initialized. Check CDEK configuration."))
+    def _cdek_refresh_tracking_state(self):
+        """Derive the latest-status fields from the stored tracking events."""
+        if not self:
+            return
+        self.env['cdek.tracking.event'].flush_model()
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (picking_id) picking_id, code, name, date_time
+              FROM cdek_tracking_event
+             WHERE picking_id IN %s
+          ORDER BY picking_id, date_time DESC, id DESC
+        """, [tuple(self.ids)])
+        for picking_id, code, name, date_time in self.env.cr.fetchall():
+            self.browse(picking_id).write({
+                'cdek_tracking_state_code': code,
+                'cdek_tracking_state_name': name or code,
+                'cdek_tracking_state_datetime': date_time,
+            })
 
-        label_format = self.carrier_id._cdek_get_label_format() # Get format from carrier or global config
+    def _cdek_record_tracking_events(self, vals_list):
+        """
+        Store the given events and refresh the pickings that received new ones.
+        :return: pickings with at least one new event
+        """
+        new_events = self.env['cdek.tracking.event'].sudo()._insert_events(vals_list)
+        pickings = new_events.picking_id.with_env(self.env)
+        pickings._cdek_refresh_tracking_state()
+        for picking in pickings:
+            picking.message_post(body=_("CDEK tracking status updated: [%s] %s at %s") % (
+                picking.cdek_tracking_state_code, picking.cdek_tracking_state_name, picking.cdek_tracking_state_datetime
+            ))
+        return pickings
 
+    @api.model
+    def _cdek_parse_datetime(self, value):
+        """CDEK sends ISO 8601 timestamps with an offset; store them as naive UTC."""
+        if not value:
+            return False
         try:
-            _logger.info("CDEK Get Label: Requesting %s label for picking %s (UUID: %s)", label_format.upper(), self.name, tracking_uuid)
-            label_data = client.get_label_data(tracking_uuid, label_format=label_format)
-
-            if not label_data:
-                raise UserError(_("CDEK did not return any label data for UUID %s.") % tracking_uuid)
-
-            filename = f"cdek_label_{tracking_uuid}_{self.name.replace('/', '_')}.{label_format}"
-            attachment_vals = {
-                'name': filename,
-                'datas': base64.b64encode(label_data),
-                'res_model': 'stock.picking',
-                'res_id': self.id,
-                'mimetype': 'application/pdf' if label_format == 'pdf' else 'text/plain', # Adjust mimetype for ZPL if needed
-            }
-            self.env['ir.attachment'].create(attachment_vals)
-            self.message_post(body=_("CDEK shipping label (%s) downloaded.") % label_format.upper(), attachments=[(filename, label_data)])
-            _logger.info("CDEK Get Label: Successfully attached %s label for picking %s.", label_format.upper(), self.name)
-
-            # return {
-            #     'type': 'ir.actions.act_url',
-            #     'url': f'/web/content/{attachment.id}?download=true', # If attachment is created and ID known
-            #     'target': 'self',
-            # }
-
-        except UserError as e:
-            _logger.error("CDEK Get Label UserError for %s: %s", self.name, e)
-            raise 
-        except Exception as e:
-            _logger.error("CDEK Get Label Exception for %s: %s", self.name, e, exc_info=True)
-            raise UserError(_("An unexpected error occurred while getting CDEK label for %s: %s") % (self.name, str(e)))
+            dt = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+        except ValueError:
+            return fields.Datetime.to_datetime(value[:19].replace('T', ' '))
+        return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+    def cdek_update_tracking_state(self):
+        """Updates CDEK tracking status for selected pickings."""
+        return self._cdek_update_tracking_state()[0]
+
+    def _cdek_update_tracking_state(self):
+        """
+        Fetch and record the CDEK statuses of the trackable pickings in self.
+        Failures are logged once per batch; only errors about one picking (unknown order...) reach its
+        chatter, and only on the first failure of a streak, not on every retry.
+        :return: tuple (updated pickings, number of pickings skipped because CDEK reported nothing new)
+        """
+        pickings = self.filtered(lambda p: p._cdek_is_trackable())
+        if not pickings:
+            return self.env['stock.picking'], 0
+
+        client = self.env['res.config.settings']._get_cdek_client()
+        uuid_by_picking = {picking: picking.carrier_tracking_ref or picking.cdek_order_uuid for picking in pickings}
+        _logger.info("CDEK Tracking Update: fetching statuses of %s pickings", len(pickings))
+        results = self._cdek_fetch_order_infos(client, uuid_by_picking.values())
+
+        event_vals = []
+        fingerprints = {}
+        skipped = 0
+        failed = self.env['stock.picking']
+        unavailable = []
+        unexpected = []
+        for picking, tracking_uuid in uuid_by_picking.items():
+            order_info, error = results[tracking_uuid]
+            if error:
+                failed |= picking
+            if isinstance(error, CdekUnavailable):
+                # CDEK down, circuit open or request budget spent: nothing this picking can act on
+                unavailable.append(error)
+                continue
+            if isinstance(error, UserError):
+                _logger.warning("CDEK Tracking Update error for %s: %s", picking.name, error)
+                if not picking.cdek_tracking_error_count:
+                    picking.message_post(body=_("CDEK Tracking Error: %s") % str(error))
+                continue
+            if error:
+                unexpected.append((picking, error))
+                continue
+
+            picking_events = self._cdek_prepare_tracking_events(order_info)
+            if not picking_events:
+                picking.message_post(body=_("CDEK Tracking: No status information found for UUID %s.") % tracking_uuid)
+                continue
+            fingerprint = self._cdek_tracking_fingerprint(picking_events)
+            if fingerprint == picking.cdek_tracking_fingerprint:
+                skipped += 1
+                continue
+            fingerprints[picking] = fingerprint
+            for vals in picking_events:
+                vals['picking_id'] = picking.id
+                vals['order_uuid'] = vals['order_uuid'] or tracking_uuid
+            event_vals += picking_events
+
+        if unavailable:
+            _logger.warning("CDEK Tracking Update: %s of %s pickings not checked, CDEK unavailable: %s",
+                            len(unavailable), len(pickings), unavailable[0])
+        if unexpected:
+            picking, error = unexpected[0]
+            _logger.error("CDEK Tracking Update: unexpected error for %s pickings, first for %s: %s",
+                          len(unexpected), picking.name, error, exc_info=error)
+
+        # Known statuses are dropped by the insert: only pickings with new events are written
+        updated_pickings = pickings._cdek_record_tracking_events(event_vals)
+        for picking, fingerprint in fingerprints.items():
+            picking.cdek_tracking_fingerprint = fingerprint
+        base_minutes = self._cdek_tracking_base_interval() or 60
+        (pickings - failed)._cdek_schedule_next_check(base_minutes)
+        failed._cdek_schedule_next_check(base_minutes, failed=True)
+        pickings.flush_recordset()
+        return updated_pickings, skipped
+
+    @api.model
+    def cron_update_cdek_tracking(self, auto_commit=True):
+        """
+        Scheduled action: refresh the tracking state of the CDEK shipments that are due.
+        Each picking carries its own next check time (see ``_cdek_schedule_next_check``);
+        due statuses are fetched concurrently per batch and each batch is committed.
+        """
+        base_minutes = self._cdek_tracking_base_interval()
+        if not base_minutes:
+            return {'updated': 0, 'skipped': 0}
+        picking_ids = self.search([
+            ('carrier_id.delivery_type', '=', 'cdek'),
+            ('cdek_order_uuid', '!=', False),
+            ('state', 'not in', ['done', 'cancel']),
+            '|', ('cdek_tracking_next_check', '=', False),
+                 ('cdek_tracking_next_check', '<=', fields.Datetime.now()),
+        ], order='cdek_tracking_next_check asc nulls first, id').ids
+        updated = skipped = 0
+        for start in range(0, len(picking_ids), CDEK_TRACKING_BATCH_SIZE):
+            batch = self.browse(picking_ids[start:start + CDEK_TRACKING_BATCH_SIZE])
+            with cdek_rate_limiter.priority('background'):
+                batch_updated, batch_skipped = batch._cdek_update_tracking_state()
+            updated += len(batch_updated)
+            skipped += batch_skipped
+            if auto_commit:
+                self.env.cr.commit()
+            self.env.invalidate_all()
+        _logger.info("CDEK Tracking Update: %s of %s pickings updated, %s unchanged skipped",
+                     updated, len(picking_ids), skipped)
+        return {'updated': updated, 'skipped': skipped}
+
+    def _cdek_split_label_pdf(self, fileobj):
+        """
+        Split a merged CDEK label PDF file into one PDF per picking of self, in the order they were sent.
+        CDEK prints one page per package, so each picking gets as many pages as it registered packages.
+        :return: dict picking -> temporary file, or None when the pages cannot be attributed to the pickings
+        """
+        if len(self) == 1:
+            return {self: fileobj}
+        counts = [picking.cdek_package_count for picking in self]
+        if not all(counts):
+            return None
+        reader = PdfFileReader(fileobj, strict=False)
+        if reader.getNumPages() != sum(counts):
+            return None
+        result = {}
+        start = 0
+        for picking, count in zip(self, counts):
+            writer = PdfFileWriter()
+            for page in range(start, start + count):
+                writer.addPage(reader.getPage(page))
+            start += count
+            # spooled to disk like the download itself, closed by the caller
+            result[picking] = tempfile.TemporaryFile()
+            writer.write(result[picking])
+        return result
+
+    def _cdek_fetch_labels(self, client, uuid_by_picking):
+        """
+        Download and cache the labels of self in one print job, split per order.
+        When the merged file cannot be attributed page by page (package count unknown or not matching
+        the pages CDEK rendered), every order gets a print job of its own instead.
+        :return: dict order uuid -> cdek.label
+        """
+        Label = self.env['cdek.label'].sudo()
+        if len(self) == 1 or all(self.mapped('cdek_package_count')):
+            _logger.info("CDEK Get Label: requesting labels of %s pickings", len(self))
+            with client.fetch_barcodes([uuid_by_picking[picking] for picking in self]) as fileobj:
+                if not fileobj.read(1):
+                    raise UserError(_("CDEK did not return any label data for %s.") % ", ".join(self.mapped('name')))
+                fileobj.seek(0)
+                split = self._cdek_split_label_pdf(fileobj)
+                if split is not None:
+                    labels = {}
+                    with ExitStack() as stack:
+                        for label in split.values():
+                            stack.enter_context(label)
+                        for picking, label in split.items():
+                            labels[uuid_by_picking[picking]] = cached = Label._store(picking, uuid_by_picking[picking], label)
+                            picking.message_post(body=_("CDEK shipping label downloaded."), attachment_ids=cached.attachment_id.ids)
+                    return labels
+            _logger.warning("CDEK Get Label: pages of %s do not match their package counts, printing them one by one",
+                            ", ".join(self.mapped('name')))
+        labels = {}
+        for picking in self:
+            labels.update(picking._cdek_fetch_labels(client, uuid_by_picking))
+        return labels
+
+    @api.model
+    def _cdek_merge_label_pdf(self, attachments, dest):
+        """Merge label PDF attachments page by page into the file object ``dest``."""
+        Label = self.env['cdek.label']
+        writer = PdfFileWriter()
+        with ExitStack() as stack:
+            for attachment in attachments:
+                reader = PdfFileReader(stack.enter_context(Label._open_attachment(attachment)), strict=False)
+                for page in range(reader.getNumPages()):
+                    writer.addPage(reader.getPage(page))
+            writer.write(dest)
+
+    def _cdek_ensure_labels(self):
+        """
+        Return the label attachments of self, in order.
+        Labels already in the ``cdek.label`` cache are read from the filestore; the others are requested
+        in print jobs of up to CDEK_PRINT_MAX_ORDERS orders.
+        """
+        pickings = self.filtered(lambda p: p.carrier_id.delivery_type == 'cdek')
+        if not pickings:
+            raise UserError(_("This picking is not configured for CDEK delivery."))
+        missing = pickings.filtered(lambda p: not (p.carrier_tracking_ref or p.cdek_order_uuid))
+        if missing:
+            raise UserError(_("CDEK Order UUID or Tracking Reference is missing for: %s") % ", ".join(missing.mapped('name')))
+
+        Label = self.env['cdek.label'].sudo()
+        uuid_by_picking = {picking: picking.cdek_order_uuid or picking.carrier_tracking_ref for picking in pickings}
+        labels = Label._get_cached(uuid_by_picking.values())
+        to_fetch = pickings.filtered(lambda p: uuid_by_picking[p] not in labels)
+        if to_fetch:
+            client = self.env['res.config.settings']._get_cdek_client()
+            for batch in split_every(CDEK_PRINT_MAX_ORDERS, to_fetch.ids, self.browse):
+                labels.update(batch._cdek_fetch_labels(client, uuid_by_picking))
+        _logger.info("CDEK Get Label: %s labels from cache, %s downloaded", len(pickings) - len(to_fetch), len(to_fetch))
+        return [labels[uuid_by_picking[picking]].attachment_id for picking in pickings]
+
+    def cdek_action_get_label(self):
+        """
+        Download the CDEK labels of the selected pickings.
+        A single label is the cached attachment itself. Several labels are merged on the fly by the
+        ``/cdek/labels`` controller, so no merged copy is ever stored in the filestore.
+        """
+        attachments = self._cdek_ensure_labels()
+        if len(attachments) == 1:
+            # /web/content streams the filestore file as is, without any base64 round trip
+            url = f'/web/content/{attachments[0].id}?download=true'
+        else:
+            url = '/cdek/labels?picking_ids=%s' % ','.join(str(picking_id) for picking_id in self.ids)
+        return {
+            'type': 'ir.actions.act_url',
+            'url': url,
+            'target': 'self',
+        }
 
+    def write(self, vals):
+        if 'cdek_order_uuid' in vals:
+            changed = self.filtered(lambda p: p.cdek_order_uuid and p.cdek_order_uuid != vals['cdek_order_uuid'])
+            if changed:
+                self.env['cdek.label'].sudo()._invalidate(changed.mapped('cdek_order_uuid'))
+        return super().write(vals)
 
     def action_cdek_send_shipping(self):
         """Button action to send selected pickings to CDEK."""
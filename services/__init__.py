@@ -1 +1,11 @@
-from . import cdek_request
\ No newline at end of file
+from . import cdek_token_store
+from . import cdek_cache
+from . import cdek_stream
+from . import cdek_text
+from . import cdek_packing
+from . import cdek_resilience
+from . import cdek_rate_limiter
+from . import cdek_singleflight
+from . import cdek_request
+from . import cdek_async_request
+from . import cdek_client_pool
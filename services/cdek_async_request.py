@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Threaded fan-out of :class:`CdekRequest` calls for bulk background pipelines.
+
+This is not a separate HTTP client: every call runs the worker's pooled
+:class:`CdekRequest` method in a thread (``asyncio.to_thread``), so deadlines,
+retries, the rate limiter, circuit breakers and error mapping are the ones of
+the synchronous client. At most ``CDEK_POOL_MAXSIZE`` calls are in flight, as
+many as the connection pool holds. The event loop only schedules the threads;
+``asyncio.to_thread`` copies the caller's context, priority class included.
+
+Cron code calls it through :func:`run_sync`::
+
+    async def fetch_all(cdek):
+        return await gather_bounded([cdek.get_order_info(uuid) for uuid in uuids], limit=16)
+
+    infos = run_sync(client, fetch_all)
+"""
+import asyncio
+import functools
+
+from ..const import CDEK_POOL_MAXSIZE
+
+
+def run_sync(client, func):
+    """
+    Run ``await func(async_client)`` to completion from synchronous code (crons) on a fresh event loop.
+    :param client: the pooled :class:`CdekRequest` of the worker
+    """
+    async def main():
+        return await func(AsyncCdekRequest(client))
+    return asyncio.run(main())
+
+
+async def gather_bounded(aws, limit):
+    """``asyncio.gather`` with at most ``limit`` awaitables running at once; results keep their order."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+    return await asyncio.gather(*(run(aw) for aw in aws))
+
+
+class AsyncCdekRequest:
+    """Awaitable view of a :class:`CdekRequest`: each public method runs in a thread, awaited here."""
+
+    def __init__(self, client, limit=CDEK_POOL_MAXSIZE):
+        self._client = client
+        self._threads = asyncio.Semaphore(limit)
+
+    async def _call(self, name, *args, **kwargs):
+        async with self._threads:
+            return await asyncio.to_thread(getattr(self._client, name), *args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not callable(getattr(self._client, name, None)):
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Small in-process caches used to avoid repeated CDEK round trips."""
+import hashlib
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from ..const import (
+    CDEK_BILLING_WEIGHT_STEP_G, CDEK_RATE_CACHE_SIZE, CDEK_RATE_CACHE_TTL_SECONDS,
+    CDEK_STALE_QUOTE_WEIGHT_BRACKET_G, CDEK_STALE_QUOTE_TTL_SECONDS,
+    CDEK_PVZ_CLUSTER_CACHE_SIZE, CDEK_PVZ_CLUSTER_CACHE_TTL_SECONDS,
+    CDEK_PACKING_CACHE_SIZE, CDEK_PACKING_CACHE_TTL_SECONDS,
+)
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a TTL."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def _round_up(value, step):
+    return int(math.ceil(float(value or 0) / step) * step)
+
+
+def normalize_rate_payload(calc_payload):
+    """Keep only what CDEK prices on, with package totals at billing granularity.
+
+    Item lines are dropped: the calculator bills on package weight and
+    dimensions, so carts that differ only in item names or prices share a quote.
+    """
+    packages = [
+        {
+            'weight': _round_up(package.get('weight'), CDEK_BILLING_WEIGHT_STEP_G),
+            'length': _round_up(package.get('length'), 1),
+            'width': _round_up(package.get('width'), 1),
+            'height': _round_up(package.get('height'), 1),
+        }
+        for package in calc_payload.get('packages') or []
+    ]
+    normalized = {k: v for k, v in calc_payload.items() if k != 'packages'}
+    normalized['packages'] = packages
+    return normalized
+
+
+def payload_key(*parts):
+    """Stable hash of JSON-serializable parts (dict key order does not matter)."""
+    raw = json.dumps(parts, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def rate_cache_key(calc_payload, client):
+    """Cache key of a calculator payload for the account behind ``client``."""
+    return payload_key(client.base_url, client.client_id, normalize_rate_payload(calc_payload))
+
+
+def stale_quote_key(calc_payload, client):
+    """Key of the last good quote for a route, tariff and total weight bracket (dimensions ignored)."""
+    weight = sum(package.get('weight') or 0 for package in calc_payload.get('packages') or [])
+    return payload_key(
+        client.base_url, client.client_id,
+        calc_payload.get('type'), calc_payload.get('tariff_code'),
+        calc_payload.get('from_location'), calc_payload.get('to_location'),
+        _round_up(weight, CDEK_STALE_QUOTE_WEIGHT_BRACKET_G),
+    )
+
+
+rate_cache = TTLCache(CDEK_RATE_CACHE_SIZE, CDEK_RATE_CACHE_TTL_SECONDS)
+# Fallback quotes served as estimates while CDEK is unavailable
+stale_quote_cache = TTLCache(CDEK_RATE_CACHE_SIZE, CDEK_STALE_QUOTE_TTL_SECONDS)
+# Keyed on (sync watermark, type, zoom, x, y): a new PVZ sync changes the key in every worker
+cluster_cache = TTLCache(CDEK_PVZ_CLUSTER_CACHE_SIZE, CDEK_PVZ_CLUSTER_CACHE_TTL_SECONDS)
+# Keyed on the packing signature (lines, box catalogue, weight limit): same cart, same parcels
+packing_cache = TTLCache(CDEK_PACKING_CACHE_SIZE, CDEK_PACKING_CACHE_TTL_SECONDS)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Per-worker registry of long-lived :class:`CdekRequest` clients.
+
+Odoo workers are separate processes, so the registry is naturally scoped to one
+worker: every rating, picking and widget call made by that worker reuses the
+same keep-alive session instead of opening a new TLS connection.
+"""
+import hashlib
+import logging
+import threading
+
+from .cdek_request import CdekRequest
+
+_logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _fingerprint(client_secret):
+    return hashlib.sha256((client_secret or "").encode()).hexdigest()
+
+
+def get_client(client_id, client_secret, test_mode=False):
+    """Return the pooled client for the given credentials, creating it if needed.
+
+    The registry is keyed on ``(client_id, test_mode, base_url)``. A changed
+    secret for the same key replaces the stored client, which also covers
+    credential changes made by another worker.
+    """
+    test_mode = bool(test_mode)
+    key = (client_id, test_mode, CdekRequest.get_base_url(test_mode))
+    secret_fp = _fingerprint(client_secret)
+    with _lock:
+        entry = _clients.get(key)
+        if entry and entry[0] == secret_fp:
+            return entry[1]
+        client = CdekRequest(client_id, client_secret, test_mode=test_mode)
+        _clients[key] = (secret_fp, client)
+    if entry:
+        _logger.info("CDEK: credentials changed for client %s, replacing pooled client", client_id)
+        entry[1].close()
+    return client
+
+
+def invalidate():
+    """Drop every pooled client of this worker (e.g. after a settings change)."""
+    with _lock:
+        stale = list(_clients.values())
+        _clients.clear()
+    for _fp, client in stale:
+        client.close()
+    if stale:
+        _logger.info("CDEK: dropped %s pooled client(s)", len(stale))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Geohash helpers backing the pickup point spatial queries.
+
+Points are indexed by a geohash string, so "points in this cell" becomes a
+btree-friendly prefix match (``geohash LIKE 'ucfv%'``) in PostgreSQL.
+"""
+import math
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+GEOHASH_PRECISION = 9
+
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    lat_lo, lat_hi, lon_lo, lon_hi = -90.0, 90.0, -180.0, 180.0
+    chars = []
+    bits = bit = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if lon >= mid:
+                bits = bits * 2 + 1
+                lon_lo = mid
+            else:
+                bits *= 2
+                lon_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                bits = bits * 2 + 1
+                lat_lo = mid
+            else:
+                bits *= 2
+                lat_hi = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(BASE32[bits])
+            bits = bit = 0
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """(height, width) in degrees of a geohash cell of ``precision`` characters."""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _wrap_lon(lon):
+    return (lon + 180.0) % 360.0 - 180.0
+
+
+def neighborhood(lat, lon, precision):
+    """The cell containing the point and its eight neighbours."""
+    height, width = cell_size(precision)
+    cells = set()
+    for dlat in (-height, 0.0, height):
+        for dlon in (-width, 0.0, width):
+            cell_lat = lat + dlat
+            if -90.0 <= cell_lat <= 90.0:
+                cells.add(geohash_encode(cell_lat, _wrap_lon(lon + dlon), precision))
+    return sorted(cells)
+
+
+def covered_radius_km(lat, precision):
+    """Radius around a point that :func:`neighborhood` is guaranteed to cover."""
+    height, width = cell_size(precision)
+    return min(height * KM_PER_DEGREE, width * KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+
+
+def split_bbox(south, west, north, east):
+    """Split a bbox crossing the antimeridian into boxes with west <= east."""
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def bbox_cover(south, west, north, east, max_cells=32):
+    """Geohash prefixes covering the bbox, as precise as ``max_cells`` allows."""
+    boxes = split_bbox(south, west, north, east)
+    best = [""]
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        height, width = cell_size(precision)
+        cells = set()
+        for b_south, b_west, b_north, b_east in boxes:
+            rows = int(math.floor((b_north + 90.0) / height) - math.floor((b_south + 90.0) / height)) + 1
+            cols = int(math.floor((b_east + 180.0) / width) - math.floor((b_west + 180.0) / width)) + 1
+            if len(cells) + rows * cols > max_cells:
+                return best
+            for row in range(rows):
+                cell_lat = min(b_south + row * height, b_north)
+                for col in range(cols):
+                    cell_lon = min(b_west + col * width, b_east)
+                    cells.add(geohash_encode(cell_lat, cell_lon, precision))
+        best = sorted(cells)
+    return best
+
+
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def lonlat_to_tile(lat, lon, zoom):
+    """Web Mercator (slippy map) tile containing the point."""
+    n = 2 ** zoom
+    lat = max(min(lat, MAX_MERCATOR_LAT), -MAX_MERCATOR_LAT)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bbox(x, y, zoom):
+    """(south, west, north, east) of a Web Mercator tile."""
+    n = 2 ** zoom
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+
+def tiles_for_bbox(south, west, north, east, zoom):
+    """Web Mercator tiles intersecting the bbox."""
+    tiles = []
+    for b_south, b_west, b_north, b_east in split_bbox(south, west, north, east):
+        x0, y0 = lonlat_to_tile(b_north, b_west, zoom)
+        x1, y1 = lonlat_to_tile(b_south, b_east, zoom)
+        tiles += [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+    return tiles
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""First-fit-decreasing packing of order lines into CDEK parcels.
+
+Pure Python: lines and boxes come in as plain tuples so results can be cached
+per order-line signature and reused by rating and order creation alike.
+"""
+from collections import namedtuple
+
+# Dimensions in cm, weights in grams; a box without volume limit only splits on weight
+Box = namedtuple('Box', 'name length width height max_weight_g')
+# One order line: ``key`` identifies it in the result, dimensions are per unit (0 = unknown)
+PackLine = namedtuple('PackLine', 'key qty weight_g length width height')
+
+
+def _volume(dims):
+    length, width, height = dims
+    return length * width * height
+
+
+def _fits(item_dims, box):
+    """Whether an item fits in a box in some orientation (sorted side by sorted side)."""
+    if not any(item_dims):
+        return True
+    box_dims = sorted((box.length, box.width, box.height))
+    return all(side <= limit for side, limit in zip(sorted(item_dims), box_dims))
+
+
+class _Parcel:
+    __slots__ = ('box', 'limit_volume', 'max_weight_g', 'weight_g', 'volume', 'items', 'max_dims')
+
+    def __init__(self, box, max_weight_g, limit_volume=True):
+        self.box = box
+        self.limit_volume = limit_volume
+        limits = [limit for limit in (max_weight_g, box.max_weight_g) if limit]
+        self.max_weight_g = min(limits) if limits else 0
+        self.weight_g = 0
+        self.volume = 0
+        self.items = {}
+        self.max_dims = (0, 0, 0)
+
+    def capacity(self, line, unit_volume):
+        """How many more units of ``line`` fit, by weight and by volume."""
+        if self.limit_volume and not _fits((line.length, line.width, line.height), self.box):
+            return 0
+        counts = []
+        if self.max_weight_g:
+            counts.append((self.max_weight_g - self.weight_g) // line.weight_g if line.weight_g else line.qty)
+        if self.limit_volume and unit_volume:
+            counts.append((_volume(self.box[1:4]) - self.volume) // unit_volume)
+        return max(0, min(counts)) if counts else line.qty
+
+    def add(self, line, unit_volume, qty):
+        self.items[line.key] = self.items.get(line.key, 0) + qty
+        self.weight_g += line.weight_g * qty
+        self.volume += unit_volume * qty
+        dims = sorted((line.length, line.width, line.height))
+        self.max_dims = tuple(max(a, b) for a, b in zip(self.max_dims, dims))
+
+
+def pack_lines(lines, boxes, max_weight_g, default_box):
+    """
+    Split order lines into parcels, largest units first, each unit going to the first parcel it fits in.
+    :param lines: iterable of PackLine
+    :param boxes: box catalogue (Box); when empty every parcel uses ``default_box`` and only weight splits
+    :param max_weight_g: CDEK weight limit per parcel (0 = no limit)
+    :return: list of dicts {'box': Box, 'weight_g': int, 'items': {line key: qty}}
+    """
+    boxes = sorted(boxes, key=lambda box: _volume(box[1:4]))
+    limit_volume = bool(boxes)
+    parcels = []
+    for line in sorted(lines, key=lambda l: (_volume((l.length, l.width, l.height)), l.weight_g), reverse=True):
+        unit_volume = _volume((line.length, line.width, line.height))
+        remaining = line.qty
+        for parcel in parcels:
+            if remaining <= 0:
+                break
+            qty = min(remaining, parcel.capacity(line, unit_volume))
+            if qty > 0:
+                parcel.add(line, unit_volume, qty)
+                remaining -= qty
+        while remaining > 0:
+            candidates = [box for box in boxes if _fits((line.length, line.width, line.height), box)]
+            if candidates:
+                # Open the largest box that fits; it is right-sized once everything is packed
+                parcel = _Parcel(candidates[-1], max_weight_g)
+            elif limit_volume:
+                # Oversized unit: ship it in its own dimensions
+                parcel = _Parcel(Box(None, line.length, line.width, line.height, 0), max_weight_g)
+            else:
+                parcel = _Parcel(default_box, max_weight_g, limit_volume=False)
+            # A unit heavier than the limit still travels, alone
+            qty = min(remaining, max(1, parcel.capacity(line, unit_volume)))
+            parcel.add(line, unit_volume, qty)
+            parcels.append(parcel)
+            remaining -= qty
+
+    result = []
+    for parcel in parcels:
+        box = parcel.box
+        if not limit_volume:
+            # Default box, grown to the largest item when an item does not fit in it
+            sides = sorted((box.length, box.width, box.height))
+            height, width, length = (max(a, b) for a, b in zip(sides, parcel.max_dims))
+            box = box._replace(length=length, width=width, height=height)
+        elif box.name is not None:
+            # Right-size: the smallest catalogue box that still holds the parcel
+            for candidate in boxes:
+                weight_ok = not candidate.max_weight_g or parcel.weight_g <= candidate.max_weight_g
+                if weight_ok and parcel.volume <= _volume(candidate[1:4]) \
+                        and _fits(parcel.max_dims, candidate):
+                    box = candidate
+                    break
+        result.append({'box': box, 'weight_g': parcel.weight_g, 'items': parcel.items})
+    return result
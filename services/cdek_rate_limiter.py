@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Token-bucket rate limiter shared by every worker and cron process of one server.
+
+The bucket lives in a small JSON file under the Odoo data directory, updated
+under an ``fcntl`` lock like the OAuth token store, so checkout workers, the
+tracking cron and the directory sync draw from one CDEK budget.
+
+Callers run in a priority class (see :func:`priority`). Lower classes leave a
+reserve of the bucket untouched, so checkout calls find a token at once while
+background jobs wait for the refill. A ``Retry-After`` answer blocks every
+class until the given time, and retries draw from a global retry budget earned
+by regular requests.
+
+Every grant takes the file lock and rewrites the few-byte file: a local
+syscall round trip per CDEK call, small next to the HTTP call itself, that
+keeps one exact budget across processes. Tokens are not leased per process in
+advance, which would let an idle worker sit on tokens checkout needs.
+"""
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+from odoo import _
+from odoo.tools import config
+
+from .cdek_resilience import CdekUnavailable
+from ..const import (
+    CDEK_RATE_LIMIT_PER_SECOND, CDEK_RATE_LIMIT_BURST, CDEK_RATE_LIMIT_RESERVES, CDEK_RATE_LIMIT_DEFAULT_PRIORITY,
+    CDEK_RATE_LIMIT_MAX_SLEEP_SECONDS, CDEK_RETRY_BUDGET_MAX, CDEK_RETRY_BUDGET_RATIO,
+)
+
+_logger = logging.getLogger(__name__)
+
+_priority = contextvars.ContextVar('cdek_priority', default=CDEK_RATE_LIMIT_DEFAULT_PRIORITY)
+
+_limiters_lock = threading.Lock()
+_limiters = {}
+
+
+@contextmanager
+def priority(level):
+    """Run the CDEK calls of the block in priority class ``level`` (interactive, warehouse, background)."""
+    if level not in CDEK_RATE_LIMIT_RESERVES:
+        raise ValueError(f"Unknown CDEK priority class: {level}")
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    """Priority class the CDEK calls of the current context run in."""
+    return _priority.get()
+
+
+def retry_after_seconds(resp):
+    """Delay requested by a ``Retry-After`` header (seconds or HTTP date), or None."""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_limiter(base_url, client_id):
+    """Return the process-wide :class:`RateLimiter` of a CDEK account."""
+    key = hashlib.sha256(f"{base_url}|{client_id}".encode()).hexdigest()[:32]
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = RateLimiter(key)
+        return limiter
+
+
+class RateLimiter:
+
+    def __init__(self, key, directory=None, rate=CDEK_RATE_LIMIT_PER_SECOND, burst=CDEK_RATE_LIMIT_BURST):
+        self.key = key
+        self.directory = directory or os.path.join(config['data_dir'], 'cdek_ratelimit')
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        # Only used without fcntl: the bucket is then per process
+        self._state = {}
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"{self.key}.json")
+
+    @contextmanager
+    def _shared_state(self):
+        """Yield the bucket state under an exclusive inter-process lock; it is written back on exit."""
+        with self._lock:
+            if fcntl is None:
+                yield self._state
+                return
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, "r+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state.get("updated", now))
+        state["tokens"] = min(self.burst, state.get("tokens", self.burst) + elapsed * self.rate)
+        state["updated"] = now
+        state.setdefault("retry_credit", CDEK_RETRY_BUDGET_MAX)
+
+    def acquire(self, expires_at=None):
+        """
+        Take one request token for the current priority class, sleeping until one is available.
+        :param expires_at: ``time.monotonic()`` deadline of the call; raises :class:`CdekUnavailable`
+            rather than waiting past it
+        """
+        level = current_priority()
+        floor = self.burst * CDEK_RATE_LIMIT_RESERVES[level]
+        while True:
+            with self._shared_state() as state:
+                now = time.time()
+                self._refill(state, now)
+                wait = state.get("blocked_until", 0.0) - now
+                if wait <= 0:
+                    if state["tokens"] - 1 >= floor:
+                        state["tokens"] -= 1
+                        state["retry_credit"] = min(CDEK_RETRY_BUDGET_MAX,
+                                                    state["retry_credit"] + CDEK_RETRY_BUDGET_RATIO)
+                        return
+                    wait = (floor + 1 - state["tokens"]) / self.rate
+            if expires_at is not None and time.monotonic() + wait >= expires_at:
+                _logger.info("CDEK rate limit: %s call dropped, no token within its deadline", level)
+                raise CdekUnavailable(_("CDEK request limit reached, please try again in a moment."))
+            time.sleep(min(wait, CDEK_RATE_LIMIT_MAX_SLEEP_SECONDS))
+
+    def block(self, seconds):
+        """Hold every caller back for ``seconds`` (a ``Retry-After`` from CDEK)."""
+        with self._shared_state() as state:
+            state["blocked_until"] = max(state.get("blocked_until", 0.0), time.time() + seconds)
+        _logger.warning("CDEK asked to retry after %ss, holding all requests back", round(seconds, 1))
+
+    def take_retry(self):
+        """Spend one unit of the global retry budget; False when retries are exhausted."""
+        with self._shared_state() as state:
+            self._refill(state, time.time())
+            if state["retry_credit"] < 1:
+                return False
+            state["retry_credit"] -= 1
+            return True
@@ -1,42 +1,108 @@
 # -*- coding: utf-8 -*-
+import copy
+import json
 import logging
+import tempfile
+import threading
+import time
 import requests
+import urllib3
 from functools import cached_property
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 from odoo import _
 from odoo.exceptions import UserError
-from ..const import CDEK_API_PROD_URL, CDEK_API_TEST_URL, CDEK_URLS, REQUEST_TIMEOUT_SECONDS
+from . import cdek_rate_limiter, cdek_resilience, cdek_singleflight, cdek_token_store
+from .cdek_resilience import CdekUnavailable
+from .cdek_stream import iter_json_array
+from ..const import (
+    CDEK_API_PROD_URL, CDEK_API_TEST_URL, CDEK_URLS, REQUEST_TIMEOUT_SECONDS,
+    CDEK_CONNECT_TIMEOUT_SECONDS, CDEK_ENDPOINT_DEADLINES, CDEK_RETRY_MAX_ATTEMPTS, CDEK_RETRY_BACKOFF_SECONDS,
+    CDEK_RETRY_STATUSES, CDEK_IDEMPOTENT_POSTS,
+    CDEK_POOL_CONNECTIONS, CDEK_POOL_MAXSIZE, STREAM_CHUNK_SIZE,
+    CDEK_PRINT_MAX_ORDERS, CDEK_PRINT_PAPER_FORMAT, CDEK_PRINT_POLL_INTERVAL_SECONDS, CDEK_PRINT_POLL_TIMEOUT_SECONDS,
+)
 
 _logger = logging.getLogger(__name__)
 
+
+def _is_connect_error(error):
+    """True when the request never reached CDEK, so even a non-idempotent call is safe to resend."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+def error_message(status_code, body):
+    """Human readable message of a failed CDEK answer, with the ``errors`` / ``requests[].errors`` CDEK reported."""
+    msg = _("CDEK API Error [%s]") % status_code
+    try:
+        err = json.loads(body)
+        details = err.get("errors") or \
+                  (err.get("requests") and err["requests"][0].get("errors"))
+        if isinstance(details, list):
+            msg += ": " + "; ".join(f"{d.get('code')}: {d.get('message')}" for d in details)
+        elif err.get("message"):
+            msg += ": " + err["message"]
+    except Exception:
+        msg += f": {(body or '')[:200]}"
+    return msg
+
+
 class CdekRequest:
 
     def __init__(self, client_id, client_secret, test_mode=False, debug_logger=None):
         if not client_id or not client_secret:
             raise ValueError("CDEK client_id and client_secret are required.")
-        self.base_url = (CDEK_API_TEST_URL if test_mode else CDEK_API_PROD_URL).rstrip("/") + "/"
+        self.base_url = self.get_base_url(test_mode)
         self.client_id = client_id
         self.client_secret = client_secret
         self.debug_logger = debug_logger
         self._session = None
-        self._access_token = None
+        self._session_lock = threading.Lock()
+        self._token_store = cdek_token_store.get_store(self.base_url, client_id, client_secret)
+        self._limiter = cdek_rate_limiter.get_limiter(self.base_url, client_id)
+
+    @staticmethod
+    def get_base_url(test_mode=False):
+        return (CDEK_API_TEST_URL if test_mode else CDEK_API_PROD_URL).rstrip("/") + "/"
 
     def _get_session(self):
         if self._session is None:
-            self._session = requests.Session()
-            retries = Retry(
-                total=3,
-                backoff_factor=0.5,
-                status_forcelist=[429, 500, 502, 503, 504],
-                allowed_methods=frozenset(["HEAD", "GET", "OPTIONS", "POST", "PUT", "DELETE"])
-            )
-            adapter = HTTPAdapter(max_retries=retries)
-            self._session.mount("https://", adapter)
-            self._session.mount("http://", adapter)
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    # Retries are driven by _request, within the deadline of each endpoint
+                    adapter = HTTPAdapter(
+                        pool_connections=CDEK_POOL_CONNECTIONS,
+                        pool_maxsize=CDEK_POOL_MAXSIZE,
+                        max_retries=0,
+                    )
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
         return self._session
 
-    def _fetch_token(self):
+    def with_debug_logger(self, debug_logger):
+        """Return a shallow copy sharing the pooled session, with its own debug logger."""
+        self._get_session()
+        clone = copy.copy(self)
+        clone.debug_logger = debug_logger
+        return clone
+
+    def close(self):
+        """Release the pooled connections of this client."""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _fetch_token(self, expires_at=None, breaker=None):
+        """
+        Fetch a new access token -> ``(token, expires_in)``, within the deadline of the call it serves.
+        Transport failures and 429/5xx answers raise :class:`CdekUnavailable` and count against ``breaker``
+        like any other call; a rejected authorization raises :class:`UserError`.
+        """
         url = self.base_url + CDEK_URLS["token"]
         payload = {
             "grant_type": "client_credentials",
@@ -44,98 +110,313 @@ class CdekRequest:
             "client_secret": self.client_secret,
         }
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        timeout = CDEK_ENDPOINT_DEADLINES.get("token", REQUEST_TIMEOUT_SECONDS)
+        if expires_at is not None:
+            timeout = min(timeout, expires_at - time.monotonic())
+            if timeout <= 0:
+                raise CdekUnavailable(_("CDEK authorization did not answer in time, please try again in a moment."))
         try:
             resp = self._get_session().post(url, data=payload,
                                             headers=headers,
-                                            timeout=REQUEST_TIMEOUT_SECONDS)
+                                            timeout=(min(CDEK_CONNECT_TIMEOUT_SECONDS, timeout), timeout))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if breaker:
+                breaker.record_failure()
+            _logger.error("CDEK Auth Error: %s", e)
+            raise CdekUnavailable(_("CDEK API unreachable: %s") % e)
+        if resp.status_code in CDEK_RETRY_STATUSES:
+            retry_after = cdek_rate_limiter.retry_after_seconds(resp)
+            if retry_after:
+                self._limiter.block(retry_after)
+            if breaker and resp.status_code != 429:
+                breaker.record_failure()
+            msg = error_message(resp.status_code, resp.text)
+            resp.close()
+            _logger.error("CDEK Auth Error: %s", msg)
+            raise CdekUnavailable(msg)
+        try:
             resp.raise_for_status()
             data = resp.json()
-            token = data.get("access_token")
-            if not token:
-                raise UserError(_("CDEK Auth Error: access_token missing in response."))
-            return token
-        except requests.exceptions.RequestException as e:
-            _logger.error("CDEK Auth Error: %s\nResponse: %s", e, getattr(e, "response", None) and e.response.text)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            _logger.error("CDEK Auth Error: %s\nResponse: %s", e, resp.text)
             raise UserError(_("CDEK Auth Error: failed to fetch token: %s") % e)
+        token = data.get("access_token")
+        if not token:
+            raise UserError(_("CDEK Auth Error: access_token missing in response."))
+        return token, int(data.get("expires_in") or 0)
 
-    def _get_token(self):
-        if not self._access_token:
-            self._access_token = self._fetch_token()
-        return self._access_token
+    def _get_token(self, expires_at=None, breaker=None):
+        return self._token_store.get_token(lambda: self._fetch_token(expires_at, breaker), expires_at=expires_at)
 
-    def _invalidate_token(self):
+    def _invalidate_token(self, token=None):
         _logger.info("CDEK: invalidating cached token")
-        self._access_token = None
+        self._token_store.invalidate(token)
 
-    def _request(self, method, endpoint_key, *, ep_params=None, query_params=None, json_payload=None, attempt=1):
+    def _request(self, method, endpoint_key, *, ep_params=None, query_params=None, json_payload=None,
+                 stream=False, accept="application/json", deadline=None, missing_ok=False):
+        """
+        Call a CDEK endpoint (see :meth:`_send`). Identical concurrent reads and calculator calls of this
+        worker are coalesced into one HTTP request whose answer they all share.
+        """
+        kwargs = dict(ep_params=ep_params, query_params=query_params, json_payload=json_payload,
+                      stream=stream, accept=accept, deadline=deadline, missing_ok=missing_ok)
+        if stream or not (method == "GET" or endpoint_key in CDEK_IDEMPOTENT_POSTS):
+            return self._send(method, endpoint_key, **kwargs)
+        key = cdek_singleflight.request_key(self, method, endpoint_key, ep_params, query_params, json_payload)
+        # Followers wait for the leader no longer than their own deadline
+        timeout = deadline or CDEK_ENDPOINT_DEADLINES.get(endpoint_key, REQUEST_TIMEOUT_SECONDS)
+        return cdek_singleflight.flights.do(key, lambda: self._send(method, endpoint_key, **kwargs), timeout=timeout)
+
+    def _send(self, method, endpoint_key, *, ep_params=None, query_params=None, json_payload=None,
+              stream=False, accept="application/json", deadline=None, missing_ok=False):
+        """
+        Send one call to a CDEK endpoint; with ``stream=True`` the open response is returned unread.
+        Every attempt shares the endpoint deadline (CDEK_ENDPOINT_DEADLINES, or ``deadline`` seconds), waits for
+        the shared rate limiter in the caller's priority class and goes through the worker's circuit breaker of
+        the endpoint class; transport failures raise :class:`CdekUnavailable`.
+        With ``missing_ok=True`` a 404 answer returns None instead of raising.
+        """
         if endpoint_key not in CDEK_URLS:
             raise ValueError(f"Unknown endpoint key: {endpoint_key}")
 
-        token = self._get_token()
         url = self.base_url + CDEK_URLS[endpoint_key].format(**(ep_params or {}))
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
+        deadline = deadline or CDEK_ENDPOINT_DEADLINES.get(endpoint_key, REQUEST_TIMEOUT_SECONDS)
+        expires_at = time.monotonic() + deadline
+        retry_transient = method != "POST" or endpoint_key in CDEK_IDEMPOTENT_POSTS
+        breaker = cdek_resilience.get_breaker(self.base_url, endpoint_key)
+        token_refreshed = False
+        attempt = 0
+        while True:
+            attempt += 1
+            # An open circuit fails fast, without waiting for a rate limiter token it would waste
+            breaker.before_call()
+            self._limiter.acquire(expires_at)
+            # The token call goes through the circuit and the deadline of the call it serves
+            token = self._get_token(expires_at, breaker)
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                raise CdekUnavailable(_("CDEK API did not answer within %s seconds.") % deadline)
+            headers = {
+                "Authorization": f"Bearer {token}",
+                "Accept": accept,
+                "Content-Type": "application/json",
+            }
+            try:
+                resp = self._get_session().request(
+                    method, url,
+                    params=query_params,
+                    json=json_payload,
+                    headers=headers,
+                    timeout=(min(CDEK_CONNECT_TIMEOUT_SECONDS, remaining), remaining),
+                    stream=stream,
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                breaker.record_failure()
+                if (retry_transient or _is_connect_error(e)) and self._retry_wait(attempt, expires_at):
+                    _logger.info("CDEK %s %s failed (attempt %s), retrying: %s", method, endpoint_key, attempt, e)
+                    continue
+                _logger.error("CDEK %s %s failed after %s attempt(s): %s", method, endpoint_key, attempt, e)
+                raise CdekUnavailable(_("CDEK API unreachable: %s") % e)
+
+            if resp.status_code == 401 and not token_refreshed:
+                breaker.record_success()
+                resp.close()
+                self._invalidate_token(token)
+                token_refreshed = True
+                attempt -= 1
+                continue
+
+            if resp.status_code in CDEK_RETRY_STATUSES:
+                retry_after = cdek_rate_limiter.retry_after_seconds(resp)
+                if retry_after:
+                    self._limiter.block(retry_after)
+                if resp.status_code != 429:
+                    # Throttling is not an outage: only the limiter reacts to it
+                    breaker.record_failure()
+                msg = error_message(resp.status_code, resp.text)
+                resp.close()
+                if retry_transient and self._retry_wait(attempt, expires_at, min_delay=retry_after or 0):
+                    _logger.info("CDEK %s %s answered %s (attempt %s), retrying",
+                                 method, endpoint_key, resp.status_code, attempt)
+                    continue
+                _logger.error("CDEK HTTPError: %s", msg)
+                raise CdekUnavailable(msg)
 
-        resp = self._get_session().request(
-            method, url,
-            params=query_params,
-            json=json_payload,
-            headers=headers,
-            timeout=REQUEST_TIMEOUT_SECONDS,
-        )
-
-        if resp.status_code == 401 and attempt == 1:
-            self._invalidate_token()
-            return self._request(method, endpoint_key,
-                                 ep_params=ep_params,
-                                 query_params=query_params,
-                                 json_payload=json_payload,
-                                 attempt=2)
+            breaker.record_success()
+            break
+
+        if missing_ok and resp.status_code == 404:
+            resp.close()
+            return None
 
         try:
             resp.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            msg = _("CDEK API Error [%s]") % resp.status_code
-            try:
-                err = resp.json()
-                details = err.get("errors") or \
-                          (err.get("requests") and err["requests"][0].get("errors"))
-                if isinstance(details, list):
-                    msg += ": " + "; ".join(f"{d.get('code')}: {d.get('message')}" for d in details)
-                elif err.get("message"):
-                    msg += ": " + err["message"]
-            except Exception:
-                msg += f": {resp.text[:200]}"
+        except requests.exceptions.HTTPError:
+            msg = error_message(resp.status_code, resp.text)
             _logger.error("CDEK HTTPError: %s", msg)
             raise UserError(msg)
 
+        if stream:
+            return resp
+
         ctype = resp.headers.get("Content-Type", "")
         if "application/json" in ctype:
             return resp.json()
         return resp.content 
 
+    def _retry_delay(self, attempt, expires_at, min_delay=0):
+        """
+        Delay before the next attempt, or None when the attempts, the deadline or the global retry budget
+        are used up. ``min_delay`` is the ``Retry-After`` asked by CDEK.
+        """
+        if attempt >= CDEK_RETRY_MAX_ATTEMPTS:
+            return None
+        delay = max(CDEK_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1), min_delay)
+        # Keep at least one connect timeout of the deadline for the attempt itself
+        if time.monotonic() + delay + CDEK_CONNECT_TIMEOUT_SECONDS >= expires_at:
+            return None
+        if not self._limiter.take_retry():
+            _logger.warning("CDEK retry budget exhausted, not retrying")
+            return None
+        return delay
+
+    def _retry_wait(self, attempt, expires_at, min_delay=0):
+        """Sleep before the next attempt; False when no retry is allowed (see :meth:`_retry_delay`)."""
+        delay = self._retry_delay(attempt, expires_at, min_delay=min_delay)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    def download(self, endpoint_key, *, ep_params=None, query_params=None, dest=None, accept="*/*"):
+        """
+        Stream a binary response chunk by chunk into ``dest`` (a new temporary file by default).
+        :return: the file object, rewound; the caller closes it
+        """
+        fileobj = dest if dest is not None else tempfile.TemporaryFile()
+        try:
+            with self._request("GET", endpoint_key, ep_params=ep_params, query_params=query_params,
+                               stream=True, accept=accept) as resp:
+                for chunk in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    fileobj.write(chunk)
+        except Exception:
+            if dest is None:
+                fileobj.close()
+            raise
+        fileobj.seek(0)
+        return fileobj
+
     def get_cities(self, **params):
         return self._request("GET", "location_cities", query_params=params)
 
+    def iter_cities(self, **params):
+        """Yield cities one by one while the response is still downloading (directory sync, loose deadline)."""
+        with self._request("GET", "location_cities", query_params=params, stream=True,
+                           deadline=REQUEST_TIMEOUT_SECONDS) as resp:
+            yield from iter_json_array(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+
     def get_delivery_points(self, **params):
         return self._request("GET", "delivery_points", query_params=params)
 
+    def iter_delivery_points(self, **params):
+        """Yield delivery points one by one while the response is still downloading."""
+        with self._request("GET", "delivery_points", query_params=params, stream=True,
+                           deadline=REQUEST_TIMEOUT_SECONDS) as resp:
+            yield from iter_json_array(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+
     def calculate_tariff(self, payload):
         return self._request("POST", "calculator_tariff", json_payload=payload)
 
+    def calculate_tariff_list(self, payload):
+        return self._request("POST", "calculator_tarifflist", json_payload=payload)
+
     def create_order(self, payload):
         return self._request("POST", "orders", json_payload=payload)
 
+    def find_order_by_number(self, number):
+        """Order info of the order registered under this shop order number, or None if CDEK has none."""
+        response = self._request("GET", "orders", query_params={"im_number": number}, missing_ok=True)
+        if not isinstance(response, dict) or not (response.get("entity") or {}).get("uuid"):
+            return None
+        return response
+
+    def create_order_idempotent(self, payload, lookup_first=False):
+        """
+        Register an order using its ``number`` as idempotency key: before every new attempt the order is
+        looked up by number, so a POST that timed out but reached CDEK is never registered twice.
+        :param lookup_first: look the order up before the first POST too (retried or reconciled job)
+        """
+        number = payload["number"]
+        attempt = 0
+        while True:
+            attempt += 1
+            if lookup_first or attempt > 1:
+                existing = self.find_order_by_number(number)
+                if existing:
+                    _logger.info("CDEK: order %s already registered, not sending it again", number)
+                    return existing
+            try:
+                return self.create_order(payload)
+            except CdekUnavailable as e:
+                if isinstance(e, cdek_resilience.CdekCircuitOpen) or attempt >= CDEK_RETRY_MAX_ATTEMPTS \
+                        or not self._limiter.take_retry():
+                    raise
+                _logger.info("CDEK: registration of %s failed (attempt %s), checking before retrying: %s",
+                             number, attempt, e)
+                time.sleep(CDEK_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
     def get_order_info(self, uuid):
         return self._request("GET", "order_by_uuid", ep_params={"uuid": uuid})
 
     def cancel_order(self, uuid):
         return self._request("DELETE", "order_cancel", ep_params={"uuid": uuid})
 
-    def get_label(self, uuid, fmt="pdf"):
-        return self._request("GET", "print_barcodes",
-                             ep_params={"uuid": uuid},
-                             query_params={"format": fmt})
+    def list_webhooks(self):
+        return self._request("GET", "webhooks")
+
+    def register_webhook(self, url, event_type):
+        return self._request("POST", "webhooks", json_payload={"url": url, "type": event_type})
+
+    def delete_webhook(self, uuid):
+        return self._request("DELETE", "webhook_by_uuid", ep_params={"uuid": uuid})
+
+    def create_barcode_job(self, order_uuids, copy_count=1, paper_format=CDEK_PRINT_PAPER_FORMAT):
+        """Start a label print job for up to CDEK_PRINT_MAX_ORDERS orders; returns the job UUID."""
+        if len(order_uuids) > CDEK_PRINT_MAX_ORDERS:
+            raise ValueError(f"CDEK prints at most {CDEK_PRINT_MAX_ORDERS} orders per job.")
+        payload = {
+            "orders": [{"order_uuid": uuid} for uuid in order_uuids],
+            "copy_count": copy_count,
+            "format": paper_format,
+        }
+        response = self._request("POST", "print_barcodes", json_payload=payload)
+        job_uuid = (response.get("entity") or {}).get("uuid")
+        if not job_uuid:
+            raise UserError(_("CDEK did not accept the label print job: %s") % response)
+        return job_uuid
+
+    def get_barcode_job(self, job_uuid):
+        return self._request("GET", "print_barcodes_job", ep_params={"uuid": job_uuid})
+
+    def wait_barcode_job(self, job_uuid, timeout=CDEK_PRINT_POLL_TIMEOUT_SECONDS):
+        """Poll a label print job until CDEK reports it READY."""
+        deadline = time.monotonic() + timeout
+        while True:
+            entity = self.get_barcode_job(job_uuid).get("entity") or {}
+            codes = [status.get("code") for status in entity.get("statuses") or []]
+            if "READY" in codes:
+                return entity
+            if "INVALID" in codes or "REMOVED" in codes:
+                raise UserError(_("CDEK label print job %s failed: %s") % (job_uuid, codes[-1]))
+            if time.monotonic() >= deadline:
+                raise UserError(_("CDEK label print job %s is not ready after %s seconds.") % (job_uuid, timeout))
+            time.sleep(CDEK_PRINT_POLL_INTERVAL_SECONDS)
+
+    def get_barcode_pdf(self, job_uuid, dest=None):
+        return self.download("print_barcodes_pdf", ep_params={"uuid": job_uuid}, dest=dest, accept="application/pdf")
+
+    def fetch_barcodes(self, order_uuids, copy_count=1, dest=None):
+        """Create a label print job for the orders, wait for it and stream the merged PDF to a file."""
+        job_uuid = self.create_barcode_job(order_uuids, copy_count=copy_count)
+        self.wait_barcode_job(job_uuid)
+        return self.get_barcode_pdf(job_uuid, dest=dest)
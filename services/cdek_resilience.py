@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Circuit breakers shared by every CDEK client of one worker.
+
+After ``CDEK_CIRCUIT_FAILURE_THRESHOLD`` consecutive transport failures
+(timeouts, refused connections, 429/5xx answers) the circuit opens and calls
+fail immediately instead of tying up a worker until their deadline. Once
+``CDEK_CIRCUIT_RESET_SECONDS`` have passed a single probe call is let through;
+its outcome closes the circuit or keeps it open for another period.
+
+Checkout calls (``CDEK_CIRCUIT_INTERACTIVE_ENDPOINTS``) and background calls
+have separate circuits, so a failing bulk sync does not fail checkout fast.
+The state is per worker process: each worker detects an outage by itself.
+"""
+import logging
+import threading
+import time
+
+from odoo import _
+from odoo.exceptions import UserError
+
+from ..const import CDEK_CIRCUIT_FAILURE_THRESHOLD, CDEK_CIRCUIT_RESET_SECONDS, CDEK_CIRCUIT_INTERACTIVE_ENDPOINTS
+
+_logger = logging.getLogger(__name__)
+
+_breakers_lock = threading.Lock()
+_breakers = {}
+
+
+class CdekUnavailable(UserError):
+    """CDEK did not answer usefully: transport failure, overload, or open circuit."""
+
+
+class CdekCircuitOpen(CdekUnavailable):
+    """Call refused without reaching CDEK because the circuit is open."""
+
+
+def endpoint_class(endpoint_key):
+    """Circuit class of an endpoint: ``interactive`` for the checkout calls, ``background`` otherwise."""
+    return "interactive" if endpoint_key in CDEK_CIRCUIT_INTERACTIVE_ENDPOINTS else "background"
+
+
+def get_breaker(base_url, endpoint_key=None):
+    """Return the process-wide :class:`CircuitBreaker` of a CDEK environment for the class of ``endpoint_key``."""
+    key = (base_url, endpoint_class(endpoint_key))
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker("%s (%s)" % key)
+        return breaker
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=CDEK_CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CDEK_CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def before_call(self):
+        """Raise :class:`CdekCircuitOpen` unless the call may go through (closed circuit or probe)."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_seconds:
+                raise CdekCircuitOpen(_("CDEK is temporarily unavailable, please try again in a moment."))
+            # Let this call probe CDEK; everybody else keeps failing fast until the next period
+            self._opened_at = now
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                _logger.info("CDEK circuit %s closed", self.name)
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    _logger.warning("CDEK circuit %s opened after %s consecutive failures", self.name, self._failures)
+                self._opened_at = time.monotonic()
+
+    def reset(self):
+        self.record_success()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Single-flight coalescing of identical concurrent CDEK calls inside one worker.
+
+When many shoppers of the same city open the pickup point widget or ask for
+the same quote at once, only the first call goes to CDEK; the others wait for
+it and get a copy of its answer (or its exception). A follower waits no longer
+than its own deadline, so a stuck leader cannot hold the others past theirs.
+Calls of different priority classes never share a flight: a checkout call
+must not wait behind a background leader queued at the rate limiter.
+"""
+import copy
+import threading
+
+from odoo import _
+
+from . import cdek_rate_limiter
+from .cdek_cache import payload_key
+from .cdek_resilience import CdekUnavailable
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func, timeout=None):
+        """
+        Return ``func()``, or the result of the identical call already in flight under ``key``.
+        :param timeout: seconds a follower waits for that call before raising :class:`CdekUnavailable`
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise CdekUnavailable(_("CDEK API did not answer within %s seconds.") % timeout)
+            if call.error is not None:
+                raise call.error
+            # Followers get their own copy: callers are free to alter the decoded JSON
+            return copy.deepcopy(call.result)
+
+        result = None
+        try:
+            result = func()
+            return result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                waiters = call.waiters
+            if waiters and call.error is None:
+                # Snapshot before anybody, the leader included, can alter the answer
+                call.result = copy.deepcopy(result)
+            call.done.set()
+
+
+def request_key(client, method, endpoint_key, ep_params=None, query_params=None, json_payload=None):
+    """
+    Canonical key of a call: account, priority class of the caller, method, endpoint and parameters
+    (dict order does not matter).
+    """
+    return payload_key(client.base_url, client.client_id, cdek_rate_limiter.current_priority(),
+                       method, endpoint_key, ep_params, query_params, json_payload)
+
+
+flights = SingleFlight()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Helpers to consume large CDEK responses without materializing them."""
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_SEPARATORS = " \t\r\n,"
+
+
+def iter_json_array(chunks, encoding="utf-8"):
+    """Yield the elements of a top-level JSON array read from byte ``chunks``.
+
+    Only the current partial element is buffered, so a response with tens of
+    thousands of objects is parsed with roughly one element of extra memory.
+    """
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    buf = ""
+    pos = 0
+    started = False
+    exhausted = False
+    chunks = iter(chunks)
+    while True:
+        if not exhausted:
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+                buf = buf[pos:] + text_decoder.decode(b"", final=True)
+            else:
+                buf = buf[pos:] + text_decoder.decode(chunk)
+            pos = 0
+        if not started:
+            stripped = buf.lstrip()
+            if not stripped:
+                if exhausted:
+                    return
+                continue
+            if stripped[0] != "[":
+                raise ValueError("Expected a JSON array, got %r" % stripped[:50])
+            buf = stripped[1:]
+            started = True
+        while True:
+            while pos < len(buf) and buf[pos] in _SEPARATORS:
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = _decoder.raw_decode(buf, pos)
+            except ValueError:
+                if exhausted:
+                    raise
+                break
+            if end == len(buf) and not exhausted:
+                break  # a number may continue in the next chunk
+            pos = end
+            yield item
+        if exhausted:
+            raise ValueError("Unterminated JSON array")
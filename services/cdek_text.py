@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""Search-key normalization for the local CDEK city directory."""
+import re
+
+from unidecode import unidecode
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_search_text(text):
+    """Case-folded, ё/е-folded, punctuation-free key: 'Ростов-на-Дону' -> 'ростов на дону'."""
+    text = (text or "").casefold().replace("ё", "е")
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def transliterate_search_text(text):
+    """Latin key of the same text: 'Ростов-на-Дону' -> 'rostov na donu'."""
+    return normalize_search_text(unidecode(normalize_search_text(text)))
+
+
+def like_prefix(text):
+    """LIKE pattern matching ``text`` as a literal prefix."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
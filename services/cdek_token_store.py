@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""OAuth token cache shared by every worker and cron process of one server.
+
+The token lives in memory for the fast path and in a small JSON file under the
+Odoo data directory, guarded by an ``fcntl`` lock, so HTTP workers and the
+tracking cron reuse the same token and only one process refreshes it. The
+lock is polled, so a caller waiting for another process' refresh gives up at
+its own deadline instead of queueing behind every slow refresh in turn.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+from odoo import _
+from odoo.tools import config
+
+from .cdek_resilience import CdekUnavailable
+from ..const import (
+    CDEK_TOKEN_DEFAULT_TTL_SECONDS, CDEK_TOKEN_EXPIRY_MARGIN_SECONDS, CDEK_TOKEN_REFRESH_AHEAD_SECONDS,
+    CDEK_TOKEN_LOCK_TIMEOUT_SECONDS, CDEK_TOKEN_LOCK_POLL_SECONDS,
+)
+
+_logger = logging.getLogger(__name__)
+
+_stores_lock = threading.Lock()
+_stores = {}
+
+
+def get_store(base_url, client_id, client_secret):
+    """Return the process-wide :class:`TokenStore` for these credentials."""
+    key = hashlib.sha256(f"{base_url}|{client_id}|{client_secret}".encode()).hexdigest()[:32]
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = TokenStore(key)
+        return store
+
+
+class TokenStore:
+
+    def __init__(self, key, directory=None):
+        self.key = key
+        self.directory = directory or os.path.join(config['data_dir'], 'cdek_tokens')
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f"{self.key}.json")
+
+    @contextmanager
+    def _file_lock(self, timeout):
+        """Exclusive inter-process lock, polled for ``timeout`` seconds; yields False if it was not taken."""
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        with open(self.path + ".lock", "a") as lock_file:
+            give_up_at = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    left = give_up_at - time.monotonic()
+                    if left <= 0:
+                        yield False
+                        return
+                    time.sleep(min(CDEK_TOKEN_LOCK_POLL_SECONDS, left))
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_file(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data.get("access_token"), float(data.get("expires_at") or 0)
+        except (OSError, ValueError):
+            return None, 0.0
+
+    def _write_file(self, token, expires_at):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"access_token": token, "expires_at": expires_at}, f)
+        os.replace(tmp_path, self.path)
+
+    def _remaining(self, now):
+        return self._expires_at - now if self._token else 0.0
+
+    @staticmethod
+    def _timeout(expires_at):
+        if expires_at is None:
+            return CDEK_TOKEN_LOCK_TIMEOUT_SECONDS
+        return max(0.0, expires_at - time.monotonic())
+
+    def _adopt_file(self, threshold):
+        """Take over the token of the shared file if it is valid for more than ``threshold`` seconds."""
+        token, expires_at = self._read_file()
+        if token and expires_at - time.time() > threshold:
+            self._token, self._expires_at = token, expires_at
+            return True
+        return False
+
+    def get_token(self, fetch, expires_at=None):
+        """Return a valid token, calling ``fetch()`` -> ``(token, expires_in)`` only when needed.
+
+        Inside the refresh-ahead window the current token is still handed out
+        while one caller refreshes it; past the expiry margin everybody waits
+        for the refresh, but no longer than the caller's deadline.
+        :param expires_at: ``time.monotonic()`` deadline of the call; raises :class:`CdekUnavailable`
+            when another refresh holds the lock past it
+        """
+        remaining = self._remaining(time.time())
+        if remaining > CDEK_TOKEN_REFRESH_AHEAD_SECONDS:
+            return self._token
+        if remaining > CDEK_TOKEN_EXPIRY_MARGIN_SECONDS:
+            if not self._lock.acquire(blocking=False):
+                return self._token
+            try:
+                with self._file_lock(0) as locked:
+                    if locked:
+                        self._refresh(fetch, ahead=True)
+            except Exception as e:
+                _logger.warning("CDEK: proactive token refresh failed, keeping current token: %s", e)
+            finally:
+                self._lock.release()
+            return self._token
+
+        if not self._lock.acquire(timeout=self._timeout(expires_at)):
+            raise CdekUnavailable(_("CDEK authorization is taking too long, please try again in a moment."))
+        try:
+            if self._remaining(time.time()) > CDEK_TOKEN_EXPIRY_MARGIN_SECONDS:
+                return self._token
+            with self._file_lock(self._timeout(expires_at)) as locked:
+                if locked:
+                    self._refresh(fetch)
+                elif not self._adopt_file(CDEK_TOKEN_EXPIRY_MARGIN_SECONDS):
+                    _logger.warning("CDEK: gave up waiting for another process' token refresh")
+                    raise CdekUnavailable(_("CDEK authorization is taking too long, please try again in a moment."))
+            return self._token
+        finally:
+            self._lock.release()
+
+    def _refresh(self, fetch, ahead=False):
+        """Adopt a fresher token written by another process, or fetch a new one."""
+        if self._adopt_file(CDEK_TOKEN_REFRESH_AHEAD_SECONDS if ahead else CDEK_TOKEN_EXPIRY_MARGIN_SECONDS):
+            return
+        now = time.time()
+        token, expires_in = fetch()
+        expires_at = now + (expires_in or CDEK_TOKEN_DEFAULT_TTL_SECONDS)
+        try:
+            self._write_file(token, expires_at)
+        except OSError as e:
+            _logger.warning("CDEK: cannot persist OAuth token to %s: %s", self.path, e)
+        self._token, self._expires_at = token, expires_at
+        _logger.info("CDEK: fetched new OAuth token (expires in %ss)", int(expires_at - now))
+
+    def invalidate(self, token=None):
+        """
+        Forget ``token`` (or the current one) here and in the shared file.
+        When another process holds the file lock it is refreshing, and overwrites the file anyway.
+        """
+        with self._lock:
+            if token is None or token == self._token:
+                self._token, self._expires_at = None, 0.0
+            with self._file_lock(CDEK_TOKEN_LOCK_POLL_SECONDS) as locked:
+                if not locked:
+                    return
+                stored, _expires_at = self._read_file()
+                if stored and (token is None or stored == token):
+                    try:
+                        os.remove(self.path)
+                    except OSError:
+                        pass
@@ -3,10 +3,14 @@
 import { Component, useState, onWillStart, onMounted, useRef } from "@odoo/owl";
 import { registry } from "@web/core/registry";
 import { useService } from "@web/core/utils/hooks";
+import { debounce } from "@web/core/utils/timing";
 import { CityAutocompleteInput } from "./components/city_autocomplete_input";
 import { PvzList } from "./components/pvz_list";
 import { PvzMap } from "./components/pvz_map"; // Предполагается, что PvzMap будет реализован
 
+// Ниже этого масштаба карта получает с сервера кластеры вместо отдельных ПВЗ
+const CLUSTER_MAX_ZOOM = 11;
+
 export class CdekPvzSelector extends Component {
     static template = "cdek_odooAPI2.CdekPvzSelector"; // Ссылка на XML-шаблон компонента
     static components = { CityAutocompleteInput, PvzList, PvzMap };
@@ -20,6 +24,7 @@ export class CdekPvzSelector extends Component {
             carrierId: this.props.carrierId,
             selectedCity: null, // { code: '123', city: 'Москва', ... }
             availablePvz: [], // Список ПВЗ от API
+            pvzClusters: [], // Кластеры ПВЗ для мелкого масштаба карты
             selectedPvz: null, // { code: 'PVZ_MSK1', name: '...', address: '...' }
             isLoadingCities: false,
             isLoadingPvz: false,
@@ -30,6 +35,8 @@ export class CdekPvzSelector extends Component {
         });
 
         this.pvzMapRef = useRef("pvzMapRef"); // Для доступа к компоненту карты
+        this.pendingPreselectPvzCode = null; // Код ПВЗ для выделения после загрузки видимой области
+        this.debouncedLoadViewport = debounce(this.loadViewportPvz, 250);
 
         onWillStart(async () => {
             // Загрузка ключа Яндекс.Карт (если используется)
@@ -92,6 +99,12 @@ export class CdekPvzSelector extends Component {
 
         if (!city || !city.code) return;
 
+        if (this.state.yandexApiKey) {
+            // С картой ПВЗ грузятся по видимой области (см. onMapBoundsChange)
+            this.pendingPreselectPvzCode = preselectPvzCode;
+            return;
+        }
+
         this.state.isLoadingPvz = true;
         try {
             const pvzList = await this.rpc("/cdek/pvz/search", {
@@ -179,6 +192,43 @@ export class CdekPvzSelector extends Component {
         );
     }
 
+    onMapBoundsChange({ bbox, zoom }) {
+        this.debouncedLoadViewport(bbox, zoom);
+    }
+
+    async loadViewportPvz(bbox, zoom) {
+        this.state.isLoadingPvz = true;
+        try {
+            if (zoom < CLUSTER_MAX_ZOOM) {
+                const clusters = await this.rpc("/cdek/pvz/clusters", { bbox, zoom });
+                if (clusters && !clusters.error) {
+                    this.state.pvzClusters = clusters;
+                    this.state.availablePvz = [];
+                }
+                return;
+            }
+            this.state.pvzClusters = [];
+            const pvzList = await this.rpc("/cdek/pvz/viewport", { bbox, limit: 500 });
+            if (pvzList && !pvzList.error) {
+                this.state.availablePvz = pvzList;
+                if (this.pendingPreselectPvzCode) {
+                    const foundPvz = pvzList.find(p => p.code === this.pendingPreselectPvzCode);
+                    if (foundPvz) {
+                        this.state.selectedPvz = foundPvz;
+                        this.pendingPreselectPvzCode = null;
+                    }
+                }
+            } else if (pvzList && pvzList.error) {
+                this.notification.add(pvzList.message, { type: 'danger' });
+            }
+        } catch (error) {
+            this.notification.add(this.env._t("Error fetching pickup points."), { type: 'danger' });
+            console.error("CDEK PVZ Viewport Error:", error);
+        } finally {
+            this.state.isLoadingPvz = false;
+        }
+    }
+
     // Для карты
     onMapReady() {
         this.state.mapInitialized = true;
@@ -13,9 +13,15 @@ export class PvzMap extends Component {
         yandexApiKey: { type: String, optional: false },
         city: { type: Object, optional: true },      // { code, city, region, country_code, country, lat, lon }
         pvzList: { type: Array, optional: false, default: () => [] },
+        // Серверные кластеры { count, lat, lon, bbox, code } для мелких масштабов
+        clusters: { type: Array, optional: true },
         selectedPvz: { type: Object, optional: true }, // Выбранный ПВЗ для выделения/центрирования
         onMapReady: { type: Function, optional: true },
         onPvzSelectedFromMap: { type: Function, optional: true },
+        // Вызывается с { bbox: [south, west, north, east], zoom } после каждого сдвига/зума карты
+        onBoundsChange: { type: Function, optional: true },
+        // false - не подгонять карту под метки (точки грузятся по видимой области)
+        autoFit: { type: Boolean, optional: true, default: true },
         // Дополнительные props для управления картой, если нужно
         initialZoom: { type: Number, default: 12 },
         pvzMarkerPreset: { type: String, default: "islands#blueRapidTransitIcon" }, // Или 'islands#blueDotIcon' / 'islands#blueDeliveryIcon'
@@ -27,6 +33,7 @@ export class PvzMap extends Component {
         this.yandexMap = null;        // Инстанс карты Яндекса (window.ymaps.Map)
         this.placemarkManager = null; // Менеджер объектов для меток (window.ymaps.ObjectManager или GeoObjectCollection)
         this.isApiLoading = false;    // Флаг, что API карт в процессе загрузки
+        this.lastCenteredCityCode = null; // Город, на котором карта уже центрировалась (режим autoFit=false)
 
         this.state = useState({
             mapInitialized: false,
@@ -46,13 +53,21 @@ export class PvzMap extends Component {
                     this._updatePlacemarks();
                 }
             },
-            () => [this.props.pvzList, this.props.selectedPvz, this.state.mapInitialized]
+            () => [this.props.pvzList, this.props.clusters, this.props.selectedPvz, this.state.mapInitialized]
         );
 
         // Перецентрирование карты при смене города или при первой загрузке с городом
         useEffect(
             () => {
                 if (this.state.mapInitialized && this.props.city) {
+                    if (!this._isAutoFit()) {
+                        // Точки грузятся по видимой области: центрируемся только при смене города
+                        if (this.lastCenteredCityCode !== this.props.city.code) {
+                            this.lastCenteredCityCode = this.props.city.code;
+                            this._recenterMapOnCity();
+                        }
+                        return;
+                    }
                     // Если список ПВЗ пуст, центрируемся на городе.
                     // Если ПВЗ есть, _updatePlacemarks позаботится о границах.
                     if (!this.props.pvzList || this.props.pvzList.length === 0) {
@@ -129,10 +144,22 @@ export class PvzMap extends Component {
 
             this.yandexMap.geoObjects.add(this.placemarkManager);
 
+            // Сообщаем родителю видимую область, чтобы он подгружал только видимые ПВЗ
+            this.yandexMap.events.add('boundschange', () => this._notifyBoundsChange());
+
             // Обработчик клика по метке в ObjectManager
             this.placemarkManager.objects.events.add('click', (e) => {
                 const objectId = e.get('objectId');
                 const clickedObject = this.placemarkManager.objects.getById(objectId);
+                if (clickedObject && clickedObject.properties && clickedObject.properties.clusterData) {
+                    // Клик по серверному кластеру - приближаемся к его границам
+                    const [south, west, north, east] = clickedObject.properties.clusterData.bbox;
+                    this.yandexMap.setBounds([[south, west], [north, east]], {
+                        checkZoomRange: true,
+                        zoomMargin: 35,
+                    }).catch(err => console.warn("Map setBounds (cluster) error:", err));
+                    return;
+                }
                 if (clickedObject && clickedObject.properties && clickedObject.properties.pvzData) {
                     if (this.props.onPvzSelectedFromMap) {
                         this.props.onPvzSelectedFromMap({ detail: clickedObject.properties.pvzData });
@@ -156,6 +183,7 @@ export class PvzMap extends Component {
             }
             // Сразу обновляем метки, если pvzList уже передан
             this._updatePlacemarks();
+            this._notifyBoundsChange();
 
         } catch (error) {
             console.error("Error initializing Yandex Map instance:", error);
@@ -164,6 +192,24 @@ export class PvzMap extends Component {
         }
     }
 
+    _isAutoFit() {
+        return this.props.autoFit !== false;
+    }
+
+    _notifyBoundsChange() {
+        if (!this.yandexMap || !this.props.onBoundsChange) {
+            return;
+        }
+        const bounds = this.yandexMap.getBounds(); // [[south, west], [north, east]]
+        if (!bounds) {
+            return;
+        }
+        this.props.onBoundsChange({
+            bbox: [bounds[0][0], bounds[0][1], bounds[1][0], bounds[1][1]],
+            zoom: this.yandexMap.getZoom(),
+        });
+    }
+
     _getInitialMapCenter() {
         if (this.props.city && this.props.city.lat && this.props.city.lon) {
             return [parseFloat(this.props.city.lat), parseFloat(this.props.city.lon)];
@@ -224,6 +270,20 @@ export class PvzMap extends Component {
             };
         }).filter(feature => feature !== null); // Удаляем ПВЗ без координат
 
+        (this.props.clusters || []).forEach((cluster, index) => {
+            features.push({
+                type: 'Feature',
+                id: `cluster_${index}`,
+                geometry: { type: 'Point', coordinates: [cluster.lat, cluster.lon] },
+                properties: {
+                    iconContent: String(cluster.count),
+                    hintContent: _t("Pickup points: %s", cluster.count),
+                    clusterData: cluster,
+                },
+                options: { preset: 'islands#blueCircleIcon' },
+            });
+        });
+
         this.placemarkManager.removeAll(); // Очищаем предыдущие метки
         if (features.length > 0) {
             this.placemarkManager.add({
@@ -233,7 +293,9 @@ export class PvzMap extends Component {
 
             // Автоматическое масштабирование карты, чтобы все метки были видны
             // Делаем это только если город не менялся, чтобы избежать конфликта с центрированием на город
-            if (this.props.city && this.state.currentCityProcessedForBounds === this.props.city.code) {
+            if (!this._isAutoFit()) {
+                // Метки соответствуют видимой области, карту не двигаем
+            } else if (this.props.city && this.state.currentCityProcessedForBounds === this.props.city.code) {
                 if (features.length === 1 && this.props.selectedPvz) {
                     // Если выбрана одна точка, центрируемся на ней с хорошим зумом
                      this.yandexMap.setCenter(
@@ -264,7 +326,7 @@ export class PvzMap extends Component {
                  }
             }
 
-        } else if (this.props.city) {
+        } else if (this.props.city && this._isAutoFit()) {
             // Если ПВЗ нет, но город выбран, центрируемся на городе
             this._recenterMapOnCity();
             this.state.currentCityProcessedForBounds = this.props.city.code;
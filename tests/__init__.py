@@ -0,0 +1 @@
+from . import test_cdek_services
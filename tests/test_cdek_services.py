@@ -0,0 +1,746 @@
+import hashlib
+import io
+import json
+import tempfile
+import threading
+import time
+from datetime import datetime
+from unittest.mock import patch
+
+import requests
+from odoo.exceptions import UserError
+from odoo.tests import common
+from odoo.tools.pdf import PdfFileReader, PdfFileWriter
+
+from odoo.addons.cdek_odooAPI2.const import CDEK_SHIPMENT_MAX_ATTEMPTS, STREAM_CHUNK_SIZE
+from odoo.addons.cdek_odooAPI2.services import (
+    cdek_cache, cdek_client_pool, cdek_geo, cdek_packing, cdek_rate_limiter, cdek_resilience, cdek_singleflight, cdek_text,
+    cdek_token_store,
+)
+from odoo.addons.cdek_odooAPI2.services.cdek_request import CdekRequest, error_message
+from odoo.addons.cdek_odooAPI2.services.cdek_stream import iter_json_array
+
+
+class TestCdekClientPool(common.TransactionCase):
+
+    def test_credential_change_swaps_client(self):
+        params = self.env['ir.config_parameter'].sudo()
+        params.set_param('cdek.client_id', 'pool-id')
+        params.set_param('cdek.client_secret', 'pool-secret')
+        Settings = self.env['res.config.settings']
+        client = Settings._get_cdek_client()
+        self.assertIs(Settings._get_cdek_client(), client)
+        # Parameters that do not configure the client keep the pooled session
+        params.set_param('cdek.unrelated_option', 'x')
+        params.set_param('web.cdek_test_option', 'x')
+        self.assertIs(Settings._get_cdek_client(), client)
+        params.set_param('cdek.client_secret', 'pool-secret-2')
+        self.assertFalse(cdek_client_pool._clients)
+        swapped = Settings._get_cdek_client()
+        self.assertIsNot(swapped, client)
+        self.assertEqual(swapped.client_secret, 'pool-secret-2')
+        params.search([('key', '=', 'cdek.client_secret')]).unlink()
+        self.assertFalse(cdek_client_pool._clients)
+
+
+class TestCdekTokenStore(common.TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def _store(self):
+        return cdek_token_store.TokenStore('test', directory=self.directory)
+
+    @staticmethod
+    def _fetcher(*tokens):
+        tokens = list(tokens)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return tokens.pop(0), 3600
+        return fetch, calls
+
+    def test_refresh_ahead(self):
+        store = self._store()
+        fetch, calls = self._fetcher('t1', 't2')
+        self.assertEqual(store.get_token(fetch), 't1')
+        self.assertEqual(store.get_token(fetch), 't1')
+        self.assertEqual(len(calls), 1)
+        # Inside the refresh-ahead window the token is renewed before it expires
+        later = time.time() + 3600 - 200
+        with patch.object(cdek_token_store.time, 'time', return_value=later):
+            self.assertEqual(store.get_token(fetch), 't2')
+        self.assertEqual(len(calls), 2)
+
+    def test_shared_between_processes(self):
+        first, second = self._store(), self._store()
+        fetch, calls = self._fetcher('t1')
+        self.assertEqual(first.get_token(fetch), 't1')
+        # Another process reads the token from the file instead of fetching its own
+        self.assertEqual(second.get_token(fetch), 't1')
+        self.assertEqual(len(calls), 1)
+
+    def test_invalidate_after_401(self):
+        first, second = self._store(), self._store()
+        fetch, calls = self._fetcher('t1', 't2')
+        first.get_token(fetch)
+        second.get_token(fetch)
+        second.invalidate('t1')
+        self.assertEqual(second.get_token(fetch), 't2')
+        # The first process drops its rejected token and adopts the new one from the file
+        first.invalidate('t1')
+        self.assertEqual(first.get_token(fetch), 't2')
+        self.assertEqual(len(calls), 2)
+        # Invalidating an old token leaves the current one alone
+        second.invalidate('t1')
+        self.assertEqual(second.get_token(fetch), 't2')
+
+    def test_waiting_for_refresh_is_bounded(self):
+        store = self._store()
+        fetch, calls = self._fetcher('t1')
+        # Another process refreshing holds the lock past the caller's deadline
+        with self._store()._file_lock(0) as locked:
+            self.assertTrue(locked)
+            with self.assertRaises(cdek_resilience.CdekUnavailable):
+                store.get_token(fetch, expires_at=time.monotonic() + 0.2)
+        self.assertFalse(calls)
+        self.assertEqual(store.get_token(fetch), 't1')
+
+
+class TestCdekRateCache(common.TransactionCase):
+
+    def _payload(self, weight, items=None):
+        return {
+            'type': 1,
+            'tariff_code': 136,
+            'from_location': {'code': 44},
+            'to_location': {'code': 137},
+            'packages': [{'number': '1', 'weight': weight, 'length': 10, 'width': 10, 'height': 10,
+                          'items': items or []}],
+        }
+
+    def test_rate_key_uses_billing_granularity(self):
+        """Weights inside one billing step share a key, items are ignored."""
+        client = type('Client', (), {'base_url': 'https://api.edu.cdek.ru/v2/', 'client_id': 'test'})()
+        key = cdek_cache.rate_cache_key(self._payload(1210), client)
+        self.assertEqual(key, cdek_cache.rate_cache_key(self._payload(1290, items=[{'name': 'X'}]), client))
+        self.assertNotEqual(key, cdek_cache.rate_cache_key(self._payload(1310), client))
+
+    def test_order_batch_one_tarifflist_per_route(self):
+        Carrier = self.env['delivery.carrier']
+        product = self.env['product.product'].create({'name': 'CDEK delivery', 'type': 'service'})
+        carriers = Carrier.create([
+            {'name': f'CDEK {code}', 'delivery_type': 'cdek', 'product_id': product.id, 'cdek_tariff_code': code}
+            for code in (136, 137, 233)
+        ])
+        other_company = self.env['res.company'].create({'name': 'Other CDEK Company'})
+        foreign = Carrier.create({'name': 'CDEK other', 'delivery_type': 'cdek', 'product_id': product.id,
+                                  'cdek_tariff_code': 138, 'company_id': other_company.id})
+        order = self.env['sale.order'].create({'partner_id': self.env['res.partner'].create({'name': 'Buyer'}).id})
+        route = {'type': 1, 'from_location': {'code': 44}, 'to_location': {'code': 99137},
+                 'packages': [{'weight': 1000, 'length': 10, 'width': 10, 'height': 10}]}
+        calls = []
+
+        class Client:
+            base_url = 'https://api.edu.cdek.ru/v2/'
+            client_id = 'batch-test'
+
+            def calculate_tariff_list(self, payload):
+                calls.append(payload)
+                return {'tariff_codes': [{'tariff_code': code, 'delivery_sum': code * 2} for code in (136, 137, 138, 233)]}
+
+        def prepare(carrier, order):
+            return dict(route, tariff_code=carrier.cdek_tariff_code)
+
+        client = Client()
+        with patch.object(type(Carrier), '_cdek_prepare_rate_payload', prepare):
+            self.assertNotIn(foreign, Carrier._cdek_carriers_for_order(order))
+            Carrier._cdek_rate_order_batch(client, order, 600)
+        self.assertEqual(len(calls), 1)
+        for carrier in carriers:
+            key = cdek_cache.rate_cache_key(prepare(carrier, order), client)
+            self.assertEqual(cdek_cache.rate_cache.get(key, ttl=600)['total_sum'], carrier.cdek_tariff_code * 2)
+        # The other company's tariff was in the answer but is not cached for its carrier
+        self.assertIsNone(cdek_cache.rate_cache.get(cdek_cache.rate_cache_key(prepare(foreign, order), client), ttl=600))
+
+    def test_ttl_lru_cache(self):
+        cache = cdek_cache.TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)  # evicts 'b', the least recently used entry
+        self.assertIsNone(cache.get('b'))
+        with patch.object(cdek_cache.time, 'monotonic', return_value=cdek_cache.time.monotonic() + 61):
+            self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+
+class TestCdekStream(common.TransactionCase):
+
+    def test_iter_json_array_across_chunks(self):
+        points = [{'code': f'MSK{i}', 'name': 'ПВЗ "Ёлка" ]}', 'location': {'latitude': 55.7}} for i in range(50)]
+        raw = json.dumps(points, ensure_ascii=False).encode()
+        chunks = [raw[i:i + 7] for i in range(0, len(raw), 7)]
+        self.assertEqual(list(iter_json_array(chunks)), points)
+        self.assertEqual(list(iter_json_array([b'[12', b'3, 4', b'5]'])), [123, 45])
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"errors": []}']))
+
+
+class TestCdekGeo(common.TransactionCase):
+
+    def test_geohash_encode(self):
+        self.assertEqual(cdek_geo.geohash_encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+
+    def test_bbox_cover_contains_points(self):
+        south, west, north, east = 55.55, 37.35, 55.95, 37.85
+        cells = cdek_geo.bbox_cover(south, west, north, east)
+        self.assertLessEqual(len(cells), 32)
+        for lat, lon in [(55.75, 37.61), (55.55, 37.35), (55.95, 37.85), (55.6, 37.8)]:
+            geohash = cdek_geo.geohash_encode(lat, lon)
+            self.assertTrue(any(geohash.startswith(cell) for cell in cells))
+
+    def test_bbox_cover_antimeridian(self):
+        cells = cdek_geo.bbox_cover(64.0, 177.0, 66.0, -172.0)
+        for lat, lon in [(65.0, 179.5), (65.0, -175.0)]:
+            geohash = cdek_geo.geohash_encode(lat, lon)
+            self.assertTrue(any(geohash.startswith(cell) for cell in cells))
+
+
+class TestCdekPvzWidget(common.TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.Pvz = self.env['cdek.pvz']
+        self.live_calls = []
+        live_calls = self.live_calls
+
+        class Client:
+            def get_delivery_points(self, **params):
+                live_calls.append(params)
+                return [{'code': 'LIVE1', 'name': 'Live point', 'type': 'PVZ',
+                         'location': {'city_code': params['city_code'], 'latitude': 55.0, 'longitude': 37.0}}]
+
+        patcher = patch.object(type(self.env['res.config.settings']), '_get_cdek_client', return_value=Client())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _sync_points(self, *points):
+        self.Pvz._upsert_batch([self.Pvz._prepare_pvz_vals({
+            'code': code, 'name': code, 'type': pvz_type,
+            'location': {'city_code': city_code, 'city': 'Test', 'latitude': lat, 'longitude': lon},
+        }) for code, pvz_type, city_code, lat, lon in points])
+
+    def test_local_points(self):
+        self._sync_points(('TW1', 'PVZ', 99044, 55.75, 37.61), ('TW2', 'POSTAMAT', 99044, 55.76, 37.62))
+        self.assertEqual([p['code'] for p in self.Pvz._get_widget_points(99044)], ['TW1', 'TW2'])
+        self.assertEqual([p['code'] for p in self.Pvz._get_widget_points(99044, 'POSTAMAT')], ['TW2'])
+        # A synced city without points of the requested type has none: CDEK is not asked
+        self._sync_points(('TW3', 'PVZ', 99045, 54.0, 36.0))
+        self.assertEqual(self.Pvz._get_widget_points(99045, 'POSTAMAT'), [])
+        self.assertFalse(self.live_calls)
+
+    def test_live_fallback_for_unsynced_city(self):
+        self._sync_points(('TW1', 'PVZ', 99044, 55.75, 37.61))
+        self.assertEqual([p['code'] for p in self.Pvz._get_widget_points(99046, 'PVZ')], ['LIVE1'])
+        self.assertEqual(self.live_calls, [{'city_code': 99046, 'type': 'PVZ', 'size': 300}])
+
+    def test_live_search_forced(self):
+        self._sync_points(('TW1', 'PVZ', 99044, 55.75, 37.61))
+        self.env['ir.config_parameter'].sudo().set_param('cdek.pvz_live_search', 'True')
+        self.assertEqual([p['code'] for p in self.Pvz._get_widget_points(99044)], ['LIVE1'])
+        self.assertEqual(len(self.live_calls), 1)
+
+
+    def test_tile_clusters_follow_sync_watermark(self):
+        params = self.env['ir.config_parameter'].sudo()
+        params.set_param('cdek.pvz_sync_watermark', '2026-01-01 00:00:00')
+        bbox = (-39.9, 100.0, -39.8, 100.1)
+        self._sync_points(('TC1', 'PVZ', 99050, -39.85, 100.05), ('TC2', 'PVZ', 99050, -39.86, 100.06))
+        clusters = self.Pvz._get_viewport_clusters(*bbox, zoom=8)
+        self.assertEqual(sum(c['count'] for c in clusters), 2)
+        self._sync_points(('TC3', 'PVZ', 99050, -39.84, 100.04))
+        # Tiles stay cached until a sync moves the watermark
+        self.assertEqual(sum(c['count'] for c in self.Pvz._get_viewport_clusters(*bbox, zoom=8)), 2)
+        params.set_param('cdek.pvz_sync_watermark', '2026-01-02 00:00:00')
+        self.assertEqual(sum(c['count'] for c in self.Pvz._get_viewport_clusters(*bbox, zoom=8)), 3)
+        # At a zoom where the points fall in separate grid cells, each single point carries its code
+        close_bbox = (-39.87, 100.03, -39.83, 100.07)
+        single = [c['code'] for c in self.Pvz._get_viewport_clusters(*close_bbox, zoom=14) if c['count'] == 1]
+        self.assertEqual(sorted(single), ['TC1', 'TC2', 'TC3'])
+
+
+class TestCdekCitySearch(common.TransactionCase):
+
+    def test_search_key_normalization(self):
+        self.assertEqual(cdek_text.normalize_search_text('  Ростов-на-Дону '), 'ростов на дону')
+        self.assertEqual(cdek_text.normalize_search_text('Орёл'), cdek_text.normalize_search_text('орел'))
+        self.assertEqual(cdek_text.like_prefix('50%_off'), '50\\%\\_off%')
+
+    def test_local_autocomplete(self):
+        City = self.env['cdek.city']
+        City._upsert_batch([
+            City._cdek_prepare_vals({'code': 44, 'city': 'Москва', 'country_code': 'RU'}),
+            City._cdek_prepare_vals({'code': 1, 'city': 'Московский', 'country_code': 'RU'}),
+        ])
+        self.assertEqual([c['code'] for c in City._search_autocomplete('моск')], ['44', '1'])
+        self.assertEqual([c['code'] for c in City._search_autocomplete('Moskva')], ['44'])
+        self.assertEqual(City._search_autocomplete('моск', country_code='KZ'), [])
+        # Only RU is synced: an empty KZ answer must fall back to CDEK, an empty RU one must not
+        self.assertTrue(City._has_replica('RU'))
+        self.assertFalse(City._has_replica('KZ'))
+
+
+class TestCdekTracking(common.TransactionCase):
+
+    def test_fetch_order_infos_concurrently(self):
+        class FakeClient:
+            def _get_token(self):
+                return 'token'
+
+            def get_order_info(self, uuid):
+                if uuid == 'bad':
+                    raise ValueError(uuid)
+                return {'entity': {'uuid': uuid, 'statuses': []}}
+
+        results = self.env['stock.picking']._cdek_fetch_order_infos(FakeClient(), ['a', 'b', 'a', 'bad'])
+        self.assertEqual(set(results), {'a', 'b', 'bad'})
+        self.assertEqual(results['b'][0]['entity']['uuid'], 'b')
+        self.assertIsInstance(results['bad'][1], ValueError)
+
+    def test_prepare_tracking_events(self):
+        events = self.env['stock.picking']._cdek_prepare_tracking_events({'entity': {'uuid': 'order', 'statuses': [
+            {'code': 'DELIVERED', 'name': 'Вручен', 'date_time': '2026-03-02T10:00:00+0300'},
+            {'code': 'CREATED', 'name': 'Создан', 'date_time': '2026-03-01T09:00:00+0300'},
+        ]}})
+        self.assertEqual([e['code'] for e in events], ['DELIVERED', 'CREATED'])
+        self.assertEqual(str(events[0]['date_time']), '2026-03-02 07:00:00')
+        self.assertEqual(events[0]['order_uuid'], 'order')
+
+    def test_tracking_events_insert_only(self):
+        Event = self.env['cdek.tracking.event']
+        vals = {'order_uuid': 'order', 'code': 'CREATED', 'date_time': '2026-03-01 06:00:00', 'source': 'poll'}
+        self.assertEqual(len(Event._insert_events([vals])), 1)
+        self.assertFalse(Event._insert_events([dict(vals, source='webhook')]))
+        self.assertEqual(Event.search_count([('order_uuid', '=', 'order')]), 1)
+
+
+    def test_tracking_fingerprint(self):
+        Picking = self.env['stock.picking']
+        info = {'entity': {'uuid': 'order', 'statuses': [
+            {'code': 'CREATED', 'date_time': '2026-03-01T09:00:00+0300'},
+            {'code': 'ACCEPTED', 'date_time': '2026-03-01T12:00:00+0300'},
+        ]}}
+        fingerprint = Picking._cdek_tracking_fingerprint(Picking._cdek_prepare_tracking_events(info))
+        self.assertEqual(fingerprint, 'ACCEPTED|2026-03-01 09:00:00|2')
+        info['entity']['statuses'].append({'code': 'ACCEPTED', 'date_time': '2026-03-01T09:00:00+0300'})
+        self.assertNotEqual(Picking._cdek_tracking_fingerprint(Picking._cdek_prepare_tracking_events(info)), fingerprint)
+
+    def test_tracking_errors_do_not_flood_chatter(self):
+        Picking = self.env['stock.picking']
+        pickings = Picking.create([{
+            'picking_type_id': self.env.ref('stock.picking_type_out').id,
+            'location_id': self.env.ref('stock.stock_location_stock').id,
+            'location_dest_id': self.env.ref('stock.stock_location_customers').id,
+            'cdek_order_uuid': uuid,
+        } for uuid in ('down', 'unknown')])
+        results = {
+            'down': (None, cdek_resilience.CdekCircuitOpen('CDEK is temporarily unavailable')),
+            'unknown': (None, UserError('CDEK API Error [404]: order not found')),
+        }
+        messages = {picking: len(picking.message_ids) for picking in pickings}
+        with patch.object(type(Picking), '_cdek_is_trackable', lambda self: True), \
+                patch.object(type(Picking), '_cdek_fetch_order_infos', lambda self, client, uuids: results), \
+                patch.object(type(self.env['res.config.settings']), '_get_cdek_client'):
+            for _run in range(3):
+                pickings._cdek_update_tracking_state()
+        down, unknown = pickings
+        # An outage is logged, not posted; an unknown order is posted once per streak of failures
+        self.assertEqual(len(down.message_ids), messages[down])
+        self.assertEqual(len(unknown.message_ids), messages[unknown] + 1)
+        self.assertEqual((down.cdek_tracking_error_count, unknown.cdek_tracking_error_count), (3, 3))
+
+    def test_schedule_next_check(self):
+        picking = self.env['stock.picking'].new({'cdek_tracking_state_code': 'ACCEPTED_AT_PICK_UP_POINT'})
+        with patch('odoo.fields.Datetime.now', return_value=datetime(2026, 3, 1)):
+            picking._cdek_schedule_next_check(60)
+            self.assertEqual(picking.cdek_tracking_next_check, datetime(2026, 3, 1, 12))
+            picking._cdek_schedule_next_check(60, failed=True)
+            picking._cdek_schedule_next_check(60, failed=True)
+        self.assertEqual(picking.cdek_tracking_error_count, 2)
+        self.assertEqual(picking.cdek_tracking_next_check, datetime(2026, 3, 1, 4))
+
+class TestCdekWebhook(common.TransactionCase):
+
+    def test_prepare_event_vals(self):
+        events = self.env['cdek.webhook.event']
+        vals = events._prepare_event_vals({
+            'type': 'ORDER_STATUS',
+            'date_time': '2026-03-02T10:00:05+0300',
+            'uuid': '72753031-0000-0000-0000-000000000001',
+            'attributes': {'code': 'DELIVERED', 'status_date_time': '2026-03-02T10:00:00+0300', 'city_name': 'Москва'},
+        })
+        self.assertEqual(vals['status_code'], 'DELIVERED')
+        self.assertEqual(str(vals['status_datetime']), '2026-03-02 07:00:00')
+        self.assertIsNone(events._prepare_event_vals({'type': 'UNKNOWN'}))
+        self.assertIsNone(events._prepare_event_vals(['not', 'an', 'event']))
+
+    def test_process_pending_marks_events(self):
+        events = self.env['cdek.webhook.event']
+        status, print_form = events.create([
+            events._prepare_event_vals({'type': 'ORDER_STATUS', 'uuid': 'missing', 'attributes': {'code': 'CREATED'}}),
+            events._prepare_event_vals({'type': 'PRINT_FORM', 'uuid': 'task', 'attributes': {'url': 'https://x'}}),
+        ])
+        events._process_pending()
+        self.assertEqual((status.state, print_form.state), ('done', 'ignored'))
+
+
+class TestCdekShipmentQueue(common.TransactionCase):
+
+    def test_extract_order_uuid(self):
+        Carrier = self.env['delivery.carrier']
+        self.assertEqual(Carrier._cdek_extract_order_uuid({'entity': {'uuid': 'u1'}}), 'u1')
+        self.assertEqual(Carrier._cdek_extract_order_uuid({'requests': [
+            {'related_entities': [{'type': 'WAYBILL', 'uuid': 'w'}, {'type': 'ORDER', 'uuid': 'u2'}]}]}), 'u2')
+        rejected = {'requests': [{'state': 'INVALID', 'errors': [{'code': 'v2_bad', 'message': 'Bad phone'}]}]}
+        self.assertIsNone(Carrier._cdek_extract_order_uuid(rejected))
+        self.assertIn('Bad phone', Carrier._cdek_order_errors(rejected))
+
+    def test_error_message_mapping(self):
+        body = json.dumps({'requests': [{'errors': [{'code': 'v2_bad_phone', 'message': 'Bad phone'}]}]})
+        self.assertEqual(error_message(400, body), 'CDEK API Error [400]: v2_bad_phone: Bad phone')
+        self.assertEqual(error_message(502, '<html>Bad Gateway</html>'), 'CDEK API Error [502]: <html>Bad Gateway</html>')
+
+    def _make_job(self, **vals):
+        product = self.env['product.product'].create({'name': 'CDEK delivery', 'type': 'service'})
+        carrier = self.env['delivery.carrier'].create({
+            'name': 'CDEK queue', 'delivery_type': 'cdek', 'product_id': product.id, 'cdek_tariff_code': 136,
+        })
+        picking = self.env['stock.picking'].create({
+            'picking_type_id': self.env.ref('stock.picking_type_out').id,
+            'location_id': self.env.ref('stock.stock_location_stock').id,
+            'location_dest_id': self.env.ref('stock.stock_location_customers').id,
+            'carrier_id': carrier.id,
+        })
+        job = self.env['cdek.shipment.job']._enqueue(picking)
+        if vals:
+            job.write(vals)
+        return job
+
+    def _process(self, jobs):
+        payload = {'number': jobs[:1].name, 'packages': [{'number': '1'}, {'number': '2'}]}
+        Settings = type(self.env['res.config.settings'])
+        with patch.object(type(self.env['delivery.carrier']), '_build_order_payload', lambda carrier, picking: payload), \
+                patch.object(Settings, '_get_cdek_client', return_value=CdekRequest('client', 'secret', test_mode=True)), \
+                patch.object(CdekRequest, '_get_token', return_value='token'), \
+                patch('odoo.addons.cdek_odooAPI2.services.cdek_request.time.sleep'):
+            jobs._process()
+
+    def test_job_registered(self):
+        job = self._make_job()
+        with patch.object(CdekRequest, 'create_order_idempotent', return_value={'entity': {'uuid': 'u1'}}):
+            self._process(job)
+        self.assertEqual((job.state, job.order_uuid), ('done', 'u1'))
+        self.assertEqual((job.picking_id.cdek_order_uuid, job.picking_id.cdek_package_count), ('u1', 2))
+
+    def test_job_transient_failure_is_retried(self):
+        job = self._make_job()
+        unavailable = cdek_resilience.CdekUnavailable('CDEK API Error [503]')
+        before = job.next_attempt_at
+        with patch.object(CdekRequest, 'create_order_idempotent', side_effect=unavailable):
+            self._process(job)
+        self.assertEqual((job.state, job.attempts), ('pending', 1))
+        self.assertIn('503', job.last_error)
+        self.assertGreater(job.next_attempt_at, before)
+        self.assertFalse(job.picking_id.cdek_order_uuid)
+
+    def test_interrupted_job_is_reconciled(self):
+        job = self._make_job(state='in_progress')
+        job.flush_recordset()
+        self.env.cr.execute("UPDATE cdek_shipment_job SET write_date = now() AT TIME ZONE 'UTC' - interval '1 hour' "
+                            "WHERE id = %s", [job.id])
+        job.invalidate_recordset()
+        self.assertEqual(self.env['cdek.shipment.job']._reconcile_stale(), job)
+        self.assertEqual((job.state, job.attempts), ('pending', 1))
+        # The retry finds the order registered before the crash instead of creating a second one
+        with patch.object(CdekRequest, 'find_order_by_number', return_value={'entity': {'uuid': 'existing'}}) as find, \
+                patch.object(CdekRequest, 'create_order') as create_order:
+            self._process(job)
+        find.assert_called_once_with(job.name)
+        create_order.assert_not_called()
+        self.assertEqual((job.state, job.picking_id.cdek_order_uuid), ('done', 'existing'))
+
+    def test_job_fails_after_max_attempts(self):
+        job = self._make_job(attempts=CDEK_SHIPMENT_MAX_ATTEMPTS - 1)
+        messages = len(job.picking_id.message_ids)
+        with patch.object(CdekRequest, 'create_order_idempotent',
+                          side_effect=cdek_resilience.CdekUnavailable('CDEK API Error [503]')):
+            self._process(job)
+        self.assertEqual((job.state, job.attempts), ('failed', CDEK_SHIPMENT_MAX_ATTEMPTS))
+        self.assertEqual(len(job.picking_id.message_ids), messages + 1)
+
+    def test_create_order_looks_up_before_retry(self):
+        client = CdekRequest('client', 'secret', test_mode=True)
+        unavailable = cdek_resilience.CdekUnavailable('CDEK API Error [503]')
+        with patch.object(CdekRequest, 'create_order', side_effect=unavailable) as create_order, \
+                patch.object(CdekRequest, 'find_order_by_number', return_value={'entity': {'uuid': 'u1'}}) as find, \
+                patch('odoo.addons.cdek_odooAPI2.services.cdek_request.time.sleep'):
+            response = client.create_order_idempotent({'number': 'WH/OUT/00001'})
+        self.assertEqual(response['entity']['uuid'], 'u1')
+        # The first POST failed: the order was found by number instead of being sent again
+        self.assertEqual(create_order.call_count, 1)
+        find.assert_called_once_with('WH/OUT/00001')
+
+
+class TestCdekLabelCache(common.TransactionCase):
+
+    def _make_picking(self, package_count=0):
+        return self.env['stock.picking'].create({
+            'picking_type_id': self.env.ref('stock.picking_type_out').id,
+            'location_id': self.env.ref('stock.stock_location_stock').id,
+            'location_dest_id': self.env.ref('stock.stock_location_customers').id,
+            'cdek_package_count': package_count,
+        })
+
+    def test_split_label_by_package_count(self):
+        writer = PdfFileWriter()
+        for _page in range(3):
+            writer.addBlankPage(298, 420)
+        merged = io.BytesIO()
+        writer.write(merged)
+        pickings = self._make_picking(2) | self._make_picking(1)
+        split = pickings._cdek_split_label_pdf(merged)
+        self.assertEqual([PdfFileReader(split[p]).getNumPages() for p in pickings], [2, 1])
+        # Pages that do not add up to the package counts are never guessed
+        pickings[1].cdek_package_count = 2
+        self.assertIsNone(pickings._cdek_split_label_pdf(merged))
+        pickings[1].cdek_package_count = 0
+        self.assertIsNone(pickings._cdek_split_label_pdf(merged))
+
+    def test_label_cache_roundtrip(self):
+        Label = self.env['cdek.label']
+        picking = self._make_picking()
+        label = Label._store(picking, 'order-1', io.BytesIO(b'%PDF-1.4 label'))
+        self.assertEqual(Label._get_cached(['order-1', 'order-2']), {'order-1': label})
+        self.assertEqual(label.attachment_id.raw, b'%PDF-1.4 label')
+        self.assertTrue(label.checksum)
+        copy = Label._attachment_from_file(io.BytesIO(b'%PDF-1.4 label'), {'name': 'copy.pdf'})
+        self.assertEqual(copy.checksum, label.checksum)
+        self.assertEqual(copy.store_fname, label.attachment_id.store_fname)
+        # Files larger than a chunk are copied to the filestore piece by piece
+        content = b'%PDF-1.4 ' + bytes(range(256)) * (STREAM_CHUNK_SIZE // 128)
+        large = Label._attachment_from_file(io.BytesIO(content), {'name': 'large.pdf'})
+        self.assertEqual(large.raw, content)
+        self.assertEqual(large.file_size, len(content))
+        self.assertEqual(large.checksum, hashlib.sha1(content).hexdigest())
+        Label._invalidate(['order-1'])
+        self.assertFalse(label.exists())
+
+    def test_print_selection_stores_no_merged_copy(self):
+        product = self.env['product.product'].create({'name': 'CDEK delivery', 'type': 'service'})
+        carrier = self.env['delivery.carrier'].create({
+            'name': 'CDEK labels', 'delivery_type': 'cdek', 'product_id': product.id, 'cdek_tariff_code': 136,
+        })
+        Label = self.env['cdek.label']
+        pickings = self.env['stock.picking']
+        for number in range(2):
+            picking = self._make_picking()
+            picking.write({'carrier_id': carrier.id, 'cdek_order_uuid': f'order-{number}'})
+            writer = PdfFileWriter()
+            writer.addBlankPage(298, 420)
+            page = io.BytesIO()
+            writer.write(page)
+            page.seek(0)
+            Label._store(picking, f'order-{number}', page)
+            pickings |= picking
+
+        action = pickings[0].cdek_action_get_label()
+        self.assertEqual(action['url'], f'/web/content/{Label._get_cached(["order-0"])["order-0"].attachment_id.id}?download=true')
+        attachment_count = self.env['ir.attachment'].search_count([])
+        action = pickings.cdek_action_get_label()
+        self.assertEqual(action['url'], '/cdek/labels?picking_ids=%s,%s' % tuple(pickings.ids))
+        self.assertEqual(self.env['ir.attachment'].search_count([]), attachment_count)
+
+        merged = io.BytesIO()
+        pickings._cdek_merge_label_pdf(pickings._cdek_ensure_labels(), merged)
+        merged.seek(0)
+        self.assertEqual(PdfFileReader(merged).getNumPages(), 2)
+
+
+class TestCdekShippingProfile(common.TransactionCase):
+
+    def test_product_profile(self):
+        product = self.env['product.product'].create({
+            'name': 'CDEK Box', 'type': 'consu', 'weight': 0.2534, 'list_price': 99.999,
+            'default_code': 'BOX-1', 'cdek_length_cm': 10.4, 'cdek_width_cm': 0.2,
+        })
+        self.assertEqual(product.cdek_weight_g, 253)
+        self.assertEqual((product.cdek_length_cm, product.cdek_width_cm, product.cdek_height_cm), (10, 1, 0))
+        self.assertEqual(product.cdek_ware_key, 'BOX-1')
+        self.assertEqual(product.cdek_declared_value, 100.0)
+        product.product_tmpl_id.list_price = 50
+        self.assertEqual(product.cdek_declared_value, 50.0)
+
+
+class TestCdekPacking(common.TransactionCase):
+
+    def test_weight_split_without_catalogue(self):
+        default_box = cdek_packing.Box(None, 10, 10, 10, 0)
+        lines = [cdek_packing.PackLine(0, 5, 8000, 20, 10, 10)]
+        parcels = cdek_packing.pack_lines(lines, [], 30000, default_box)
+        self.assertEqual([p['items'][0] for p in parcels], [3, 2])
+        self.assertEqual([p['weight_g'] for p in parcels], [24000, 16000])
+        # The default box grows to the item that does not fit in it
+        self.assertEqual(sorted(parcels[0]['box'][1:4]), [10, 10, 20])
+
+    def test_catalogue_right_sizing(self):
+        small = cdek_packing.Box('S', 20, 20, 10, 0)
+        large = cdek_packing.Box('L', 40, 40, 40, 0)
+        lines = [cdek_packing.PackLine(0, 2, 100, 10, 10, 5), cdek_packing.PackLine(1, 1, 500, 60, 10, 10)]
+        parcels = cdek_packing.pack_lines(lines, [large, small], 30000, None)
+        self.assertEqual(len(parcels), 2)
+        # The oversized unit ships in its own dimensions, the small items in the smallest box holding them
+        self.assertEqual(parcels[0]['box'].name, None)
+        self.assertEqual(parcels[0]['items'], {1: 1})
+        self.assertEqual(parcels[1]['box'], small)
+        self.assertEqual(parcels[1]['items'], {0: 2})
+
+
+class TestCdekResilience(common.TransactionCase):
+
+    def test_circuit_breaker(self):
+        breaker = cdek_resilience.CircuitBreaker('test', failure_threshold=2, reset_seconds=30)
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        with self.assertRaises(cdek_resilience.CdekCircuitOpen):
+            breaker.before_call()
+        # After the reset period one probe goes through, the next caller still fails fast
+        with patch.object(cdek_resilience.time, 'monotonic', return_value=breaker._opened_at + 31):
+            breaker.before_call()
+            with self.assertRaises(cdek_resilience.CdekCircuitOpen):
+                breaker.before_call()
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        breaker.before_call()
+
+    def test_circuit_per_endpoint_class(self):
+        base_url = 'https://cdek.test/'
+        background = cdek_resilience.get_breaker(base_url, 'delivery_points')
+        self.assertIs(background, cdek_resilience.get_breaker(base_url, 'order_by_uuid'))
+        interactive = cdek_resilience.get_breaker(base_url, 'calculator_tarifflist')
+        self.assertIsNot(interactive, background)
+        for _i in range(background.failure_threshold):
+            background.record_failure()
+        # A failing bulk sync leaves the checkout calculator alone
+        self.assertTrue(background.is_open)
+        interactive.before_call()
+        background.reset()
+
+    def test_token_fetch_within_call_deadline(self):
+        client = CdekRequest('client', 'secret', test_mode=True)
+        breaker = cdek_resilience.CircuitBreaker('token', failure_threshold=1, reset_seconds=30)
+        response = requests.Response()
+        response.status_code = 503
+        response._content = b'Service Unavailable'
+        with patch.object(requests.Session, 'post', return_value=response) as post:
+            with self.assertRaises(cdek_resilience.CdekUnavailable):
+                client._fetch_token(time.monotonic() + 2, breaker)
+        # The token call never outlives the call it serves, and an outage counts against its circuit
+        self.assertLessEqual(post.call_args.kwargs['timeout'][1], 2)
+        self.assertTrue(breaker.is_open)
+        # An open circuit refuses the call before it takes a rate limiter or a token
+        with patch.object(cdek_resilience, 'get_breaker', return_value=breaker), \
+                patch.object(client._limiter, 'acquire') as acquire, \
+                patch.object(CdekRequest, '_get_token') as get_token:
+            with self.assertRaises(cdek_resilience.CdekCircuitOpen):
+                client._send('GET', 'order_by_uuid', ep_params={'uuid': 'u1'})
+        acquire.assert_not_called()
+        get_token.assert_not_called()
+
+    def test_rate_limiter_priorities(self):
+        with tempfile.TemporaryDirectory() as directory:
+            limiter = cdek_rate_limiter.RateLimiter('test', directory=directory, rate=0.001, burst=4)
+            # Background calls leave half of the bucket to the classes above them
+            with cdek_rate_limiter.priority('background'):
+                limiter.acquire()
+                limiter.acquire()
+                with self.assertRaises(cdek_resilience.CdekUnavailable):
+                    limiter.acquire(expires_at=time.monotonic() + 1)
+            with cdek_rate_limiter.priority('interactive'):
+                limiter.acquire(expires_at=time.monotonic() + 1)
+            # Retry-After holds back every class, checkout included
+            limiter.block(60)
+            with cdek_rate_limiter.priority('interactive'):
+                with self.assertRaises(cdek_resilience.CdekUnavailable):
+                    limiter.acquire(expires_at=time.monotonic() + 1)
+
+    def test_stale_quote_key_brackets_weight(self):
+        client = type('Client', (), {'base_url': 'https://api.cdek.ru/v2/', 'client_id': 'id'})()
+        payload = {'type': 1, 'tariff_code': 136, 'from_location': {'code': 44}, 'to_location': {'code': 137},
+                   'packages': [{'weight': 1210, 'length': 10, 'width': 10, 'height': 10}]}
+        heavier = dict(payload, packages=[{'weight': 700, 'length': 30, 'width': 20, 'height': 10},
+                                          {'weight': 790, 'length': 10, 'width': 10, 'height': 10}])
+        self.assertEqual(cdek_cache.stale_quote_key(payload, client), cdek_cache.stale_quote_key(heavier, client))
+        other_route = dict(payload, to_location={'code': 270})
+        self.assertNotEqual(cdek_cache.stale_quote_key(payload, client),
+                            cdek_cache.stale_quote_key(other_route, client))
+
+
+class TestCdekSingleFlight(common.TransactionCase):
+
+    def test_concurrent_calls_share_one_request(self):
+        flights = cdek_singleflight.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return {'points': [1, 2]}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do('pvz:44', fetch))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flights.coalesced < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'points': [1, 2]}] * 5)
+        # Every caller owns its answer
+        self.assertEqual(len({id(result) for result in results}), 5)
+
+    def test_follower_waits_within_its_deadline(self):
+        flights = cdek_singleflight.SingleFlight()
+        release = threading.Event()
+        leader = threading.Thread(target=lambda: flights.do('pvz:44', lambda: release.wait(5)))
+        leader.start()
+        while 'pvz:44' not in flights._calls:
+            time.sleep(0.01)
+        with self.assertRaises(cdek_resilience.CdekUnavailable):
+            flights.do('pvz:44', lambda: None, timeout=0.05)
+        release.set()
+        leader.join()
+
+    def test_request_key_is_canonical(self):
+        client = type('Client', (), {'base_url': 'https://api.cdek.ru/v2/', 'client_id': 'id'})()
+        self.assertEqual(
+            cdek_singleflight.request_key(client, 'GET', 'delivery_points', query_params={'city_code': 44, 'type': 'PVZ'}),
+            cdek_singleflight.request_key(client, 'GET', 'delivery_points', query_params={'type': 'PVZ', 'city_code': 44}),
+        )
+        # A checkout call leads its own flight rather than waiting behind a background one
+        with cdek_rate_limiter.priority('background'):
+            background = cdek_singleflight.request_key(client, 'GET', 'location_cities', query_params={'q': 'Моск'})
+        with cdek_rate_limiter.priority('interactive'):
+            interactive = cdek_singleflight.request_key(client, 'GET', 'location_cities', query_params={'q': 'Моск'})
+        self.assertNotEqual(background, interactive)